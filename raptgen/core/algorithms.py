@@ -3,12 +3,15 @@
 
 # todo: このファイルでは pHMM に関するアルゴリズムをまとめる。weblogo に関するアルゴリズムもここに集約する。
 
-from itertools import groupby
+import copy
+import warnings
 from time import time
-from typing import Callable, List, Tuple, Union
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from matplotlib.axes import Axes
 from torch import Tensor, nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
 import torch
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -40,6 +43,24 @@ def kld_loss(mus: Tensor, logvars: Tensor):
     return kl_divergence
 
 
+def _weighted_mean(
+    weights: Optional[Tensor], values: Tensor, replicas: Optional[int] = None
+) -> Tensor:
+    """`weights` が None なら単純平均，そうでなければ重み付き平均を返す。
+    `replicas` を指定した場合は `values` を `replicas` 個に等分し，それぞれの平均を (`replicas`, ) で返す。
+    """
+    if replicas is None:
+        if weights is None:
+            return values.mean()
+        return (values * weights).sum() / weights.sum()
+
+    values = values.reshape(replicas, -1)
+    if weights is None:
+        return values.mean(dim=1)
+    weights = weights.reshape(replicas, -1)
+    return (values * weights).sum(dim=1) / weights.sum(dim=1)
+
+
 def profile_hmm_vae_loss(
     batch_input: Tensor,
     transition_probs: Tensor,
@@ -50,6 +71,11 @@ def profile_hmm_vae_loss(
     force_matching: bool = False,
     match_cost: float = 5,
     split_ce_kld: bool = False,
+    engine: str = "wavefront",
+    padded: bool = True,
+    band_width: Optional[int] = None,
+    weights: Optional[Tensor] = None,
+    replicas: Optional[int] = None,
 ) -> Tensor:
     """pHMM デコーダを使用する際の損失関数。
 
@@ -76,12 +102,26 @@ def profile_hmm_vae_loss(
         Matching の方に傾く度合いを示す。大きいほど matching to matcing への傾向が高くなる。`1` のとき他の `combi of 'from' and 'to'` と重みが等しくなる。
     split_ce_kld : True, default = False
         返却時に再構成誤差項と正則化項を別々に分けたテンソルとして返却するかを指定する。これを指定するとき，`beta = 1` となる。
+    engine : str, default = "wavefront"
+        forward アルゴリズムの実装。`profile_hmm_loss` の `engine` を参照。
+    padded : bool, default = True
+        長さの異なる配列を含むバッチを一度の動的計画法で計算するか。`profile_hmm_loss` の `padded` を参照。
+    band_width : Optional[int], default = None
+        動的計画表の対角線周りの帯の幅。`profile_hmm_loss` の `band_width` を参照。
+    weights : Optional[Tensor], default = None
+        batch 内の各要素の重み。(`batch`, ) の 1 次元構成。
+        指定した場合は平均の代わりに重み付き平均をとる。重複数を重みにすると，重複を展開した配列集合に対する平均と一致する。
+    replicas : Optional[int], default = None
+        batch が `replicas` 個のモデルの出力を連結したものである場合に指定する。
+        各モデルの出力は同じ大きさで，この順に連結されている必要がある。
+        全モデルの動的計画法を 1 度に計算し，損失値はモデル毎に平均する。
 
     Returns
     -------
     vae_loss : Tensor
-        batch 内の各要素に対する ELBO の平均値が出力される。
+        batch 内の各要素に対する ELBO の平均値（`weights` を指定した際は重み付き平均値）が出力される。
         `split_ce_kld` を指定した際は再構成誤差項と正則化項のそれぞれの平均値が結合されたテンソルとして出力される。
+        `replicas` を指定した際はモデル毎の値が (`replicas`, ) の 1 次元構成で，`split_ce_kld` を指定した際は (2, `replicas`) の 2 次元構成で出力される。
     """
     assert batch_input.dim() == 2
     assert transition_probs.dim() == 3
@@ -89,19 +129,34 @@ def profile_hmm_vae_loss(
     assert mus.dim() == 2
     assert logvars.dim() == 2
 
-    reconstruction_error = profile_hmm_loss(
-        transition_probs=transition_probs,
-        emission_probs=emission_probs,
-        batch_input=batch_input,
-    ).mean()
+    if weights is not None:
+        assert weights.shape == batch_input.shape[:1]
+        weights = weights.to(transition_probs.dtype)
 
-    if force_matching == True:
-        reconstruction_error += force_matching_loss(
+    reconstruction_error = _weighted_mean(
+        weights,
+        profile_hmm_loss(
             transition_probs=transition_probs,
-            match_cost=match_cost,
-        ).mean()
+            emission_probs=emission_probs,
+            batch_input=batch_input,
+            engine=engine,
+            padded=padded,
+            band_width=band_width,
+        ),
+        replicas,
+    )
+
+    if force_matching == True:
+        reconstruction_error += _weighted_mean(
+            weights,
+            force_matching_loss(
+                transition_probs=transition_probs,
+                match_cost=match_cost,
+            ),
+            replicas,
+        )
 
-    regularization_error = kld_loss(mus, logvars).mean()
+    regularization_error = _weighted_mean(weights, kld_loss(mus, logvars), replicas)
 
     if split_ce_kld == True:
         return torch.stack([reconstruction_error, regularization_error])
@@ -120,10 +175,736 @@ def _masked_select_1D(input: Tensor, mask: Tensor):
     return torch.masked_select(input, expanded_mask).reshape(output_shape)
 
 
+def _phmm_band_mask(
+    ks: Tensor, ls: Tensor, lengths: Tensor, motif_len: int, band_width: int
+) -> Tensor:
+    """セル (k, l) が各配列の帯 `|l - k * length / motif_len| <= band_width` の内側にあるかを返す。
+    帯の中心は (0, 0) と終端セル (`motif_len`, `length`) を結ぶ直線であり，両端のセルは常に帯に含まれる。
+
+    Parameters
+    ----------
+    ks, ls : Tensor
+        セルの k, l 座標。同じ形状 `S` に broadcast できる必要がある。
+    lengths : Tensor
+        各配列のパディングを除いた長さ。(`set_size`,) の 1 次元構成。
+
+    Returns
+    -------
+    in_band : Tensor
+        (`set_size`, *`S`) の bool テンソル。
+    """
+    lengths = lengths.view(-1, *([1] * max(ks.dim(), ls.dim())))
+    # 浮動小数点の丸めを避けるため |l * motif_len - k * length| <= band_width * motif_len を整数で判定する。
+    return (ls * motif_len - ks * lengths).abs() <= band_width * motif_len
+
+
+def _phmm_band_range(
+    d: int, motif_len: int, lengths: Tensor, band_width: Optional[int]
+) -> Tuple[int, int]:
+    """反対角線 `d` 上で，いずれかの配列の帯に含まれるセルの k の範囲 [lo, hi] を返す。帯を用いない場合は全範囲を返す。
+    帯の端 `k = motif_len * (d ∓ band_width) / (motif_len + length)` は length について単調なので，最短・最長の配列について調べれば十分である。
+    """
+    if band_width is None:
+        return 0, motif_len
+    bounds = [
+        (
+            -((-motif_len * (d - band_width)) // (motif_len + length)),
+            (motif_len * (d + band_width)) // (motif_len + length),
+        )
+        for length in (int(lengths.min().item()), int(lengths.max().item()))
+    ]
+    return min(lo for lo, _ in bounds), max(hi for _, hi in bounds)
+
+
+def _phmm_forward_loop(
+    a: Tensor,
+    e_m: Tensor,
+    seqs: Tensor,
+    lengths: Tensor,
+    band_width: Optional[int] = None,
+) -> Tensor:
+    """動的計画表の各セルを一つずつ埋める forward アルゴリズム。参照実装として残している。
+
+    Parameters
+    ----------
+    a : Tensor
+        pHMM の遷移確率。(`set_size`, `model_length`+1, `combi of 'from' and 'to'`) の 3 次元構成。
+    e_m : Tensor
+        pHMM の出力確率。(`set_size`, `model_length`, `nucleotide_type`=4) の 3 次元構成。
+    seqs : Tensor
+        右詰めでパディングされた配列のセット。(`set_size`, `seq_length`) の 2 次元構成であり，パディング部分には `0` から `3` の任意の値が入っていてよい。
+    lengths : Tensor
+        各配列のパディングを除いた長さ。(`set_size`,) の 1 次元構成。
+        セル (k, l) は配列の先頭 l 塩基にのみ依存するため，各配列の終端確率はそれぞれの長さの位置から読み出す。
+    band_width : Optional[int], default = None
+        指定したとき，各配列の帯（`_phmm_band_mask` を参照）の外側のセルを計算せず，未計算のセルと同じく -100 とする。
+
+    Returns
+    -------
+    nll : Tensor
+        各配列の負の対数尤度。(`set_size`,) の 1 次元構成。
+    """
+    set_size, seq_length = seqs.shape
+    motif_len = e_m.shape[1]
+
+    # forward アルゴリズムを対数形式で行う。
+    # (match or insert or delete, motif_len, random_len) の三次元の動的計画表を用意する。
+    f_set = torch.ones(
+        size=(set_size, 3, motif_len + 1, seq_length + 1),
+        device=seqs.device,
+    ) * (-100)
+    f_set[:, State.M, 0, 0] = 0
+
+    if band_width is not None:
+        in_band = _phmm_band_mask(
+            torch.arange(motif_len + 1, device=seqs.device).unsqueeze(1),
+            torch.arange(seq_length + 1, device=seqs.device),
+            lengths,
+            motif_len,
+            band_width,
+        )
+
+    def banded(values: Tensor, k: int, l: int) -> Tensor:
+        if band_width is None:
+            return values
+        return values.masked_fill(~in_band[:, k, l], -100)
+
+    for l in range(seq_length + 1):  # locus starts from '1'
+        for k in range(
+            motif_len + 1
+        ):  # motif starts from '1' but model starts from '0'
+            # for state M
+            if l != 0 and k != 0:
+                f_set[:, State.M, k, l] = banded(
+                    e_m[:, k - 1].gather(1, seqs[:, l - 1 : l])[:, 0]
+                    + torch.logsumexp(
+                        torch.stack(
+                            (
+                                a[:, k - 1, Transition.M2M]
+                                + f_set[:, State.M, k - 1, l - 1],
+                                a[:, k - 1, Transition.I2M]
+                                + f_set[:, State.I, k - 1, l - 1],
+                                a[:, k - 1, Transition.D2M]
+                                + f_set[:, State.D, k - 1, l - 1],
+                            )
+                        ),
+                        dim=0,
+                    ),
+                    k,
+                    l,
+                )
+            # for state I
+            if l != 0:
+                f_set[:, State.I, k, l] = banded(
+                    np.log(1 / 4)
+                    + torch.logsumexp(
+                        torch.stack(
+                            (
+                                a[:, k, Transition.M2I] + f_set[:, State.M, k, l - 1],
+                                a[:, k, Transition.I2I] + f_set[:, State.I, k, l - 1],
+                            )
+                        ),
+                        dim=0,
+                    ),
+                    k,
+                    l,
+                )
+            # for state D
+            if k != 0:
+                f_set[:, State.D, k, l] = banded(
+                    torch.logsumexp(
+                        torch.stack(
+                            (
+                                a[:, k - 1, Transition.M2D]
+                                + f_set[:, State.M, k - 1, l],
+                                a[:, k - 1, Transition.D2D]
+                                + f_set[:, State.D, k - 1, l],
+                            )
+                        ),
+                        dim=0,
+                    ),
+                    k,
+                    l,
+                )
+
+    terminal = (
+        f_set[torch.arange(set_size), :, motif_len, lengths]
+        + a[:, motif_len, [Transition.M2M, Transition.I2M, Transition.D2M]]
+    )
+    return -torch.logsumexp(terminal, dim=1)
+
+
+def _phmm_forward_wavefront(
+    a: Tensor,
+    e_m: Tensor,
+    seqs: Tensor,
+    lengths: Tensor,
+    band_width: Optional[int] = None,
+) -> Tensor:
+    """動的計画表を反対角線（`k + l` が一定のセルの集合）ごとにまとめて計算する forward アルゴリズム。
+    セル (k, l) は反対角線 `k + l - 1` および `k + l - 2` 上のセルにのみ依存するため，同じ反対角線上のセルは一度のテンソル演算で計算できる。
+    Python のループ回数は `model_length` × `seq_length` から `model_length` + `seq_length` に減る。
+    計算の順序と値は `_phmm_forward_loop` と同一であり，損失値・勾配ともに一致する。
+    帯を指定した場合，各反対角線で計算するセルは帯の幅程度に限られ，計算量は O(`model_length` × `band_width`) になる。
+
+    Parameters
+    ----------
+    a : Tensor
+        pHMM の遷移確率。(`set_size`, `model_length`+1, `combi of 'from' and 'to'`) の 3 次元構成。
+    e_m : Tensor
+        pHMM の出力確率。(`set_size`, `model_length`, `nucleotide_type`=4) の 3 次元構成。
+    seqs : Tensor
+        右詰めでパディングされた配列のセット。(`set_size`, `seq_length`) の 2 次元構成であり，パディング部分には `0` から `3` の任意の値が入っていてよい。
+    lengths : Tensor
+        各配列のパディングを除いた長さ。(`set_size`,) の 1 次元構成。
+        セル (k, l) は配列の先頭 l 塩基にのみ依存するため，各配列の終端確率はそれぞれの長さの位置から読み出す。
+    band_width : Optional[int], default = None
+        指定したとき，各配列の帯（`_phmm_band_mask` を参照）の外側のセルを計算せず，未計算のセルと同じく -100 とする。
+
+    Returns
+    -------
+    nll : Tensor
+        各配列の負の対数尤度。(`set_size`,) の 1 次元構成。
+    """
+    set_size, seq_length = seqs.shape
+    motif_len = e_m.shape[1]
+
+    # 未計算のセルは `_phmm_forward_loop` と同じく -100 で埋める。
+    fill = a.new_full((set_size, motif_len + 1), -100)
+    # em[:, k - 1, l - 1] が状態 M_k で l 番目の塩基を出力する確率になる。
+    em = e_m.gather(2, seqs.unsqueeze(1).expand(-1, motif_len, -1))
+
+    def banded(values: Tensor, lo: int, d: int) -> Tensor:
+        # 帯の範囲は全配列の和集合なので，配列ごとに帯の外側のセルを -100 に戻す。
+        if band_width is None:
+            return values
+        ks = torch.arange(lo, lo + values.shape[1], device=seqs.device)
+        in_band = _phmm_band_mask(ks, d - ks, lengths, motif_len, band_width)
+        return values.masked_fill(~in_band, -100)
+
+    def place(values: Tensor, lo: int) -> Tensor:
+        # k = lo, ..., lo + n - 1 の値を長さ motif_len + 1 の反対角線に埋め込む。
+        hi = lo + values.shape[1]
+        if values.shape[1] == 0:
+            return fill
+        return torch.cat((fill[:, :lo], values, fill[:, hi:]), dim=1)
+
+    # diags[-1], diags[-2] はそれぞれ一つ前，二つ前の反対角線。(set_size, 3, motif_len + 1) の構成。
+    start = place(a.new_zeros((set_size, 1)), 0)
+    diags: List[Tensor] = [torch.stack((start, fill, fill), dim=1)]
+
+    for d in range(1, motif_len + seq_length + 1):
+        prev1 = diags[-1]
+        band_lo, band_hi = _phmm_band_range(d, motif_len, lengths, band_width)
+
+        # for state M: (k - 1, l - 1) は二つ前の反対角線上にある。
+        lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+        if lo <= hi:
+            prev2 = diags[-2]
+            ks = torch.arange(lo, hi + 1, device=seqs.device)
+            m_values = em[:, ks - 1, d - ks - 1] + torch.logsumexp(
+                torch.stack(
+                    (
+                        a[:, lo - 1 : hi, Transition.M2M]
+                        + prev2[:, State.M, lo - 1 : hi],
+                        a[:, lo - 1 : hi, Transition.I2M]
+                        + prev2[:, State.I, lo - 1 : hi],
+                        a[:, lo - 1 : hi, Transition.D2M]
+                        + prev2[:, State.D, lo - 1 : hi],
+                    )
+                ),
+                dim=0,
+            )
+            m_diag = place(banded(m_values, lo, d), lo)
+        else:
+            m_diag = fill
+
+        # for state I: (k, l - 1) は一つ前の反対角線上にある。
+        lo, hi = max(0, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+        if lo <= hi:
+            i_values = np.log(1 / 4) + torch.logsumexp(
+                torch.stack(
+                    (
+                        a[:, lo : hi + 1, Transition.M2I]
+                        + prev1[:, State.M, lo : hi + 1],
+                        a[:, lo : hi + 1, Transition.I2I]
+                        + prev1[:, State.I, lo : hi + 1],
+                    )
+                ),
+                dim=0,
+            )
+            i_diag = place(banded(i_values, lo, d), lo)
+        else:
+            i_diag = fill
+
+        # for state D: (k - 1, l) は一つ前の反対角線上にある。
+        lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d, band_hi)
+        if lo <= hi:
+            d_values = torch.logsumexp(
+                torch.stack(
+                    (
+                        a[:, lo - 1 : hi, Transition.M2D]
+                        + prev1[:, State.M, lo - 1 : hi],
+                        a[:, lo - 1 : hi, Transition.D2D]
+                        + prev1[:, State.D, lo - 1 : hi],
+                    )
+                ),
+                dim=0,
+            )
+            d_diag = place(banded(d_values, lo, d), lo)
+        else:
+            d_diag = fill
+
+        diags.append(torch.stack((m_diag, i_diag, d_diag), dim=1))
+
+    # 各配列の終端 (motif_len, length) は反対角線 motif_len + length 上にある。
+    last_column = torch.stack(
+        [diag[:, :, motif_len] for diag in diags[motif_len:]], dim=2
+    )
+    terminal = (
+        last_column[torch.arange(set_size), :, lengths]
+        + a[:, motif_len, [Transition.M2M, Transition.I2M, Transition.D2M]]
+    )
+    return -torch.logsumexp(terminal, dim=1)
+
+
+class _PHMMForwardBackward(torch.autograd.Function):
+    """forward アルゴリズムで負の対数尤度を，backward アルゴリズムで得た事後確率から勾配を計算する。
+    autograd は動的計画表のセルごとに計算グラフを記録するが，本関数は forward 時に動的計画表のみを保持するため，メモリ使用量と backward の計算時間が小さい。
+    値と勾配は `_phmm_forward_loop` と一致する（未計算のセルの -100 も定数として同様に扱う）。
+
+    動的計画表はセル (k, l) を `[k + l, k]` に置く反対角線優先の配置で保持し，各反対角線の計算を連続したスライスで行う。
+    表の範囲外（`l < 0` または `l > seq_length`）に当たる位置は -inf で埋める。
+    帯を指定した場合，帯の外側のセルは定数 -100 として扱い，その backward 変数は -inf とする。
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        a: Tensor,
+        e_m: Tensor,
+        seqs: Tensor,
+        lengths: Tensor,
+        band_width: Optional[int] = None,
+    ) -> Tensor:
+        set_size, seq_length = seqs.shape
+        motif_len = e_m.shape[1]
+        num_diags = motif_len + seq_length + 1
+        batch_index = torch.arange(set_size, device=seqs.device)
+
+        # 反対角線優先の配置における各位置の k, l
+        ks = torch.arange(motif_len + 1, device=seqs.device)
+        ls = torch.arange(num_diags, device=seqs.device).unsqueeze(1) - ks
+        inside = (ls >= 0) & (ls <= seq_length)
+        emits = inside & (ks >= 1) & (ls >= 1)
+        # excluded[:, d, k] は配列の長さを超える，または帯の外側にあるセル。これらは後続に含めない。
+        excluded = ls.unsqueeze(0) > lengths.view(-1, 1, 1)
+        if band_width is not None:
+            excluded |= ~_phmm_band_mask(ks, ls, lengths, motif_len, band_width)
+
+        with torch.no_grad():
+            # tokens[:, d, k] は l = d - k 番目の塩基，em_skew[:, d, k] はそれを M_k が出力する対数確率。
+            tokens = seqs[:, (ls - 1).clamp(0, max(seq_length - 1, 0))]
+            em_skew = (
+                e_m[:, (ks - 1).clamp(min=0)]
+                .unsqueeze(1)
+                .expand(-1, num_diags, -1, -1)
+                .gather(3, tokens.unsqueeze(3))
+                .squeeze(3)
+                .masked_fill(~emits, 0)
+            )
+
+            a_to_m = a[:, :, [Transition.M2M, Transition.I2M, Transition.D2M]]
+            a_to_i = a[:, :, [Transition.M2I, Transition.I2I]]
+            a_to_d = a[:, :, [Transition.M2D, Transition.D2D]]
+            a_to_m, a_to_i, a_to_d = (
+                t.transpose(1, 2).contiguous() for t in (a_to_m, a_to_i, a_to_d)
+            )
+
+            f_skew = a.new_full((set_size, 3, num_diags, motif_len + 1), -100)
+            f_skew.masked_fill_(~inside, -np.inf)
+            f_skew[:, State.M, 0, 0] = 0
+
+            def banded(values: Tensor, d: int, lo: int, hi: int) -> Tensor:
+                # 帯の範囲は全配列の和集合なので，配列ごとに帯の外側のセルを -100 に戻す。
+                if band_width is None:
+                    return values
+                ks_d = ks[lo : hi + 1]
+                in_band = _phmm_band_mask(
+                    ks_d, d - ks_d, lengths, motif_len, band_width
+                )
+                return values.masked_fill(~in_band, -100)
+
+            for d in range(1, num_diags):
+                band_lo, band_hi = _phmm_band_range(d, motif_len, lengths, band_width)
+                # for state M: (k - 1, l - 1) は二つ前の反対角線上にある。
+                lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+                if lo <= hi:
+                    f_skew[:, State.M, d, lo : hi + 1] = banded(
+                        em_skew[:, d, lo : hi + 1]
+                        + torch.logsumexp(
+                            a_to_m[:, :, lo - 1 : hi]
+                            + f_skew[:, :, d - 2, lo - 1 : hi],
+                            dim=1,
+                        ),
+                        d,
+                        lo,
+                        hi,
+                    )
+                # for state I: (k, l - 1) は一つ前の反対角線上にある。
+                lo, hi = max(0, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+                if lo <= hi:
+                    f_skew[:, State.I, d, lo : hi + 1] = banded(
+                        np.log(1 / 4)
+                        + torch.logsumexp(
+                            a_to_i[:, :, lo : hi + 1]
+                            + f_skew[:, 0:2, d - 1, lo : hi + 1],
+                            dim=1,
+                        ),
+                        d,
+                        lo,
+                        hi,
+                    )
+                # for state D: (k - 1, l) は一つ前の反対角線上にある。
+                lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d, band_hi)
+                if lo <= hi:
+                    f_skew[:, State.D, d, lo : hi + 1] = banded(
+                        torch.logsumexp(
+                            a_to_d[:, :, lo - 1 : hi]
+                            + f_skew[:, 0::2, d - 1, lo - 1 : hi],
+                            dim=1,
+                        ),
+                        d,
+                        lo,
+                        hi,
+                    )
+
+            terminal = (
+                f_skew[batch_index, :, motif_len + lengths, motif_len]
+                + a[:, motif_len, [Transition.M2M, Transition.I2M, Transition.D2M]]
+            )
+            log_likelihood = torch.logsumexp(terminal, dim=1)
+
+        ctx.band_width = band_width
+        ctx.save_for_backward(
+            a, e_m, lengths, tokens, em_skew, f_skew, log_likelihood, excluded, emits
+        )
+        return -log_likelihood
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor):
+        a, e_m, lengths, tokens, em_skew, f_skew, log_likelihood, excluded, emits = (
+            ctx.saved_tensors
+        )
+        set_size, _, num_diags, _ = f_skew.shape
+        motif_len = e_m.shape[1]
+        seq_length = num_diags - motif_len - 1
+        batch_index = torch.arange(set_size, device=a.device)
+        log_quarter = np.log(1 / 4)
+        end_transitions = [Transition.M2M, Transition.I2M, Transition.D2M]
+
+        # b_skew[:, s, d, k] はセル (s, k, l = d - k) から終了状態までの対数確率の和（backward 変数）。
+        # 番兵として反対角線を二本，k を一つ余分に -inf で確保しておく。
+        b_skew = a.new_full((set_size, 3, num_diags + 2, motif_len + 2), -np.inf)
+        em_pad = F.pad(em_skew, (0, 1, 0, 2))
+        # 終端セルから終了状態への遷移
+        b_skew[batch_index, :, motif_len + lengths, motif_len] = a[
+            :, motif_len, end_transitions
+        ]
+
+        # a_succ[:, s, t, k] は状態 s_k から後続の状態 t への遷移の対数確率。存在しない遷移 (I -> D, D -> I) は -inf とする。
+        a_succ = a.new_full((set_size, 3, 3, motif_len + 1), -np.inf)
+        for source, target, transition in (
+            (State.M, State.M, Transition.M2M),
+            (State.M, State.I, Transition.M2I),
+            (State.M, State.D, Transition.M2D),
+            (State.I, State.M, Transition.I2M),
+            (State.I, State.I, Transition.I2I),
+            (State.D, State.M, Transition.D2M),
+            (State.D, State.D, Transition.D2D),
+        ):
+            a_succ[:, source, target] = a[:, :, transition]
+
+        for d in range(num_diags - 1, -1, -1):
+            band_lo, band_hi = _phmm_band_range(d, motif_len, lengths, ctx.band_width)
+            lo, hi = max(0, d - seq_length, band_lo), min(motif_len, d, band_hi)
+            if lo > hi:
+                continue
+            # 後続セル M(k + 1, l + 1), I(k, l + 1), D(k + 1, l) の backward 変数と出力確率
+            successors = torch.stack(
+                (
+                    em_pad[:, d + 2, lo + 1 : hi + 2]
+                    + b_skew[:, State.M, d + 2, lo + 1 : hi + 2],
+                    log_quarter + b_skew[:, State.I, d + 1, lo : hi + 1],
+                    b_skew[:, State.D, d + 1, lo + 1 : hi + 2],
+                ),
+                dim=1,
+            )
+            values = torch.logaddexp(
+                torch.logsumexp(
+                    a_succ[:, :, :, lo : hi + 1] + successors.unsqueeze(1), dim=2
+                ),
+                b_skew[:, :, d, lo : hi + 1],
+            )
+            b_skew[:, :, d, lo : hi + 1] = values.masked_fill(
+                excluded[:, d, lo : hi + 1].unsqueeze(1), -np.inf
+            )
+
+        # 各遷移・各出力の期待使用回数（事後確率の和）を求める。
+        z = log_likelihood.view(-1, 1, 1, 1)
+        b_skew = b_skew[:, :, :num_diags, : motif_len + 1]
+        grad_a = torch.zeros_like(a)
+
+        def expected_counts(source: Tensor, transitions: List[int], target: Tensor):
+            # 遷移元の forward 変数と遷移先の backward 変数から，遷移ごとの事後確率を位置 l について足し合わせる。
+            # 一時テンソルを増やさないよう in-place で計算する。
+            counts = source + a[:, : source.shape[3], transitions].transpose(
+                1, 2
+            ).unsqueeze(2)
+            counts.add_(target.unsqueeze(1)).sub_(z).exp_()
+            return counts.sum(dim=2).transpose(1, 2)
+
+        # 遷移元 (k, l) は [d, k]，遷移先 M(k + 1, l + 1) は [d + 2, k + 1] にある。
+        to_m = [Transition.M2M, Transition.I2M, Transition.D2M]
+        grad_a[:, :motif_len, to_m] = expected_counts(
+            f_skew[:, :, :-2, :motif_len],
+            to_m,
+            em_skew[:, 2:, 1:] + b_skew[:, State.M, 2:, 1:],
+        )
+        # 遷移先 I(k, l + 1) は [d + 1, k] にある。
+        to_i = [Transition.M2I, Transition.I2I]
+        grad_a[:, :, to_i] = expected_counts(
+            f_skew[:, 0:2, :-1, :],
+            to_i,
+            log_quarter + b_skew[:, State.I, 1:, :],
+        )
+        # 遷移先 D(k + 1, l) は [d + 1, k + 1] にある。
+        to_d = [Transition.M2D, Transition.D2D]
+        grad_a[:, :motif_len, to_d] = expected_counts(
+            f_skew[:, 0::2, :-1, :motif_len],
+            to_d,
+            b_skew[:, State.D, 1:, 1:],
+        )
+        grad_a[:, motif_len, end_transitions] += torch.exp(
+            f_skew[batch_index, :, motif_len + lengths, motif_len]
+            + a[:, motif_len, end_transitions]
+            - log_likelihood.unsqueeze(1)
+        )
+
+        posterior_m = torch.exp(
+            f_skew[:, State.M] + b_skew[:, State.M] - z[:, 0]
+        ).masked_fill(~emits, 0)
+        # M_k (k >= 1) で塩基 tokens を出力した回数を e_m[:, k - 1, tokens] に加算する。
+        ks = torch.arange(motif_len + 1, device=a.device)
+        flat_index = (ks - 1).clamp(min=0) * 4 + tokens
+        grad_e_m = (
+            e_m.new_zeros((set_size, motif_len * 4))
+            .scatter_add_(
+                1, flat_index.view(set_size, -1), posterior_m.view(set_size, -1)
+            )
+            .view_as(e_m)
+        )
+
+        # 出力は負の対数尤度なので符号を反転する。
+        scale = -grad_output.view(-1, 1, 1)
+        return grad_a * scale, grad_e_m * scale, None, None, None
+
+
+def _phmm_forward_backward(
+    a: Tensor,
+    e_m: Tensor,
+    seqs: Tensor,
+    lengths: Tensor,
+    band_width: Optional[int] = None,
+) -> Tensor:
+    """`_PHMMForwardBackward` を用いる forward アルゴリズム。引数と返り値は `_phmm_forward_loop` を参照。"""
+    return _PHMMForwardBackward.apply(a, e_m, seqs, lengths, band_width)
+
+
+def _phmm_forward_inference(
+    a: Tensor,
+    e_m: Tensor,
+    seqs: Tensor,
+    lengths: Tensor,
+    band_width: Optional[int] = None,
+) -> Tensor:
+    """評価専用の forward アルゴリズム。勾配は計算できない。
+    float32 の連続した numpy 配列上で，反対角線を三本だけ保持するバッファを使い回して計算する。
+    バッチの次元を最後に置くことで，各反対角線の計算と正規化がいずれも連続したメモリ上の要素ごとの演算になる。
+    対数確率の logsumexp の代わりに確率そのものの積和で計算し，アンダーフローを防ぐため各反対角線を配列ごとの最大値で正規化してその対数を別に保持する。
+    未計算のセル（動的計画表の端のセルと帯の外側のセル）は他の実装と同じく対数確率 -100，すなわち確率 `exp(-100)` の定数とする。
+    長い配列のように真の経路の確率が `exp(-100)` を下回る場合もこの定数を経由する経路が尤度を決めるため，値は他の実装と一致する。
+    引数と返り値は `_phmm_forward_loop` を参照。
+    """
+    set_size, seq_length = seqs.shape
+    motif_len = e_m.shape[1]
+    num_diags = motif_len + seq_length + 1
+
+    with torch.no_grad():
+        # (motif_len + 1, combi of 'from' and 'to', set_size) などバッチを最後の次元に置く。
+        a_np = np.exp(a.detach().cpu().numpy().astype(np.float32)).transpose(1, 2, 0)
+        e_m_np = np.exp(e_m.detach().cpu().numpy().astype(np.float32))
+    seqs_np = seqs.cpu().numpy()
+    lengths_np = lengths.cpu().numpy()
+
+    # 遷移確率を遷移先ごとに (遷移元の状態, motif_len + 1, set_size) の連続した配列にまとめる。
+    def transitions(ids: List[int]) -> np.ndarray:
+        return np.ascontiguousarray(a_np[:, ids].transpose(1, 0, 2))
+
+    a_to_m = transitions([Transition.M2M, Transition.I2M, Transition.D2M])
+    a_to_i = transitions([Transition.M2I, Transition.I2I]) * np.float32(1 / 4)
+    a_to_d = transitions([Transition.M2D, Transition.D2D])
+    a_end = a_to_m[:, motif_len]
+
+    # em_skew[d, k] は M_k が l = d - k 番目の塩基を出力する確率（反対角線優先の配置）。(num_diags, motif_len + 1, set_size) の構成。
+    ks = np.arange(motif_len + 1)
+    ls = np.arange(num_diags)[:, None] - ks
+    emits = (ks >= 1) & (ls >= 1) & (ls <= seq_length)
+    tokens = seqs_np[:, np.clip(ls - 1, 0, max(seq_length - 1, 0))]
+    em_skew = e_m_np[
+        np.arange(set_size)[:, None, None], np.clip(ks - 1, 0, None), tokens
+    ]
+    em_skew = np.ascontiguousarray((em_skew * emits).transpose(1, 2, 0))
+    if band_width is not None:
+        # (num_diags, motif_len + 1, set_size) の構成の帯のマスク
+        in_band = np.ascontiguousarray(
+            _phmm_band_mask(
+                torch.from_numpy(ks),
+                torch.from_numpy(ls),
+                lengths.cpu(),
+                motif_len,
+                band_width,
+            )
+            .numpy()
+            .transpose(1, 2, 0)
+        )
+
+    # prev2, prev1, current はそれぞれ二つ前，一つ前，現在の反対角線。(state, motif_len + 1, set_size) の構成。
+    prev2 = np.zeros((3, motif_len + 1, set_size), dtype=np.float32)
+    prev1 = np.zeros_like(prev2)
+    current = np.zeros_like(prev2)
+    prev1[State.M, 0] = 1
+    # (0, 0) の I と D は未計算のセル
+    prev1[State.I, 0] = prev1[State.D, 0] = np.exp(np.float32(-100))
+    # 各反対角線の正規化定数の対数
+    log_scale2 = np.zeros(set_size, dtype=np.float32)
+    log_scale1 = np.zeros(set_size, dtype=np.float32)
+    log_likelihood = np.full(set_size, -np.inf, dtype=np.float32)
+
+    for d in range(1, num_diags):
+        current.fill(0)
+        band_lo, band_hi = _phmm_band_range(d, motif_len, lengths, band_width)
+        # 二つ前と一つ前の反対角線を大きい方の尺度に揃える係数。いずれも 1 以下でオーバーフローしない。
+        log_scale_ref = np.maximum(log_scale1, log_scale2)
+        ratio2 = np.exp(log_scale2 - log_scale_ref)
+        ratio1 = np.exp(log_scale1 - log_scale_ref)
+
+        # for state M: (k - 1, l - 1) は二つ前の反対角線上にある。
+        lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+        if lo <= hi:
+            src = prev2[:, lo - 1 : hi]
+            trans = a_to_m[:, lo - 1 : hi]
+            values = current[State.M, lo : hi + 1]
+            np.multiply(trans[0], src[0], out=values)
+            values += trans[1] * src[1]
+            values += trans[2] * src[2]
+            values *= ratio2
+            values *= em_skew[d, lo : hi + 1]
+        # for state I: (k, l - 1) は一つ前の反対角線上にある。
+        lo, hi = max(0, d - seq_length, band_lo), min(motif_len, d - 1, band_hi)
+        if lo <= hi:
+            src = prev1[:, lo : hi + 1]
+            trans = a_to_i[:, lo : hi + 1]
+            values = current[State.I, lo : hi + 1]
+            np.multiply(trans[0], src[State.M], out=values)
+            values += trans[1] * src[State.I]
+            values *= ratio1
+        # for state D: (k - 1, l) は一つ前の反対角線上にある。
+        lo, hi = max(1, d - seq_length, band_lo), min(motif_len, d, band_hi)
+        if lo <= hi:
+            src = prev1[:, lo - 1 : hi]
+            trans = a_to_d[:, lo - 1 : hi]
+            values = current[State.D, lo : hi + 1]
+            np.multiply(trans[0], src[State.M], out=values)
+            values += trans[1] * src[State.D]
+            values *= ratio1
+
+        # 反対角線上で計算するセル (k, d - k) の k の範囲
+        cell_lo, cell_hi = max(0, d - seq_length), min(motif_len, d)
+        # 端の未計算のセル M(d, 0)，I(d, 0)，M(0, d)，D(0, d) は全配列にある。
+        has_fill = np.full(set_size, d <= motif_len or d <= seq_length)
+        if band_width is not None:
+            lo, hi = max(0, band_lo), min(motif_len, band_hi)
+            current[:, lo : hi + 1] *= in_band[d, lo : hi + 1]
+            out_of_band = ~in_band[d, cell_lo : cell_hi + 1]
+            has_fill |= out_of_band.any(axis=0)
+
+        # 配列ごとの最大値で正規化する。未計算のセルの定数も最大値の候補とする。
+        scale = current.reshape(-1, set_size).max(axis=0)
+        with np.errstate(divide="ignore"):
+            log_scale = log_scale_ref + np.log(scale)
+        log_scale = np.where(
+            has_fill, np.maximum(log_scale, np.float32(-100)), log_scale
+        )
+        log_scale = np.where(np.isneginf(log_scale), log_scale_ref, log_scale)
+        # 係数は exp(100) 程度になり得るので float64 で計算する。積は 1 以下に収まる。
+        np.multiply(
+            current,
+            np.exp(log_scale_ref.astype(np.float64) - log_scale),
+            out=current,
+            casting="unsafe",
+        )
+
+        # 未計算のセルを正規化後の尺度での exp(-100) で埋める。
+        # 定数を持たない配列の値は使わないが，オーバーフローしないよう 1 で抑える。
+        fill = np.exp(np.minimum(np.float32(-100) - log_scale, 0))
+        if d <= motif_len:
+            current[State.M, d] = fill
+            current[State.I, d] = fill
+        if d <= seq_length:
+            current[State.M, 0] = fill
+            current[State.D, 0] = fill
+        if band_width is not None:
+            for state, lo, hi in (
+                (State.M, max(1, cell_lo), min(cell_hi, d - 1)),
+                (State.I, cell_lo, min(cell_hi, d - 1)),
+                (State.D, max(1, cell_lo), cell_hi),
+            ):
+                if lo <= hi:
+                    np.copyto(
+                        current[state, lo : hi + 1],
+                        np.broadcast_to(fill, (hi - lo + 1, set_size)),
+                        where=out_of_band[lo - cell_lo : hi - cell_lo + 1],
+                    )
+
+        # 反対角線 motif_len + length 上に終端セル (motif_len, length) を持つ配列の尤度を読み出す。
+        ends = np.nonzero(lengths_np + motif_len == d)[0]
+        if len(ends) > 0:
+            terminal = (current[:, motif_len, ends] * a_end[:, ends]).sum(axis=0)
+            with np.errstate(divide="ignore"):
+                log_likelihood[ends] = np.log(terminal) + log_scale[ends]
+
+        prev2, prev1, current = prev1, current, prev2
+        log_scale2, log_scale1 = log_scale1, log_scale
+
+    return -torch.from_numpy(log_likelihood).to(a.device)
+
+
+_PHMM_FORWARD_ENGINES = {
+    "loop": _phmm_forward_loop,
+    "wavefront": _phmm_forward_wavefront,
+    "forward_backward": _phmm_forward_backward,
+    "inference": _phmm_forward_inference,
+}
+
+
 def profile_hmm_loss(
     transition_probs: Tensor,
     emission_probs: Tensor,
     batch_input: Tensor,
+    engine: str = "wavefront",
+    padded: bool = True,
+    band_width: Optional[int] = None,
 ) -> Tensor:
     """pHMM の遷移確率と出力確率をとり，`batch_input` で示された元の配列が生成される確率を計算する。
 
@@ -135,6 +916,17 @@ def profile_hmm_loss(
         pHMM の出力確率。(`batch`, `model_length`, `nucleotide_type`=4) の 3 次元構成になっている必要があり，全確率は対数で表現されていることとする。
     batch_input : Tensor
         VAE モデルに入力したバッチの値。(`batch`, `string_length`) の 2 次元構成になっている必要があり，各塩基は `NucleotideID` に示された値で表現されていなければならない。パディングも許可される。
+    engine : str, default = "wavefront"
+        forward アルゴリズムの実装。`"loop"` はセルを一つずつ計算する参照実装，`"wavefront"` は反対角線ごとにまとめて計算する実装，
+        `"forward_backward"` は backward アルゴリズムによる事後確率から勾配を直接計算する実装で，計算グラフを保持しないため学習時のメモリ使用量が最も小さい。いずれの結果も一致する。
+        `"inference"` は勾配を計算しない評価専用の実装（`_phmm_forward_inference`）で，テスト損失の計算や尤度によるスコアリングに用いる。`torch.no_grad()` の外で勾配を要するテンソルを与えると `ValueError` となる。
+    padded : bool, default = True
+        `True` のとき，長さの異なる配列を含むバッチ全体を最長の配列に合わせて一度の動的計画法で計算し，各配列の終端確率をそれぞれの長さの位置から読み出す。
+        `False` のとき，配列長ごとにバッチを分割して別々に計算する。いずれの場合も結果は一致する。
+    band_width : Optional[int], default = None
+        指定したとき，動的計画表のうち (0, 0) と終端セル (`model_length`, `length`) を結ぶ対角線から l 方向に `band_width` 以内のセルのみを計算する。
+        計算量は O(`model_length` × `string_length`) から O(`model_length` × `band_width`) になる。帯の外側を通る経路は除かれるため，返り値は帯を用いない場合以上の値になる。
+        除かれる確率質量の割合は `profile_hmm_band_cutoff` で確認できる。
 
     Returns
     -------
@@ -142,11 +934,38 @@ def profile_hmm_loss(
         遷移確率，出力確率が決まっていた際に `batch_input` が生成された確率。
         (`batch`,) の 1 次元構成になっている。
     """
+    if engine not in _PHMM_FORWARD_ENGINES:
+        raise ValueError(
+            f"engine should be one of {list(_PHMM_FORWARD_ENGINES)}, given {engine}"
+        )
+    if (
+        engine == "inference"
+        and torch.is_grad_enabled()
+        and (transition_probs.requires_grad or emission_probs.requires_grad)
+    ):
+        raise ValueError(
+            "engine 'inference' does not support autograd. Use it under torch.no_grad()."
+        )
+    if band_width is not None and band_width < 0:
+        raise ValueError(f"band_width should be non-negative, given {band_width}")
+    forward_fn = _PHMM_FORWARD_ENGINES[engine]
+
     batch_size = batch_input.shape[0]
-    motif_len = emission_probs.shape[1]
 
     # 各配列の長さ取得
     lengths = torch.sum(batch_input != NucleotideID.PAD, dim=1)
+
+    if padded:
+        # パディングを右端に寄せ（安定ソートなので塩基の順序は保たれる），最長の配列に合わせて切り詰める。
+        order = torch.argsort(
+            batch_input.eq(NucleotideID.PAD).int(), dim=1, stable=True
+        )
+        input_seqs = batch_input.gather(1, order)[:, : int(lengths.max().item())]
+        input_seqs = input_seqs.masked_fill(input_seqs.eq(NucleotideID.PAD), 0)
+        return forward_fn(
+            transition_probs, emission_probs, input_seqs, lengths, band_width
+        )
+
     indeces = torch.tensor(range(batch_size), device=batch_input.device)
     unique_lengths = set(lengths.tolist())
 
@@ -164,67 +983,13 @@ def profile_hmm_loss(
             input_seq_set.ne(NucleotideID.PAD)
         ).reshape(set_size, seq_length)
 
-        # forward アルゴリズムを対数形式で行う。
-        # (match or insert or delete, motif_len, random_len) の三次元の動的計画表を用意する。
-        f_set = torch.ones(
-            size=(set_size, 3, motif_len + 1, seq_length + 1),
-            device=input_seq_set.device,
-        ) * (-100)
-        f_set[:, State.M, 0, 0] = 0
-
-        for l in range(seq_length + 1):  # locus starts from '1'
-            for k in range(
-                motif_len + 1
-            ):  # motif starts from '1' but model starts from '0'
-                # for state M
-                if l != 0 and k != 0:
-                    f_set[:, State.M, k, l] = e_m_set[:, k - 1].gather(
-                        1, input_seq_set[:, l - 1 : l]
-                    )[:, 0] + torch.logsumexp(
-                        torch.stack(
-                            (
-                                a_set[:, k - 1, Transition.M2M]
-                                + f_set[:, State.M, k - 1, l - 1],
-                                a_set[:, k - 1, Transition.I2M]
-                                + f_set[:, State.I, k - 1, l - 1],
-                                a_set[:, k - 1, Transition.D2M]
-                                + f_set[:, State.D, k - 1, l - 1],
-                            )
-                        ),
-                        dim=0,
-                    )
-                # for state I
-                if l != 0:
-                    f_set[:, State.I, k, l] = np.log(1 / 4) + torch.logsumexp(
-                        torch.stack(
-                            (
-                                a_set[:, k, Transition.M2I]
-                                + f_set[:, State.M, k, l - 1],
-                                a_set[:, k, Transition.I2I]
-                                + f_set[:, State.I, k, l - 1],
-                            )
-                        ),
-                        dim=0,
-                    )
-                # for state D
-                if k != 0:
-                    f_set[:, State.D, k, l] = torch.logsumexp(
-                        torch.stack(
-                            (
-                                a_set[:, k - 1, Transition.M2D]
-                                + f_set[:, State.M, k - 1, l],
-                                a_set[:, k - 1, Transition.D2D]
-                                + f_set[:, State.D, k - 1, l],
-                            )
-                        ),
-                        dim=0,
-                    )
-
-        f_set[:, State.M, motif_len, seq_length] += a_set[:, motif_len, Transition.M2M]
-        f_set[:, State.I, motif_len, seq_length] += a_set[:, motif_len, Transition.I2M]
-        f_set[:, State.D, motif_len, seq_length] += a_set[:, motif_len, Transition.D2M]
-
-        val_set = -torch.logsumexp(f_set[:, :, motif_len, seq_length], dim=1)
+        val_set = forward_fn(
+            a_set,
+            e_m_set,
+            input_seq_set,
+            torch.masked_select(lengths, mask),
+            band_width,
+        )
 
         result_list += list(
             zip(
@@ -238,11 +1003,53 @@ def profile_hmm_loss(
         key=lambda x: x[0],
     )
 
-    result_tensor = torch.stack([value_tuple[1] for value_tuple in result_sorted])
+    result_tensor = torch.cat([value_tuple[1] for value_tuple in result_sorted])
 
     return result_tensor
 
 
+def profile_hmm_band_cutoff(
+    transition_probs: Tensor,
+    emission_probs: Tensor,
+    batch_input: Tensor,
+    band_width: int,
+    engine: str = "inference",
+) -> Tensor:
+    """`profile_hmm_loss` に `band_width` を指定した際に，帯の外側を通る経路として除かれる確率質量の割合を計算する。
+    帯を用いない場合の尤度 P と帯の内側のみの尤度 P_band から `1 - P_band / P` を求める。値が十分小さくなる `band_width` であれば安全に使用できる。
+
+    Parameters
+    ----------
+    transition_probs : Tensor
+        pHMM の遷移確率。`profile_hmm_loss` を参照。
+    emission_probs : Tensor
+        pHMM の出力確率。`profile_hmm_loss` を参照。
+    batch_input : Tensor
+        入力配列のバッチ。`profile_hmm_loss` を参照。
+    band_width : int
+        調べる帯の幅。
+    engine : str, default = "inference"
+        forward アルゴリズムの実装。`profile_hmm_loss` の `engine` を参照。
+
+    Returns
+    -------
+    cutoff : Tensor
+        各配列について除かれる確率質量の割合。(`batch`,) の 1 次元構成で，値は [0, 1] の範囲にある。
+    """
+    with torch.no_grad():
+        full_nll = profile_hmm_loss(
+            transition_probs, emission_probs, batch_input, engine=engine
+        )
+        band_nll = profile_hmm_loss(
+            transition_probs,
+            emission_probs,
+            batch_input,
+            engine=engine,
+            band_width=band_width,
+        )
+    return (1 - torch.exp(full_nll - band_nll)).clamp(0, 1)
+
+
 def force_matching_loss(transition_probs: Tensor, match_cost: float = 5.0) -> Tensor:
     """遷移確率において，Match to Match の確率が小さければ小さい程大きな損失値を与える損失関数を定義する。
     これを初期 epoch における損失関数に付け加えることにより，モチーフの学習がうまくいく。論文中では State_transition_loss として定義されている。
@@ -448,40 +1255,252 @@ class CNN_PHMM_VAE(VAE):
         self.loss_fn = profile_hmm_vae_loss
 
 
-def embed_sequences(sequences: List[str], model: VAE) -> List[np.ndarray]:
+class _FusedBottleneck(nn.Module):
+    """推論用の `Bottleneck`。畳み込みの直後の BatchNorm をその畳み込みの重みに畳み込む。
+    `bn1` は活性化関数を挟んで畳み込みの前にあるため畳み込めず，そのまま残す。
+    """
+
+    def __init__(self, bottleneck: Bottleneck):
+        super(_FusedBottleneck, self).__init__()
+        self.bn1 = copy.deepcopy(bottleneck.bn1)
+        self.conv1 = fuse_conv_bn_eval(bottleneck.conv1, bottleneck.bn2)
+        self.conv2 = fuse_conv_bn_eval(bottleneck.conv2, bottleneck.bn3)
+        self.conv3 = copy.deepcopy(bottleneck.conv3)
+
+    def forward(self, input):
+        x = self.conv1(F.leaky_relu(self.bn1(input)))
+        x = self.conv2(F.leaky_relu(x))
+        x = self.conv3(F.leaky_relu(x))
+        return F.leaky_relu(x + input)
+
+
+class _FusedEncoderCNN(nn.Module):
+    """推論用の `EncoderCNN`。埋め込みの直後の活性化関数を埋め込み表に適用しておく。"""
+
+    def __init__(self, encoder: EncoderCNN):
+        super(_FusedEncoderCNN, self).__init__()
+        self.embed = nn.Embedding.from_pretrained(
+            F.leaky_relu(encoder.embed.weight.detach()),
+            padding_idx=NucleotideID.PAD,
+        )
+        self.resnet = nn.Sequential(
+            *[_FusedBottleneck(bottleneck) for bottleneck in encoder.resnet]
+        )
+
+    def forward(self, seqences):
+        x = self.embed(seqences).transpose(1, 2)
+        value, indices = self.resnet(x).max(dim=2)
+        return value
+
+
+def _fuse_decoder(decoder: DecoderPHMM) -> DecoderPHMM:
+    """全結合層の直後の BatchNorm をその全結合層の重みに畳み込んだ `DecoderPHMM` の複製を返す。"""
+    fused = copy.deepcopy(decoder)
+    for sequential in [fused.fc1, fused.fc2]:
+        for i, layer in enumerate(sequential):
+            if isinstance(layer, nn.BatchNorm1d):
+                sequential[i - 1] = fuse_linear_bn_eval(sequential[i - 1], layer)
+                sequential[i] = nn.Identity()
+    return fused
+
+
+class _PointwiseConv1d(nn.Module):
+    """`kernel_size` = 1 の `nn.Conv1d` と同じ計算をチャネルの次元に対する `nn.Linear` で行う。
+    動的量子化は `nn.Linear` のみを対象とするため，量子化の前に置き換える。
+    """
+
+    def __init__(self, conv: nn.Conv1d):
+        super(_PointwiseConv1d, self).__init__()
+        assert conv.kernel_size == (1,)
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[:, :, 0])
+            self.linear.bias.copy_(conv.bias)
+
+    def forward(self, input):
+        return self.linear(input.transpose(1, 2)).transpose(1, 2)
+
+
+def export_inference_model(model: CNN_PHMM_VAE, quantize: bool = False) -> CNN_PHMM_VAE:
+    """推論専用に最適化したモデルを返す。`model` 自体は変更しない。
+
+    エンコーダとデコーダの BatchNorm を直前の畳み込み層・全結合層に畳み込み，TorchScript に変換して凍結したものに置き換える。
+    返り値は `CNN_PHMM_VAE` と同じく `encoder`，`h2mu`，`decoder` を持つため，`embed_sequences` や `get_most_probable_seq` などにそのまま渡せる。
+    学習には使えない。変換に失敗した場合は警告を出し，`model` をそのまま返す。
+
+    Parameters
+    ----------
+    model : CNN_PHMM_VAE
+        変換する VAE モデル。
+    quantize : bool, default = False
+        `True` のとき，エンコーダの 1x1 畳み込み層とデコーダの全結合層の重みを int8 に動的量子化する。
+        CPU での推論は速くなるが埋め込み値と pHMM のパラメータに誤差が生じる。`h2mu` は出力への影響が大きいため量子化しない。
+
+    Returns
+    -------
+    exported_model : CNN_PHMM_VAE
+        エンコーダとデコーダを TorchScript に置き換えた評価モードのモデル。
+    """
+    exported = copy.deepcopy(model).eval()
+    try:
+        with torch.no_grad(), warnings.catch_warnings():
+            # `torch.jit.script` や動的量子化は新しい PyTorch では非推奨の警告を出すため，変換中の警告は表示しない。
+            warnings.simplefilter("ignore")
+            encoder: nn.Module = _FusedEncoderCNN(exported.encoder)
+            decoder: nn.Module = _fuse_decoder(exported.decoder)
+            if quantize:
+                for bottleneck in encoder.resnet:
+                    bottleneck.conv1 = _PointwiseConv1d(bottleneck.conv1)
+                    bottleneck.conv3 = _PointwiseConv1d(bottleneck.conv3)
+                encoder = torch.ao.quantization.quantize_dynamic(
+                    encoder, {nn.Linear}, dtype=torch.qint8
+                )
+                decoder = torch.ao.quantization.quantize_dynamic(
+                    decoder, {nn.Linear}, dtype=torch.qint8
+                )
+            encoder = torch.jit.freeze(torch.jit.script(encoder.eval()))
+            decoder = torch.jit.freeze(torch.jit.script(decoder.eval()))
+    except Exception as e:
+        warnings.warn(f"TorchScript export failed, using the eager model: {e}")
+        return model
+
+    exported.encoder = encoder
+    exported.decoder = decoder
+    return exported
+
+
+def embed_sequences(
+    sequences: List[str], model: VAE, max_batch_size: int = 1024
+) -> np.ndarray:
     """対応する埋め込み空間の値を返却する。
 
+    配列を長さで安定ソートし，同じ長さの配列を最大 `max_batch_size` 本ずつまとめてエンコーダに入力する。
+    パディングは CNN エンコーダの出力を変えるため，長さの異なる配列は同じバッチに含めない。
+    結果は `sequences` の順序で事前に確保した配列に書き込む。
+
     Parameters
     ----------
     sequences : List[str]
         各残基が `A, U, C, G` で表現された塩基配列のリスト。
     model : VAE
         埋め込みに使用する VAE モデル。
+    max_batch_size : int, default = 1024
+        一度にエンコーダに入力する配列の最大数。
 
     Returns
     -------
-    coords : List[np.ndarray]
-        `sequences` に対応する埋め込み値
+    coords : np.ndarray
+        `sequences` に対応する埋め込み値。(`len(sequences)`, `embed_size`) の float32 の配列。
     """
     assert type(sequences) == list
+    assert max_batch_size > 0
 
     # https://discuss.pytorch.org/t/how-to-check-if-model-is-on-cuda/180
     model_device = next(model.parameters()).device
+    coords = np.empty((len(sequences), model.embed_size), dtype=np.float32)
+
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    order = np.argsort(lengths, kind="stable")
+    # 長さが変わる位置で分割する。
+    groups = np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1)
+
     with torch.no_grad():
         model.eval()
-        coords: List[np.ndarray] = list()
-
-        for _, group_it in groupby(sequences, len):
-            encoded_seqs: List[List[int]] = list(map(ID_encode, group_it))
-            recon, mu, logvar = model(
-                torch.Tensor(np.array(encoded_seqs), device=model_device).long()
-            )
-            mu_list = list(mu.to("cpu").detach().numpy().copy())
-            coords += mu_list
+        for group in groups:
+            for start in range(0, len(group), max_batch_size):
+                indices = group[start : start + max_batch_size]
+                encoded_seqs = torch.tensor(
+                    [ID_encode(sequences[index]) for index in indices],
+                    dtype=torch.long,
+                    device=model_device,
+                )
+                # 埋め込み値には平均ベクトルのみを使うため，デコーダは計算しない。
+                mu = model.h2mu(model.encoder(encoded_seqs))
+                coords[indices] = mu.cpu().numpy()
 
     return coords
 
 
+def _phmm_greedy_decode(
+    a_probs: np.ndarray, e_probs: np.ndarray
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """各 pHMM について，各状態で最も確率の高い遷移と出力を選んで配列を生成する。`get_most_probable_seq` の本体。
+
+    Parameters
+    ----------
+    a_probs : np.ndarray
+        pHMM の遷移確率。(`batch`, `model_length`+1, `combi of 'from' and 'to'`) の構成で，対数ではない。
+    e_probs : np.ndarray
+        pHMM の出力確率。(`batch`, `model_length`, `nucleotide_type`=4) の構成で，対数ではない。
+
+    Returns
+    -------
+    seqs_path_tuple : Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]
+        生成された配列，各歩の index と状態（いずれも (`batch`, 2 * (`model_length`+1) + 1) の構成），および各 pHMM の歩数。
+        配列の表記は `get_most_probable_seq` を参照。
+    """
+    num_coords, model_length = a_probs.shape[0], a_probs.shape[1] - 1
+
+    # 貪欲法の遷移先は遷移元の状態と index のみで決まるため，全座標・全 index について先に求めておく。
+    # next_states[state, n, index] は状態 (index, state) の次の状態。I, D からは存在しない遷移の確率を 0 として argmax をとる。
+    zeros = np.zeros(a_probs.shape[:2], dtype=a_probs.dtype)
+    next_states = np.stack(
+        [
+            np.stack(
+                [
+                    a_probs[:, :, Transition.M2M],
+                    a_probs[:, :, Transition.M2I],
+                    a_probs[:, :, Transition.M2D],
+                ]
+            ).argmax(axis=0),
+            np.stack([a_probs[:, :, Transition.I2M], zeros, zeros]).argmax(axis=0),
+            np.stack(
+                [a_probs[:, :, Transition.D2M], zeros, a_probs[:, :, Transition.D2D]]
+            ).argmax(axis=0),
+        ]
+    )
+    nucleotides = np.frombuffer(b"ATGC", dtype=np.uint8)[e_probs.argmax(axis=2)]
+
+    # 全座標の状態を一歩ずつ同時に進める。I の後は必ず index が進むため，歩数は高々 2 * (model_length + 1) である。
+    max_steps = 2 * (model_length + 1)
+    coord_index = np.arange(num_coords)
+    indices = np.zeros((num_coords, max_steps + 1), dtype=np.int64)
+    states = np.full((num_coords, max_steps + 1), int(State.M), dtype=np.int64)
+    chars = np.zeros((num_coords, max_steps), dtype=np.uint8)
+    num_steps = np.zeros(num_coords, dtype=np.int64)
+    index = np.zeros(num_coords, dtype=np.int64)
+    state = np.full(num_coords, int(State.M), dtype=np.int64)
+    active = np.ones(num_coords, dtype=bool)
+
+    for step in range(1, max_steps + 1):
+        if not active.any():
+            break
+        # update state and index
+        # 終了済みの座標の index は範囲外なので丸めて参照し，結果は使わない。
+        next_state = next_states[state, coord_index, np.minimum(index, model_length)]
+        state = np.where(active, next_state, state)
+        index = np.where(active & (state != State.I), index + 1, index)
+        indices[active, step] = index[active]
+        states[active, step] = state[active]
+        num_steps[active] = step
+
+        # finish with
+        active &= index != model_length + 1
+
+        # update nucleotides string
+        chars[:, step - 1] = np.where(
+            state == State.M,
+            nucleotides[coord_index, np.clip(index - 1, 0, model_length - 1)],
+            np.where(state == State.I, ord("N"), ord("_")),
+        )
+
+    # 最後の一歩（終了状態への遷移）では塩基を出力しない。
+    sequences = [
+        chars[n, : num_steps[n] - 1].tobytes().decode() for n in range(num_coords)
+    ]
+    return sequences, indices, states, num_steps
+
+
 def get_most_probable_seq(
     coords: List[np.ndarray],
     model: CNN_PHMM_VAE,
@@ -506,107 +1525,759 @@ def get_most_probable_seq(
     """
     assert np.array(coords).shape[1] == model.embed_size
 
-    sequences = list()
-    states_transit = list()
-
-    for coord in coords:
-        transition_probs, emission_probs = model.decoder(torch.Tensor([coord]))
-        a_probs: np.ndarray = transition_probs.detach().numpy()[0]
-        e_probs: np.ndarray = emission_probs.detach().numpy()[0]
-        if proba_is_log:
-            a_probs = np.exp(a_probs)
-            e_probs = np.exp(e_probs)
-
-        index, state = 0, State.M
-        states: List[Tuple[int, int]] = [(index, state)]
-        seq = ""
-        while True:
-            a_prob: np.ndarray = a_probs[index]
-            if state == State.M:
-                next_transit_prob = a_prob.take(
-                    [
-                        Transition.M2M,
-                        Transition.M2I,
-                        Transition.M2D,
-                    ]
-                )
-            elif state == State.I:
-                next_transit_prob = np.array(
-                    [
-                        a_prob[Transition.I2M],
-                        0,
-                        0,
-                    ]
-                )
-            elif state == State.D:
-                next_transit_prob = np.array(
-                    [
-                        a_prob[Transition.D2M],
-                        0,
-                        a_prob[Transition.D2D],
-                    ]
-                )
-            else:
-                raise Exception()
+    # 全座標について一度にデコーダを計算する。
+    with torch.no_grad():
+        transition_probs, emission_probs = model.decoder(torch.Tensor(np.array(coords)))
+    a_probs: np.ndarray = transition_probs.numpy()
+    e_probs: np.ndarray = emission_probs.numpy()
+    if proba_is_log:
+        a_probs = np.exp(a_probs)
+        e_probs = np.exp(e_probs)
+    sequences, indices, states, num_steps = _phmm_greedy_decode(a_probs, e_probs)
+
+    # `State(value)` の呼び出しは遅いため，列挙子の列から引く。
+    state_members = list(State)
+    states_transit = [
+        list(
+            zip(
+                indices[n, : num_steps[n] + 1].tolist(),
+                map(state_members.__getitem__, states[n, : num_steps[n] + 1].tolist()),
+            )
+        )
+        for n in range(len(sequences))
+    ]
+
+    return sequences, states_transit
+
 
-            # update state and index
-            state = State(next_transit_prob.argmax())
-            if state != State.I:
-                index += 1
-            states.append((index, state))
+def _phmm_viterbi(
+    a: Tensor, e_m: Tensor, top_k: int = 1
+) -> Tuple[List[List[str]], List[List[float]]]:
+    """pHMM が（状態列，配列）の組を生成する同時確率を最大化する上位 `top_k` 個の組を，バッチ全体で同時に max-product の動的計画法で求める。
+    I の出力確率は一様 (1/4) なので I が出力する塩基は "N" で表し，M が出力する塩基は出力確率に従って選ぶ（上位候補では二番目以降の塩基も候補となる）。
+    I -> I の自己遷移は確率を単調に下げるため，上位 `top_k` 個の候補に現れる I の連続回数は高々 `top_k` 回であり，自己遷移を `top_k` 回まで展開すれば厳密な解が得られる。
 
-            # finish with
-            if index == len(a_probs):
+    Parameters
+    ----------
+    a : Tensor
+        pHMM の遷移確率。(`batch`, `model_length`+1, `combi of 'from' and 'to'`) の 3 次元構成で，対数で表現されていることとする。
+    e_m : Tensor
+        pHMM の出力確率。(`batch`, `model_length`, `nucleotide_type`=4) の 3 次元構成で，対数で表現されていることとする。
+    top_k : int, default = 1
+        各要素について求める候補の数。
+
+    Returns
+    -------
+    result : Tuple[List[List[str]], List[List[float]]]
+        要素ごとに確率の高い順に並べた配列とその対数確率のリスト。配列の表記は `get_most_probable_seq` と同じである。
+    """
+    set_size, model_length = e_m.shape[0], e_m.shape[1]
+    log_quarter = np.log(1 / 4)
+    neg_inf = a.new_full((set_size, top_k), -np.inf)
+
+    def top(candidates: Tensor) -> Tuple[Tensor, Tensor]:
+        # (set_size, N) の候補から上位 top_k 個を降順に選ぶ。候補が足りなければ -inf で埋める。
+        if candidates.shape[1] < top_k:
+            candidates = torch.cat((candidates, neg_inf), dim=1)
+        values, indices = torch.sort(candidates, dim=1, descending=True, stable=True)
+        return values[:, :top_k], indices[:, :top_k]
+
+    # scores[k][:, s] は状態 s_k に至る上位 top_k 個の部分経路の対数確率。
+    # back_states, back_ranks は直前の状態とその順位，back_chars は M_k が出力した塩基。
+    scores = torch.empty((model_length + 1, set_size, 3, top_k), dtype=a.dtype)
+    back_states = torch.zeros((model_length + 1, set_size, 3, top_k), dtype=torch.long)
+    back_ranks = torch.zeros_like(back_states)
+    back_chars = torch.zeros((model_length + 1, set_size, top_k), dtype=torch.long)
+
+    for k in range(model_length + 1):
+        if k == 0:
+            scores[0, :, State.M] = neg_inf
+            scores[0, :, State.M, 0] = 0
+            scores[0, :, State.D] = neg_inf
+        else:
+            # for state M: M_{k-1}, I_{k-1}, D_{k-1} から遷移し，4 種の塩基のいずれかを出力する。
+            previous = scores[k - 1] + a[
+                :, k - 1, [Transition.M2M, Transition.I2M, Transition.D2M]
+            ].unsqueeze(2)
+            candidates = previous.unsqueeze(3) + e_m[:, k - 1].view(set_size, 1, 1, 4)
+            values, indices = top(candidates.reshape(set_size, -1))
+            scores[k, :, State.M] = values
+            back_states[k, :, State.M] = indices // (4 * top_k)
+            back_ranks[k, :, State.M] = indices // 4 % top_k
+            back_chars[k] = indices % 4
+
+            # for state D: M_{k-1}, D_{k-1} から遷移する。
+            candidates = torch.cat(
+                (
+                    scores[k - 1, :, State.M] + a[:, k - 1, [Transition.M2D]],
+                    scores[k - 1, :, State.D] + a[:, k - 1, [Transition.D2D]],
+                ),
+                dim=1,
+            )
+            values, indices = top(candidates)
+            scores[k, :, State.D] = values
+            back_states[k, :, State.D] = torch.where(
+                indices < top_k, int(State.M), int(State.D)
+            )
+            back_ranks[k, :, State.D] = indices % top_k
+
+        # for state I: M_k と I_k 自身から遷移する。自己遷移による候補の列が変化しなくなるまで更新する。
+        from_m = scores[k, :, State.M] + a[:, k, [Transition.M2I]] + log_quarter
+        values = from_m
+        indices = torch.arange(top_k).expand(set_size, -1)
+        for _ in range(top_k + 1):
+            candidates = torch.cat(
+                (from_m, values + a[:, k, [Transition.I2I]] + log_quarter), dim=1
+            )
+            new_values, indices = top(candidates)
+            converged = torch.equal(new_values, values)
+            values = new_values
+            if converged:
                 break
+        scores[k, :, State.I] = values
+        back_states[k, :, State.I] = torch.where(
+            indices < top_k, int(State.M), int(State.I)
+        )
+        back_ranks[k, :, State.I] = indices % top_k
+
+    # 終了状態への遷移
+    candidates = scores[model_length] + a[
+        :, model_length, [Transition.M2M, Transition.I2M, Transition.D2M]
+    ].unsqueeze(2)
+    final_scores, indices = top(candidates.reshape(set_size, -1))
+
+    # 全要素・全候補の経路を同時に遡る。
+    back_states_np = back_states.numpy()
+    back_ranks_np = back_ranks.numpy()
+    back_chars_np = back_chars.numpy()
+    batch_index = np.repeat(np.arange(set_size), top_k)
+    state = (indices // top_k).numpy().reshape(-1)
+    rank = (indices % top_k).numpy().reshape(-1)
+    column = np.full(set_size * top_k, model_length)
+    active = np.ones(set_size * top_k, dtype=bool)
+    # 遡った各段階で有効な候補と，その状態が出力した記号（"ATGCN_" の添字）
+    trace_active: List[np.ndarray] = []
+    trace_chars: List[np.ndarray] = []
+
+    while active.any():
+        chars = np.where(
+            state == State.M,
+            back_chars_np[column, batch_index, rank],
+            np.where(state == State.I, 4, 5),
+        )
+        trace_active.append(active.copy())
+        trace_chars.append(chars)
+        # 始状態 M_0 に到達した候補は終了する。
+        active &= ~((state == State.M) & (column == 0))
+        next_state = back_states_np[column, batch_index, state, rank]
+        next_rank = back_ranks_np[column, batch_index, state, rank]
+        column = np.where(active & (state != State.I), column - 1, column)
+        state = np.where(active, next_state, state)
+        rank = np.where(active, next_rank, rank)
+
+    # 候補ごとに連続した (set_size * top_k, steps) の構成にまとめ，始状態側から読む。
+    active_steps = np.ascontiguousarray(np.stack(trace_active, axis=1)[:, ::-1])
+    char_steps = np.ascontiguousarray(np.stack(trace_chars, axis=1)[:, ::-1])
+    symbols = np.frombuffer(b"ATGCN_", dtype=np.uint8)
+    sequences: List[List[str]] = [[] for _ in range(set_size)]
+    log_probs: List[List[float]] = [[] for _ in range(set_size)]
+    final_scores_list = final_scores.reshape(-1).tolist()
+    for n in range(set_size * top_k):
+        if final_scores_list[n] == -np.inf:
+            continue
+        # 始状態 M_0 は塩基を出力しない。
+        chars = char_steps[n, active_steps[n]][1:]
+        sequences[n // top_k].append(symbols[chars].tobytes().decode())
+        log_probs[n // top_k].append(final_scores_list[n])
 
-            # update nucleotides string
-            if state == State.M:
-                e_prob: np.ndarray = e_probs[index - 1]
-                seq += "ATGC"[e_prob.argmax()]
-            elif state == State.I:
-                seq += "N"
-            else:  # equals to State.D
-                seq += "_"
+    return sequences, log_probs
 
-        sequences.append(seq)
-        states_transit.append(states)
 
-    return sequences, states_transit
+def get_viterbi_seqs(
+    coords: List[np.ndarray],
+    model: CNN_PHMM_VAE,
+    top_k: int = 1,
+    proba_is_log: bool = True,
+) -> Tuple[List[List[str]], List[List[float]]]:
+    """座標に対応する pHMM モデルにおいて，最も生成されやすい配列を Viterbi アルゴリズムで厳密に計算する。
+    `get_most_probable_seq` は各状態で局所的に最も確率の高い遷移を選ぶため，必ずしも最も生成されやすい配列とはならない。
+    `top_k` を指定すると確率の高い順に複数の候補を返す。
+
+    Parameters
+    ----------
+    coords : List[np.ndarray]
+        座標値のリスト。
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    top_k : int, default = 1
+        各座標について求める候補の数。
+    proba_is_log : bool = True
+        `model` の pHMM-decoder が生成する出力確率および遷移確率が対数で表現されている場合 True, そうでない場合 False となる。
 
+    Returns
+    -------
+    seqs_probs_tuple : Tuple[List[List[str]], List[List[float]]]
+        座標ごとに確率の高い順に並べた配列と，（状態列，配列）の組が生成される対数確率のリスト。
+        配列の表記は `get_most_probable_seq` と同じで，I が出力する塩基は "N"，D は "_" で表す。状態列は配列の各文字から一意に定まる。
+    """
+    assert np.array(coords).shape[1] == model.embed_size
+    assert top_k >= 1
 
-def draw_logo(
-    ax: Axes,
-    coord: np.ndarray,
+    with torch.no_grad():
+        transition_probs, emission_probs = model.decoder(torch.Tensor(np.array(coords)))
+    if not proba_is_log:
+        transition_probs = transition_probs.log()
+        emission_probs = emission_probs.log()
+
+    return _phmm_viterbi(transition_probs, emission_probs, top_k=top_k)
+
+
+def sample_sequences(
+    coords: List[np.ndarray],
     model: CNN_PHMM_VAE,
-    is_RNA: bool = True,
-    calc_h_em: bool = True,
-    correction: float = 0,
-    font_file: str = "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
-) -> Axes:
-    assert coord.ndim == 1
+    num_samples: int,
+    seed: Optional[int] = None,
+    proba_is_log: bool = True,
+    max_batch_size: int = 4096,
+) -> Tuple[List[List[str]], np.ndarray]:
+    """座標に対応する pHMM モデルから，座標ごとに `num_samples` 本の配列を確率的に生成する。
 
-    red = "#d50000"
-    green = "#00d500"
-    blue = "#0000c0"
-    yellow = "#ffaa00"
+    （座標，サンプル）の組を最大 `max_batch_size` 組ずつまとめ，その状態を一歩ずつ同時に進める。各歩では一様乱数と累積確率の比較で遷移先と出力塩基を選ぶため，サンプルごとの Python のループはない。
+    各歩の出力を保持する作業領域はバッチの大きさに比例するため，組の総数によらず一定の大きさに収まる。
+    I の出力する塩基は一様分布から選ぶ。最後の index から D への遷移は終了状態に到達しないため，その index では D を除いて正規化した確率で遷移先を選ぶ。
+
+    Parameters
+    ----------
+    coords : List[np.ndarray]
+        座標値のリスト。
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    num_samples : int
+        各座標について生成する配列の数。
+    seed : Optional[int], default = None
+        乱数のシード。指定すると同じ結果が得られる。
+    proba_is_log : bool = True
+        `model` の pHMM-decoder が生成する出力確率および遷移確率が対数で表現されている場合 True, そうでない場合 False となる。
+    max_batch_size : int, default = 4096
+        同時に生成する（座標，サンプル）の組の最大数。同じ `seed` でもこの値が異なると結果は異なる。
 
-    if is_RNA:
-        nucleotides = list("AUGC")
+    Returns
+    -------
+    seqs_probs_tuple : Tuple[List[List[str]], np.ndarray]
+        座標ごとに生成した配列のリストと，（状態列，配列）の組がモデルから生成される対数確率。対数確率は (`len(coords)`, `num_samples`) の構成。
+        対数確率は `_phmm_viterbi` と同様に正規化前の遷移確率で計算するため，`profile_hmm_loss` や Viterbi アルゴリズムの値と比較できる。
+        配列は D を含まず，各文字は `A, T, G, C` のいずれかである。
+    """
+    assert np.array(coords).shape[1] == model.embed_size
+    assert num_samples >= 1 and max_batch_size >= 1
+
+    with torch.no_grad():
+        transition_probs, emission_probs = model.decoder(torch.Tensor(np.array(coords)))
+    # 累積確率の比較で丸め誤差の影響を受けないよう倍精度で計算する。
+    transition_probs = transition_probs.cpu().double()
+    emission_probs = emission_probs.cpu().double()
+    if not proba_is_log:
+        transition_probs = transition_probs.log()
+        emission_probs = emission_probs.log()
+    num_coords, model_length = emission_probs.shape[0], emission_probs.shape[1]
+
+    # log_trans[state, n, index, next_state] は状態 (index, state) から next_state への遷移の対数確率。存在しない遷移は -inf。
+    impossible = torch.full(
+        transition_probs.shape[:2], -float("inf"), dtype=torch.float64
+    )
+    log_trans = torch.stack(
+        [
+            transition_probs[:, :, Transition.M2M : Transition.M2D + 1],
+            torch.stack(
+                [
+                    transition_probs[:, :, Transition.I2M],
+                    transition_probs[:, :, Transition.I2I],
+                    impossible,
+                ],
+                dim=2,
+            ),
+            torch.stack(
+                [
+                    transition_probs[:, :, Transition.D2M],
+                    impossible,
+                    transition_probs[:, :, Transition.D2D],
+                ],
+                dim=2,
+            ),
+        ]
+    )
+    sampling_trans = log_trans.exp()
+    sampling_trans[:, :, model_length, State.D] = 0
+    # 最後の列で割るため，確率 0 の遷移先より後ろの累積確率はちょうど 1 になり，選ばれることはない。
+    trans_cdf = sampling_trans.cumsum(dim=3)
+    trans_cdf = (trans_cdf / trans_cdf[..., -1:])[..., :-1].contiguous()
+    emission_cdf = emission_probs.exp().cumsum(dim=2)
+    emission_cdf = (emission_cdf / emission_cdf[..., -1:])[..., :-1].contiguous()
+
+    generator = torch.Generator()
+    if seed is None:
+        generator.seed()
     else:
-        nucleotides = list("ATGC")
+        generator.manual_seed(seed)
+
+    sequences: List[str] = []
+    log_probs_list: List[Tensor] = []
+    for start in range(0, num_coords * num_samples, max_batch_size):
+        # 組の通し番号 n * num_samples + i は座標 n の i 番目のサンプル
+        pair_index = torch.arange(
+            start, min(start + max_batch_size, num_coords * num_samples)
+        )
+        coord_index = pair_index // num_samples
+        batch_size = len(pair_index)
+        state = torch.full((batch_size,), int(State.M), dtype=torch.long)
+        index = torch.zeros(batch_size, dtype=torch.long)
+        log_probs = torch.zeros(batch_size, dtype=torch.float64)
+        active = torch.ones(batch_size, dtype=torch.bool)
+        # 各歩の出力塩基の ID。出力しない歩は -1。
+        emitted: List[Tensor] = []
+
+        # I2I の確率は 1 未満なので，全サンプルが確率 1 で終了する。
+        while bool(active.any()):
+            # 終了済みのサンプルの index は範囲外なので丸めて参照し，結果は使わない。
+            source = (state, coord_index, index.clamp(max=model_length))
+            next_state = (
+                torch.rand(batch_size, 1, generator=generator, dtype=torch.float64)
+                >= trans_cdf[source]
+            ).sum(dim=1)
+            log_probs += torch.where(active, log_trans[source + (next_state,)], 0.0)
+            state = torch.where(active, next_state, state)
+            index = torch.where(active & (state != State.I), index + 1, index)
+            active &= index != model_length + 1
+
+            uniform = torch.rand(
+                batch_size, 1, generator=generator, dtype=torch.float64
+            )
+            emission_index = (coord_index, (index - 1).clamp(0, model_length - 1))
+            match_nucleotide = (uniform >= emission_cdf[emission_index]).sum(dim=1)
+            insert_nucleotide = (uniform[:, 0] * 4).long()
+            is_match = active & (state == State.M)
+            is_insert = active & (state == State.I)
+            log_probs += torch.where(
+                is_match,
+                emission_probs[emission_index + (match_nucleotide,)],
+                torch.where(is_insert, np.log(1 / 4), 0.0),
+            )
+            emitted.append(
+                torch.where(
+                    is_match,
+                    match_nucleotide,
+                    torch.where(is_insert, insert_nucleotide, -1),
+                )
+            )
 
-    res = dict()
-    for text, color in zip(nucleotides, [green, red, yellow, blue]):
+        # 出力しない歩を詰めて文字列にする。
+        emitted_np = torch.stack(emitted, dim=1).numpy()
+        is_emitted = emitted_np >= 0
+        order = np.argsort(~is_emitted, axis=1, kind="stable")
+        chars = np.frombuffer(b"ATGC", dtype=np.uint8)[
+            np.take_along_axis(emitted_np, order, axis=1).clip(0, 3)
+        ]
+        seq_lengths = is_emitted.sum(axis=1).tolist()
+        sequences += [
+            row[:length].tobytes().decode() for row, length in zip(chars, seq_lengths)
+        ]
+        log_probs_list.append(log_probs)
+    log_probs = torch.cat(log_probs_list)
+
+    return [
+        sequences[n * num_samples : (n + 1) * num_samples] for n in range(num_coords)
+    ], log_probs.numpy().reshape(num_coords, num_samples)
+
+
+def get_log_likelihoods(
+    sequences: List[str],
+    coords: List[np.ndarray],
+    model: CNN_PHMM_VAE,
+    max_batch_size: int = 1024,
+    band_width: Optional[int] = None,
+) -> np.ndarray:
+    """各座標に対応する pHMM モデルにおいて，各配列が生成される対数尤度を計算する。
+
+    座標ごとの pHMM のパラメータはデコーダで一度だけ計算し，（配列，座標）の組を最大 `max_batch_size` 組ずつまとめて
+    評価専用の forward アルゴリズム（`profile_hmm_loss` の `engine="inference"`）で計算する。
+    配列は長さで安定ソートしてからまとめるため，同じバッチ内のパディングは最小限になる。
+
+    Parameters
+    ----------
+    sequences : List[str]
+        各残基が `A, U, C, G` で表現された塩基配列のリスト。
+    coords : List[np.ndarray]
+        座標値のリスト。
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    max_batch_size : int, default = 1024
+        一度に forward アルゴリズムで計算する（配列，座標）の組の最大数。
+    band_width : Optional[int], default = None
+        `profile_hmm_loss` の `band_width` を参照。
+
+    Returns
+    -------
+    log_likelihoods : np.ndarray
+        `log_likelihoods[n, m]` は `coords[m]` の pHMM が `sequences[n]` を生成する対数尤度。
+        (`len(sequences)`, `len(coords)`) の float32 の配列。
+    """
+    assert type(sequences) == list
+    assert np.array(coords).shape[1] == model.embed_size
+    assert max_batch_size > 0
+
+    num_seqs, num_coords = len(sequences), len(coords)
+    log_likelihoods = np.empty((num_seqs, num_coords), dtype=np.float32)
+    if num_seqs == 0 or num_coords == 0:
+        return log_likelihoods
+
+    model_device = next(model.parameters()).device
+    with torch.no_grad():
+        model.eval()
+        transition_probs, emission_probs = model.decoder(
+            torch.tensor(np.array(coords), dtype=torch.float32, device=model_device)
+        )
+
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=num_seqs)
+    order = np.argsort(lengths, kind="stable")
+    # 一つのバッチに含める配列と座標の数。積が `max_batch_size` を超えないようにする。
+    coords_per_batch = min(num_coords, max_batch_size)
+    seqs_per_batch = max(max_batch_size // coords_per_batch, 1)
+
+    with torch.no_grad():
+        for seq_start in range(0, num_seqs, seqs_per_batch):
+            indices = order[seq_start : seq_start + seqs_per_batch]
+            max_length = int(lengths[indices].max())
+            encoded_seqs = torch.tensor(
+                [
+                    ID_encode(
+                        sequences[index],
+                        right_padding=max_length - len(sequences[index]),
+                    )
+                    for index in indices
+                ],
+                dtype=torch.long,
+                device=model_device,
+            )
+            for coord_start in range(0, num_coords, coords_per_batch):
+                coord_stop = min(coord_start + coords_per_batch, num_coords)
+                # 組は（配列，座標）の順に並べる。
+                seq_ids = torch.arange(len(indices), device=model_device)
+                coord_ids = torch.arange(coord_start, coord_stop, device=model_device)
+                seq_ids, coord_ids = (
+                    seq_ids.repeat_interleave(len(coord_ids)),
+                    coord_ids.repeat(len(seq_ids)),
+                )
+                nll = profile_hmm_loss(
+                    transition_probs[coord_ids],
+                    emission_probs[coord_ids],
+                    encoded_seqs[seq_ids],
+                    engine="inference",
+                    band_width=band_width,
+                )
+                log_likelihoods[indices, coord_start:coord_stop] = (
+                    -nll.cpu().numpy().reshape(len(indices), -1)
+                )
+
+    return log_likelihoods
+
+
+def get_log_likelihood_grid(
+    sequences: List[str],
+    model: CNN_PHMM_VAE,
+    range_x: Tuple[float, float],
+    range_y: Tuple[float, float],
+    resolution: int = 50,
+    max_batch_size: int = 1024,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """潜在空間上の格子点ごとに各配列の対数尤度を計算する。配列ごとの尤度のヒートマップの描画に用いる。
+    2 次元の潜在空間を持つモデルのみに対応する。
+
+    Parameters
+    ----------
+    sequences : List[str]
+        各残基が `A, U, C, G` で表現された塩基配列のリスト。
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    range_x : Tuple[float, float]
+        格子の x 座標の範囲（両端を含む）。
+    range_y : Tuple[float, float]
+        格子の y 座標の範囲（両端を含む）。
+    resolution : int, default = 50
+        各軸の格子点の数。
+    max_batch_size : int, default = 1024
+        `get_log_likelihoods` を参照。
+
+    Returns
+    -------
+    grid_tuple : Tuple[np.ndarray, np.ndarray, np.ndarray]
+        x 座標 (`resolution`,)，y 座標 (`resolution`,)，および対数尤度 (`len(sequences)`, `resolution`, `resolution`) の組。
+        対数尤度の配列は y 座標，x 座標の順に並ぶ。
+    """
+    assert model.embed_size == 2
+    assert resolution > 0
+
+    grid_x = np.linspace(range_x[0], range_x[1], resolution, dtype=np.float32)
+    grid_y = np.linspace(range_y[0], range_y[1], resolution, dtype=np.float32)
+    mesh_x, mesh_y = np.meshgrid(grid_x, grid_y)
+    coords = np.stack([mesh_x.ravel(), mesh_y.ravel()], axis=1)
+
+    log_likelihoods = get_log_likelihoods(
+        sequences, list(coords), model, max_batch_size=max_batch_size
+    )
+    return grid_x, grid_y, log_likelihoods.reshape(-1, resolution, resolution)
+
+
+class LatentDecodeTiles:
+    """潜在空間の矩形領域上の格子点について，pHMM のパラメータと `get_most_probable_seq` の配列を事前に計算して保持する。
+
+    格子は解像度の異なる複数の階層からなり，階層 `level` の各軸の格子点の数は `base_resolution * 2 ** level` である。
+    各階層は `tile_size` × `tile_size` 個の格子点ごとのタイルに分かれており，タイル単位でデコーダと貪欲法をまとめて計算する。
+    最も粗い階層は作成時に全て計算し，それより細かい階層のタイルは初めて参照された時に計算して保持する。
+    2 次元の潜在空間を持つモデルのみに対応する。
+
+    Parameters
+    ----------
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    range_x : Tuple[float, float]
+        格子の x 座標の範囲（両端を含む）。
+    range_y : Tuple[float, float]
+        格子の y 座標の範囲（両端を含む）。
+    base_resolution : int, default = 32
+        最も粗い階層の各軸の格子点の数。
+    num_levels : int, default = 3
+        階層の数。
+    tile_size : int, default = 16
+        タイルの各軸の格子点の数。
+    """
+
+    def __init__(
+        self,
+        model: CNN_PHMM_VAE,
+        range_x: Tuple[float, float],
+        range_y: Tuple[float, float],
+        base_resolution: int = 32,
+        num_levels: int = 3,
+        tile_size: int = 16,
+    ):
+        assert model.embed_size == 2
+        assert base_resolution >= 2 and num_levels >= 1 and tile_size >= 1
+        assert range_x[0] < range_x[1] and range_y[0] < range_y[1]
+
+        self.model = model
+        self.range_x = (float(range_x[0]), float(range_x[1]))
+        self.range_y = (float(range_y[0]), float(range_y[1]))
+        self.resolutions = [base_resolution * 2**level for level in range(num_levels)]
+        self.tile_size = tile_size
+        # (level, tile_x, tile_y) -> (遷移確率, 出力確率, 配列)。確率は対数で，タイル内の格子点は y, x の順に並ぶ。
+        self._tiles: Dict[
+            Tuple[int, int, int], Tuple[np.ndarray, np.ndarray, List[str]]
+        ] = dict()
+
+        num_tiles = -(-self.resolutions[0] // tile_size)
+        self._compute_tiles(
+            [(0, tx, ty) for ty in range(num_tiles) for tx in range(num_tiles)]
+        )
+
+    def _lattice(self, level: int) -> Tuple[np.ndarray, np.ndarray]:
+        resolution = self.resolutions[level]
+        return (
+            np.linspace(*self.range_x, resolution, dtype=np.float32),
+            np.linspace(*self.range_y, resolution, dtype=np.float32),
+        )
+
+    def _compute_tiles(self, keys: List[Tuple[int, int, int]]):
+        """未計算のタイルをまとめて一度のデコーダと貪欲法の計算で求める。"""
+        keys = [key for key in dict.fromkeys(keys) if key not in self._tiles]
+        if len(keys) == 0:
+            return
+
+        coords_list, sizes = [], []
+        for level, tx, ty in keys:
+            lattice_x, lattice_y = self._lattice(level)
+            xs = lattice_x[tx * self.tile_size : (tx + 1) * self.tile_size]
+            ys = lattice_y[ty * self.tile_size : (ty + 1) * self.tile_size]
+            mesh_x, mesh_y = np.meshgrid(xs, ys)
+            coords_list.append(np.stack([mesh_x.ravel(), mesh_y.ravel()], axis=1))
+            sizes.append(mesh_x.size)
+
+        with torch.no_grad():
+            self.model.eval()
+            transition_probs, emission_probs = self.model.decoder(
+                torch.from_numpy(np.concatenate(coords_list))
+            )
+        a_log, e_log = transition_probs.numpy(), emission_probs.numpy()
+        sequences, _, _, _ = _phmm_greedy_decode(np.exp(a_log), np.exp(e_log))
+
+        offsets = np.cumsum([0] + sizes)
+        for key, start, stop in zip(keys, offsets[:-1], offsets[1:]):
+            self._tiles[key] = (
+                a_log[start:stop],
+                e_log[start:stop],
+                sequences[start:stop],
+            )
+
+    def _nearest(
+        self, coords: np.ndarray, level: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """各座標に最も近い格子点の添字と，座標が格子の範囲内にあるかを返す。"""
+        resolution = self.resolutions[level]
+        index_x = np.rint(
+            (coords[:, 0] - self.range_x[0])
+            / (self.range_x[1] - self.range_x[0])
+            * (resolution - 1)
+        )
+        index_y = np.rint(
+            (coords[:, 1] - self.range_y[0])
+            / (self.range_y[1] - self.range_y[0])
+            * (resolution - 1)
+        )
+        inside = (
+            (index_x >= 0)
+            & (index_x < resolution)
+            & (index_y >= 0)
+            & (index_y < resolution)
+        )
+        index_x = np.clip(index_x, 0, resolution - 1).astype(np.int64)
+        index_y = np.clip(index_y, 0, resolution - 1).astype(np.int64)
+        return index_x, index_y, inside
+
+    def lookup(
+        self, coords: List[np.ndarray], level: Optional[int] = None
+    ) -> Tuple[List[Optional[str]], np.ndarray, np.ndarray, np.ndarray]:
+        """各座標に最も近い格子点の値を返す。格子の範囲外の座標は計算しない。
+
+        Parameters
+        ----------
+        coords : List[np.ndarray]
+            座標値のリスト。
+        level : Optional[int], default = None
+            参照する階層。指定しない場合は最も細かい階層を用いる。
+
+        Returns
+        -------
+        lookup_tuple : Tuple[List[Optional[str]], np.ndarray, np.ndarray, np.ndarray]
+            最も生成されやすい配列，対数の遷移確率，対数の出力確率，および座標が格子の範囲内にあるか。
+            範囲外の座標の配列は `None`，確率は `nan` となる。
+        """
+        if level is None:
+            level = len(self.resolutions) - 1
+        assert 0 <= level < len(self.resolutions)
+
+        coords_np = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        index_x, index_y, inside = self._nearest(coords_np, level)
+        tile_x, tile_y = index_x // self.tile_size, index_y // self.tile_size
+        self._compute_tiles(
+            [
+                (level, int(tx), int(ty))
+                for tx, ty in zip(tile_x[inside], tile_y[inside])
+            ]
+        )
+
+        # TorchScript に変換したデコーダは層を参照できないため，計算済みのタイルから pHMM の長さを得る。
+        model_length = next(iter(self._tiles.values()))[1].shape[1]
+        sequences: List[Optional[str]] = [None] * len(coords_np)
+        transition_probs = np.full(
+            (len(coords_np), model_length + 1, 7), np.nan, dtype=np.float32
+        )
+        emission_probs = np.full(
+            (len(coords_np), model_length, 4), np.nan, dtype=np.float32
+        )
+        for n in np.flatnonzero(inside):
+            a_log, e_log, tile_sequences = self._tiles[
+                (level, int(tile_x[n]), int(tile_y[n]))
+            ]
+            # タイルの幅は右端と上端で `tile_size` より小さいことがある。
+            width = min(
+                self.tile_size,
+                self.resolutions[level] - tile_x[n] * self.tile_size,
+            )
+            position = (index_y[n] % self.tile_size) * width + index_x[
+                n
+            ] % self.tile_size
+            sequences[n] = tile_sequences[position]
+            transition_probs[n] = a_log[position]
+            emission_probs[n] = e_log[position]
+
+        return sequences, transition_probs, emission_probs, inside
+
+    def decode(
+        self,
+        coords: List[np.ndarray],
+        exact: bool = False,
+        level: Optional[int] = None,
+    ) -> List[str]:
+        """各座標の最も生成されやすい配列を返す。
+
+        格子の範囲内の座標は最も近い格子点の配列で近似し，範囲外の座標と `exact` が `True` の場合は `get_most_probable_seq` で計算する。
+
+        Parameters
+        ----------
+        coords : List[np.ndarray]
+            座標値のリスト。
+        exact : bool, default = False
+            `True` のとき格子を用いずに計算する。
+        level : Optional[int], default = None
+            参照する階層。`lookup` を参照。
+
+        Returns
+        -------
+        sequences : List[str]
+            各座標の最も生成されやすい配列。表記は `get_most_probable_seq` と同じ。
+        """
+        if exact:
+            return get_most_probable_seq(coords, self.model)[0]
+
+        sequences, _, _, inside = self.lookup(coords, level=level)
+        outside = np.flatnonzero(~inside)
+        if len(outside) > 0:
+            exact_sequences, _ = get_most_probable_seq(
+                [coords[n] for n in outside], self.model
+            )
+            for n, seq in zip(outside, exact_sequences):
+                sequences[n] = seq
+        return sequences  # type: ignore
+
+
+# weblogo の各塩基の色。A, T (U), G, C の順。
+LOGO_COLORS: Tuple[str, str, str, str] = ("#00d500", "#d50000", "#ffaa00", "#0000c0")
+LOGO_FONT_FILE = "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc"
+
+
+@lru_cache(maxsize=16)
+def _load_glyph_atlas(
+    font_file: str, nucleotides: str, colors: Tuple[str, ...] = LOGO_COLORS
+) -> Dict[str, Image.Image]:
+    """weblogo に用いる塩基の文字画像を作成する。フォントと色の組ごとに一度だけ作成し，以降はキャッシュを返す。
+    返り値の画像は共有されるため，呼び出し側で変更してはならない。
+    """
+    font = ImageFont.truetype(font_file, size=200)
+    glyphs = dict()
+    for text, color in zip(nucleotides, colors):
         img = Image.new("RGBA", (200, 300), (255, 255, 255, 0))
-        font = ImageFont.truetype(font_file, size=200)
         drawer = ImageDraw.Draw(img)
         drawer.text((10, 10), text, fill=color, font=font)
-        img = img.crop(img.getbbox())
-        res[text] = img
+        glyphs[text] = img.crop(img.getbbox())
+    return glyphs
 
-    emission_probs: np.ndarray = (
-        model.decoder(torch.Tensor([coord]))[1].detach().numpy()[0]
-    )
+
+def _logo_heights(
+    coord: np.ndarray,
+    model: CNN_PHMM_VAE,
+    calc_h_em: bool = True,
+    correction: float = 0,
+) -> np.ndarray:
+    """weblogo の各座位における各塩基の高さを計算する。M と I の座位のみを含み，D の座位は除く。
+
+    Returns
+    -------
+    h_em : np.ndarray
+        (`length`, `nucleotide_type`=4) の構成。`calc_h_em` が `True` のとき情報量 (bit)，そうでないとき出力確率。
+    """
+    with torch.no_grad():
+        emission_probs: np.ndarray = model.decoder(torch.Tensor(np.array([coord])))[
+            1
+        ].numpy()[0]
 
     e_prob_list = list()
     for index, state in get_most_probable_seq(
@@ -625,24 +2296,26 @@ def draw_logo(
             e_prob_list.append(np.ones((4)) * 0.25)
 
     e_probs = np.stack(e_prob_list)
-    length = len(e_probs)
 
     if calc_h_em:
         p = e_probs.T
         h = -p * np.log2(p + 1e-30)
         r = 2 - np.sum(h, axis=0, keepdims=True) - correction
-        h_em = (p * r).T
-    else:
-        h_em = e_probs
-
-    c_h = int(ax.bbox.height)
-    if calc_h_em == True:
-        ylim = 2
+        return (p * r).T
     else:
-        ylim = 1
+        return e_probs
+
+
+def _compose_logo(
+    h_em: np.ndarray,
+    glyphs: Dict[str, Image.Image],
+    nucleotides: str,
+    c_w: int,
+    c_h: int,
+    ylim: float,
+) -> Image.Image:
+    """各座位の塩基を高さの大きい順に下から積み上げた，幅 `c_w`，高さ `c_h` の透過画像を作成する。"""
     unit_c_h = c_h / ylim  # 0 to ylim bit
-
-    c_w = int(ax.bbox.width)
     width = c_w // len(h_em)
 
     canvas = Image.new("RGBA", (c_w, c_h), (255, 255, 255, 0))
@@ -654,11 +2327,42 @@ def draw_logo(
             h = int(unit_c_h * [a, t, g, c][i])
             if h != 0:  # when matching rather than insertion
                 canvas.paste(
-                    res[nucleotides[i]].resize((w, h), Image.BOX),
+                    glyphs[nucleotides[i]].resize((w, h), Image.BOX),
                     (w_offset, c_h - h_offset - h),
                 )
             h_offset += h
         w_offset += w
+    return canvas
+
+
+def draw_logo(
+    ax: Axes,
+    coord: np.ndarray,
+    model: CNN_PHMM_VAE,
+    is_RNA: bool = True,
+    calc_h_em: bool = True,
+    correction: float = 0,
+    font_file: str = LOGO_FONT_FILE,
+) -> Axes:
+    assert coord.ndim == 1
+
+    nucleotides = "AUGC" if is_RNA else "ATGC"
+    glyphs = _load_glyph_atlas(font_file, nucleotides)
+
+    h_em = _logo_heights(coord, model, calc_h_em=calc_h_em, correction=correction)
+    length = len(h_em)
+
+    c_h = int(ax.bbox.height)
+    if calc_h_em == True:
+        ylim = 2
+    else:
+        ylim = 1
+    unit_c_h = c_h / ylim  # 0 to ylim bit
+
+    c_w = int(ax.bbox.width)
+    width = c_w // len(h_em)
+
+    canvas = _compose_logo(h_em, glyphs, nucleotides, c_w, c_h, ylim)
 
     ax.imshow(np.asarray(canvas), zorder=1)
     ax.set_xticks(np.arange(length) * width + width // 2)
@@ -668,3 +2372,93 @@ def draw_logo(
     ax.xaxis.grid(False)
 
     return ax
+
+
+def render_logo(
+    coord: np.ndarray,
+    model: CNN_PHMM_VAE,
+    is_RNA: bool = True,
+    calc_h_em: bool = True,
+    correction: float = 0,
+    font_file: str = LOGO_FONT_FILE,
+    size: Tuple[int, int] = (1200, 360),
+) -> Image.Image:
+    """`draw_logo` と同じ weblogo を Matplotlib を介さずに PIL の画像として直接描画する。
+    塩基の文字画像は `_load_glyph_atlas` のキャッシュを用いるため，描画ごとのフォントの読み込みやラスタライズは行わない。
+
+    Parameters
+    ----------
+    coord : np.ndarray
+        weblogo を描画する座標。
+    model : CNN_PHMM_VAE
+        埋め込み値から pHMM のパラメータを計算する VAE モデル。
+    is_RNA : bool, default = True
+        `True` のとき T の代わりに U を表示する。
+    calc_h_em : bool, default = True
+        `True` のとき各塩基の高さを情報量 (bit) で，そうでないとき出力確率で表す。
+    correction : float, default = 0
+        情報量の計算に用いる補正値。
+    font_file : str
+        塩基および目盛りの描画に用いるフォントファイル。
+    size : Tuple[int, int], default = (1200, 360)
+        出力画像の幅と高さ (px)。
+
+    Returns
+    -------
+    image : Image.Image
+        白背景の RGB 画像。左端に縦軸，下端に座位番号の目盛りを描く。
+    """
+    assert coord.ndim == 1
+
+    nucleotides = "AUGC" if is_RNA else "ATGC"
+    glyphs = _load_glyph_atlas(font_file, nucleotides)
+    h_em = _logo_heights(coord, model, calc_h_em=calc_h_em, correction=correction)
+    ylim = 2 if calc_h_em else 1
+
+    img_w, img_h = size
+    margin_left, margin_bottom, margin_top, margin_right = 60, 40, 15, 15
+    c_w = img_w - margin_left - margin_right
+    c_h = img_h - margin_top - margin_bottom
+    width = c_w // len(h_em)
+
+    # 背景は不透明なので RGB で作成する。PNG への変換も RGBA より速い。
+    image = Image.new("RGB", size, (255, 255, 255))
+    logo = _compose_logo(h_em, glyphs, nucleotides, c_w, c_h, ylim)
+    image.paste(logo, (margin_left, margin_top), logo)
+
+    font = _load_tick_font(font_file)
+    drawer = ImageDraw.Draw(image)
+    black = (0, 0, 0)
+    # 縦軸と目盛り
+    drawer.line(
+        [(margin_left - 1, margin_top), (margin_left - 1, margin_top + c_h)],
+        fill=black,
+    )
+    for fraction in [0, 0.25, 0.5, 0.75, 1]:
+        y = margin_top + c_h - int(fraction * c_h)
+        drawer.line([(margin_left - 6, y), (margin_left - 1, y)], fill=black)
+        drawer.text(
+            (margin_left - 9, y),
+            f"{fraction * ylim:g}",
+            fill=black,
+            font=font,
+            anchor="rm",
+        )
+    # 座位番号
+    for position in range(len(h_em)):
+        x = margin_left + position * width + width // 2
+        drawer.text(
+            (x, margin_top + c_h + 6),
+            str(position + 1),
+            fill=black,
+            font=font,
+            anchor="mt",
+        )
+
+    return image
+
+
+@lru_cache(maxsize=4)
+def _load_tick_font(font_file: str) -> ImageFont.FreeTypeFont:
+    """`render_logo` の目盛りに用いるフォントを読み込む。"""
+    return ImageFont.truetype(font_file, size=16)
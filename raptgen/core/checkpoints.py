@@ -0,0 +1,178 @@
+import gzip
+import hashlib
+import os
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Dict, Optional
+
+import torch
+
+# Directory of the checkpoint store. The backend and the workers must share it.
+CHECKPOINT_DIR = os.environ.get("RAPTGEN_CHECKPOINT_DIR", "/app/data/checkpoints")
+
+
+class CheckpointStore:
+    """
+    Content-addressed store of serialized checkpoints on a local directory.
+
+    Each checkpoint is written once to a file named after the SHA-256 digest of
+    its serialized bytes. The database keeps only the reference returned by
+    `put` or `save`, which is the file name.
+
+    Parameters
+    ----------
+    root : str, optional
+        directory to store the checkpoint files. Defaults to `CHECKPOINT_DIR`
+    compress : bool
+        flag to gzip the files. Compressed references end with ".gz"
+    compresslevel : int
+        gzip compression level, from 1 (fastest) to 9 (smallest)
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        compress: bool = True,
+        compresslevel: int = 1,
+    ):
+        self.root = root if root is not None else CHECKPOINT_DIR
+        self.compress = compress
+        self.compresslevel = compresslevel
+
+    def _path(self, ref: str) -> str:
+        if os.path.basename(ref) != ref or ref.startswith("."):
+            raise ValueError(f"Invalid checkpoint reference: {ref}")
+        return os.path.join(self.root, ref[:2], ref)
+
+    def put(self, data: bytes) -> str:
+        """
+        Store the bytes and return their reference.
+        Storing the same bytes twice writes the file only once.
+        """
+        ref = hashlib.sha256(data).hexdigest()
+        if self.compress:
+            ref += ".gz"
+        path = self._path(ref)
+        if os.path.exists(path):
+            return ref
+
+        if self.compress:
+            data = gzip.compress(data, compresslevel=self.compresslevel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return ref
+
+    def get(self, ref: str) -> bytes:
+        """
+        Read the bytes of the reference.
+        """
+        with open(self._path(ref), "rb") as f:
+            data = f.read()
+        if ref.endswith(".gz"):
+            data = gzip.decompress(data)
+        return data
+
+    def delete(self, ref: str):
+        """
+        Delete the file of the reference if it exists.
+        """
+        try:
+            os.remove(self._path(ref))
+        except FileNotFoundError:
+            pass
+
+    def save(self, checkpoint: Dict[str, Any]) -> str:
+        """
+        Serialize the checkpoint with `torch.save` and store it.
+        """
+        with BytesIO() as f:
+            torch.save(checkpoint, f)
+            return self.put(f.getvalue())
+
+    def load(self, ref: str, map_location=None) -> Dict[str, Any]:
+        """
+        Load the checkpoint of the reference with `torch.load`.
+        """
+        with BytesIO(self.get(ref)) as f:
+            return torch.load(f, map_location=map_location)
+
+
+def _copy_to_cpu(obj: Any) -> Any:
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _copy_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Background thread that serializes and stores checkpoints.
+
+    `submit` copies the tensors of the checkpoint to the CPU and returns
+    immediately, so the training loop can keep updating the model while the
+    checkpoint is written. Checkpoints are written in the order of submission.
+
+    Parameters
+    ----------
+    store : CheckpointStore
+        store to write the checkpoints to
+    """
+
+    def __init__(self, store: CheckpointStore):
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-writer"
+        )
+
+    def submit(self, checkpoint: Dict[str, Any]) -> "Future[str]":
+        """
+        Schedule the checkpoint to be written.
+        The returned future resolves to the reference of the stored checkpoint.
+        """
+        return self._executor.submit(self.store.save, _copy_to_cpu(checkpoint))
+
+    def close(self):
+        """
+        Wait for the scheduled checkpoints to be written and stop the thread.
+        """
+        self._executor.shutdown(wait=True)
+
+
+def read_checkpoint(
+    ref: Optional[str],
+    binary: Optional[bytes],
+    store: Optional[CheckpointStore] = None,
+) -> Optional[bytes]:
+    """
+    Return the serialized checkpoint from the store, or the bytes kept in the
+    database by jobs trained before the checkpoint store was introduced.
+
+    Parameters
+    ----------
+    ref : str, optional
+        reference of the checkpoint in the store
+    binary : bytes, optional
+        checkpoint bytes kept in the database
+    store : CheckpointStore, optional
+        checkpoint store. Defaults to the store on `CHECKPOINT_DIR`
+
+    Returns
+    -------
+    bytes or None
+        serialized checkpoint, or None if neither is available
+    """
+    if ref is not None:
+        return (store or CheckpointStore()).get(ref)
+    return binary
@@ -6,11 +6,14 @@ from sqlalchemy import (
     Integer,
     String,
     Float,
+    JSON,
     Boolean,
     ForeignKey,
     LargeBinary,
     Enum,
     create_engine,
+    inspect,
+    text,
 )
 from sqlalchemy.dialects import postgresql
 
@@ -57,7 +60,12 @@ class ParentJob(BaseSchema):
     duration : int
         overall duration of the parent job, interval is not included
     reiteration : int
-        number of reiterations of the child jobs
+        number of reiterations of each configuration
+    sweep : dict, optional
+        search space of the hyperparameter sweep, as submitted. None for a single configuration
+    num_configurations : int, optional
+        number of configurations of the sweep. The parent job has `reiteration * num_configurations`
+        child jobs, the reiterations of each configuration numbered consecutively. None means 1
     child_jobs : list
         list of child jobs
     """
@@ -71,6 +79,8 @@ class ParentJob(BaseSchema):
     start = Column(Integer)
     duration = Column(Integer)
     reiteration = Column(Integer)
+    sweep = Column(JSON, nullable=True)
+    num_configurations = Column(Integer, nullable=True)
     child_jobs = relationship("ChildJob", backref="job")
     worker_uuid = Column(String)
 
@@ -115,9 +125,15 @@ class ChildJob(BaseSchema):
     jobtype : str
         type of job, e.g. "RaptGen", "RaptGen-Freq", etc.
     current_checkpoint: bytes
-        the latest checkpoint of the child job, needed for resuming the training
+        the latest checkpoint of the child job, needed for resuming the training.
+        only used by jobs trained before the checkpoint store was introduced
     optimal_checkpoint: bytes
-        the latest optimal checkpoint of the child job, updated when the child job updates the minimal NLL
+        the latest optimal checkpoint of the child job, updated when the child job updates the minimal NLL.
+        only used by jobs trained before the checkpoint store was introduced
+    current_checkpoint_ref: str
+        reference of the latest checkpoint in the checkpoint store (`core.checkpoints`)
+    optimal_checkpoint_ref: str
+        reference of the latest optimal checkpoint in the checkpoint store (`core.checkpoints`)
     """
 
     __tablename__ = "child_jobs"
@@ -140,6 +156,8 @@ class ChildJob(BaseSchema):
     jobtype = Column(Enum(JobType), nullable=False)
     current_checkpoint = Column(LargeBinary)
     optimal_checkpoint = Column(LargeBinary)
+    current_checkpoint_ref = Column(String)
+    optimal_checkpoint_ref = Column(String)
 
 
 class SequenceEmbeddings(BaseSchema):
@@ -464,6 +482,30 @@ class RaptGenParams(BaseSchema):
         random seed
     device : str
         device to use for training
+    band_width : int, optional
+        band width of the pHMM dynamic programming. None evaluates the full table.
+    checkpoint_interval : int, optional
+        number of epochs between the checkpoints written for resuming. None writes one every epoch.
+    halving_min_epochs : int, optional
+        first rung of the successive halving over the child jobs of the parent job. The child jobs are
+        ranked together across the configurations of a sweep, so it prunes configurations as well as
+        reiterations. None disables it.
+    halving_rate : int, optional
+        reduction factor of the successive halving. Only the best 1 / rate of the child jobs
+        reaching a rung continue. None uses 3.
+    warm_start_vae_uuid : str, optional
+        published VAE model to initialize the model from. The pHMM length must match.
+    warm_start_child_uuid : str, optional
+        child job whose optimal checkpoint initializes the model. The pHMM length must match.
+    warm_start_optimizer : bool, optional
+        flag to also initialize the optimizer state from the warm start checkpoint
+    frozen_encoder_layers : int, optional
+        number of encoder residual blocks, from the input side, kept fixed with the
+        nucleotide embedding. None or 0 trains the whole model.
+    num_processes : int, optional
+        number of processes training the child job data-parallel on CPU. None trains in one.
+    pipelined_validation : bool, optional
+        flag to validate each epoch while the next one trains. Early stopping then acts one epoch late.
     """
 
     __tablename__ = "raptgen_params"
@@ -479,6 +521,16 @@ class RaptGenParams(BaseSchema):
     match_cost = Column(Float, nullable=False)
     seed_value = Column(Integer, nullable=False)
     device = Column(String, nullable=False)
+    band_width = Column(Integer, nullable=True)
+    checkpoint_interval = Column(Integer, nullable=True)
+    halving_min_epochs = Column(Integer, nullable=True)
+    halving_rate = Column(Integer, nullable=True)
+    warm_start_vae_uuid = Column(String, nullable=True)
+    warm_start_child_uuid = Column(String, nullable=True)
+    warm_start_optimizer = Column(Boolean, nullable=True)
+    frozen_encoder_layers = Column(Integer, nullable=True)
+    num_processes = Column(Integer, nullable=True)
+    pipelined_validation = Column(Boolean, nullable=True)
 
 
 class Experiments(BaseSchema):
@@ -832,6 +884,36 @@ class BIC(BaseSchema):
     BIC = Column(Float, nullable=False)
 
 
+def add_missing_columns(engine):
+    """
+    Add the nullable columns introduced after the tables were created.
+
+    `create_all` only creates missing tables, so the databases of existing
+    deployments lack the columns added to the tables since. They are added
+    with `ALTER TABLE`, empty, which the jobs read as the default behavior.
+
+    Parameters
+    ----------
+    engine : Engine
+        database engine
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in BaseSchema.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                    )
+                )
+
+
 def get_db_session(
     url: str = "postgresql+psycopg2://postgres:postgres@db:5432/raptgen",
 ):
@@ -856,6 +938,7 @@ def get_db_session(
 
     # create tables
     BaseSchema.metadata.create_all(engine)
+    add_missing_columns(engine)
 
     # create session
     session = scoped_session(sessionmaker(bind=engine))
@@ -0,0 +1,184 @@
+from datetime import timedelta
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+
+# Collectives wait at most this long for the other processes, so that a rank
+# whose peers died does not block forever.
+TIMEOUT = timedelta(minutes=10)
+
+
+class DataParallelGroup:
+    """
+    Gloo process group of the processes training one child job on localhost.
+
+    Rank 0 runs in the Celery worker and starts the other ranks with `start`.
+    The group is not the default process group of `torch.distributed`, so
+    several data-parallel jobs can run in the same worker process.
+
+    Every rank takes its share of the batches with `shard` and calls the
+    collectives in the same order. Rank 0 tells the other ranks whether to
+    train another epoch with `broadcast_flag`.
+
+    Parameters
+    ----------
+    rank : int
+        rank of the calling process
+    size : int
+        number of processes
+    store : torch.distributed.Store
+        store the processes meet at
+    timeout : timedelta
+        timeout of the collectives
+    """
+
+    def __init__(
+        self,
+        rank: int,
+        size: int,
+        store: dist.Store,
+        timeout: timedelta = TIMEOUT,
+    ):
+        self.rank = rank
+        self.size = size
+        self.store = store
+        self.process_group = dist.ProcessGroupGloo(store, rank, size, timeout)
+        self.processes: List[mp.Process] = []
+
+    @classmethod
+    def start(
+        cls,
+        size: int,
+        target: Callable,
+        args: Sequence = (),
+        timeout: timedelta = TIMEOUT,
+    ) -> "DataParallelGroup":
+        """
+        Start ranks 1 to `size - 1` as `target(rank, size, port, *args)` in
+        new processes, and join the group as rank 0. The target should join
+        with `DataParallelGroup.join(rank, size, port)`.
+        """
+        store = dist.TCPStore(
+            "127.0.0.1",
+            0,
+            size,
+            is_master=True,
+            timeout=timeout,
+            wait_for_workers=False,
+        )
+        context = mp.get_context("spawn")
+        processes = []
+        for rank in range(1, size):
+            process = context.Process(
+                target=target,
+                args=(rank, size, store.port, *args),
+                daemon=True,
+            )
+            process.start()
+            processes.append(process)
+
+        try:
+            group = cls(0, size, store, timeout)
+        except Exception:
+            for process in processes:
+                process.terminate()
+            raise
+        group.processes = processes
+        return group
+
+    @classmethod
+    def join(
+        cls,
+        rank: int,
+        size: int,
+        port: int,
+        timeout: timedelta = TIMEOUT,
+    ) -> "DataParallelGroup":
+        """
+        Join the group started by rank 0 on `port`.
+        """
+        store = dist.TCPStore("127.0.0.1", port, size, is_master=False, timeout=timeout)
+        return cls(rank, size, store, timeout)
+
+    def close(self, timeout: float = 30):
+        """
+        Wait for the ranks started by this process to exit, and stop those
+        still running after `timeout` seconds, e.g. after rank 0 failed.
+        """
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.processes = []
+
+    def broadcast_flag(self, flag: bool = False) -> bool:
+        """
+        Send `flag` from rank 0 to all ranks and return it.
+        """
+        tensor = torch.tensor([int(flag)])
+        self.process_group.broadcast(tensor, 0).wait()
+        return bool(tensor.item())
+
+    def all_reduce_(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Sum `tensor` over the ranks in place.
+        """
+        self.process_group.allreduce([tensor]).wait()
+        return tensor
+
+    def shard(self, batches: Iterable) -> Iterator[Optional[object]]:
+        """
+        Yield every `size`-th batch starting from the rank. Ranks left without
+        a batch in the last round yield None, so that all ranks take the same
+        number of steps. The batches must be the same on all ranks.
+        """
+        num_batches = 0
+        num_local = 0
+        for i, batch in enumerate(batches):
+            num_batches += 1
+            if i % self.size == self.rank:
+                num_local += 1
+                yield batch
+        for _ in range(-(-num_batches // self.size) - num_local):
+            yield None
+
+    def average_gradients(self, models: List[nn.Module], weight: float):
+        """
+        Replace the gradients by their weighted average over the ranks.
+
+        Each rank backpropagates its loss multiplied by `weight`, the total
+        weight of its batch, and passes 0 when it has no batch. The sums of
+        the gradients and of the weights are reduced in one collective.
+        """
+        params = [
+            param
+            for model in models
+            for param in model.parameters()
+            if param.requires_grad
+        ]
+        flat = torch.cat(
+            [
+                (
+                    param.grad.flatten()
+                    if param.grad is not None
+                    else torch.zeros(param.numel(), device=param.device)
+                )
+                for param in params
+            ]
+            + [torch.tensor([weight], device=params[0].device)]
+        )
+        self.all_reduce_(flat)
+        flat /= flat[-1].item()
+
+        offset = 0
+        for param in params:
+            grad = flat[offset : offset + param.numel()].view_as(param)
+            if param.grad is None:
+                param.grad = grad.clone()
+            else:
+                param.grad.copy_(grad)
+            offset += param.numel()
@@ -1,37 +1,56 @@
+import copy
+import os
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from threading import Semaphore
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 from uuid import UUID, uuid4
 
 import pandas as pd
 import torch
 from celery.contrib.abortable import AbortableAsyncResult, AbortableTask
 from celery.result import allow_join_result
-from core.algorithms import CNN_PHMM_VAE, profile_hmm_vae_loss
+from core.algorithms import CNN_PHMM_VAE, profile_hmm_band_cutoff, profile_hmm_vae_loss
+from core.checkpoints import CheckpointStore, CheckpointWriter, read_checkpoint
 from core.db import (
     ChildJob,
+    JobType,
     ParentJob,
     RaptGenParams,
     SequenceData,
     SequenceEmbeddings,
     TrainingLosses,
+    ViewerVAE,
     get_db_session,
 )
+from core.distributed import DataParallelGroup
 from core.preprocessing import ID_encode
+from core.resources import CoreScheduler, bind_threads, split_cores
 from core.schemas import RaptGenTrainingParams
+from core.train import LengthBucketBatchSampler, sequence_lengths, trim_padding
+from sqlalchemy import func
 from sqlalchemy.orm import Session, scoped_session
 from tasks import celery
 from torch.utils.data import DataLoader, TensorDataset
 
-# Use a semaphore to limit the number of concurrent jobs
+# Limit the number of concurrent jobs. CPU jobs are admitted within the core
+# budget of the node, each with its own share of the cores.
+cpu_scheduler = CoreScheduler(
+    threads_per_job=(
+        int(os.environ["RAPTGEN_CPU_THREADS_PER_JOB"])
+        if "RAPTGEN_CPU_THREADS_PER_JOB" in os.environ
+        else None
+    ),
+    pin=os.environ.get("RAPTGEN_CPU_AFFINITY", "0") == "1",
+)
 if torch.cuda.is_available():
     semaphore_dict = {
-        "CPU": Semaphore(value=2),
+        "CPU": cpu_scheduler,
     } | {f"CUDA:{i}": Semaphore(value=2) for i in range(torch.cuda.device_count())}
 else:
     semaphore_dict = {
-        "CPU": Semaphore(value=2),
+        "CPU": cpu_scheduler,
     }
 
 
@@ -44,11 +63,13 @@ class ChildJobTask(AbortableTask):
         if session is None:
             raise ValueError("ChildJobTask: Database session is not found.")
 
-        job = session.query(ChildJob).filter(ChildJob.worker_uuid == task_id).first()
-        if job is None:
+        # an ensemble task runs several child jobs
+        jobs = session.query(ChildJob).filter(ChildJob.worker_uuid == task_id).all()
+        if len(jobs) == 0:
             raise ValueError(
                 f"ChildJobTask: Task {task_id} does not exist on the database."
             )
+        job = jobs[0]
         parent = (
             session.query(ParentJob).filter(ParentJob.uuid == job.parent_uuid).first()
         )
@@ -71,13 +92,14 @@ class ChildJobTask(AbortableTask):
                 f"ChildJobTask: Child job {subling.uuid} has status {subling.status}."
             )
 
-        job.datetime_laststop = int(time.time())  # type: ignore
+        for task_job in jobs:
+            task_job.datetime_laststop = int(time.time())  # type: ignore
 
         if any([subling.status in {"pending", "progress"} for subling in sublings]):
             parent.status = "progress"  # type: ignore
         elif any([subling.status in {"suspend"} for subling in sublings]):
             # 2 cases:
-            if job.status == "suspend":  # type: ignore
+            if any([task_job.status == "suspend" for task_job in jobs]):  # type: ignore
                 # 1. aborted this task and others are already finished
                 parent.status = "suspend"  # type: ignore
             else:
@@ -95,12 +117,16 @@ class ChildJobTask(AbortableTask):
         if session is None:
             raise ValueError("ChildJobTask: Database session is not found.")
 
-        job = session.query(ChildJob).filter(ChildJob.worker_uuid == task_id).first()
-        if job is None:
+        jobs = session.query(ChildJob).filter(ChildJob.worker_uuid == task_id).all()
+        if len(jobs) == 0:
             raise ValueError(
                 f"ChildJobTask: Task {task_id} does not exist on the database."
             )
-        job.status = "failure"  # type: ignore
+        job = jobs[0]
+        for task_job in jobs:
+            # child jobs of an ensemble may have finished before the failure
+            if task_job.status != "success":  # type: ignore
+                task_job.status = "failure"  # type: ignore
 
         parent = (
             session.query(ParentJob).filter(ParentJob.uuid == job.parent_uuid).first()
@@ -119,13 +145,14 @@ class ChildJobTask(AbortableTask):
                 f"ChildJobTask: Parent job {job.parent_uuid} does not have any child jobs."
             )
 
-        job.datetime_laststop = int(time.time())  # type: ignore
+        for task_job in jobs:
+            task_job.datetime_laststop = int(time.time())  # type: ignore
 
         if any([subling.status in {"pending", "progress"} for subling in sublings]):
             parent.status = "progress"  # type: ignore
         elif any([subling.status in {"suspend"} for subling in sublings]):
             # 2 cases:
-            if job.status == "suspend":  # type: ignore
+            if any([task_job.status == "suspend" for task_job in jobs]):  # type: ignore
                 # 1. aborted this task and others are already finished
                 parent.status = "suspend"  # type: ignore
             else:
@@ -136,7 +163,9 @@ class ChildJobTask(AbortableTask):
         else:
             parent.status = "failure"  # type: ignore
 
-        job.error_msg = str(exc)  # type: ignore
+        for task_job in jobs:
+            if task_job.status == "failure":  # type: ignore
+                task_job.error_msg = str(exc)  # type: ignore
         session.commit()
 
     @classmethod
@@ -166,65 +195,254 @@ class ChildJobTask(AbortableTask):
         if session is None:
             raise ValueError("ChildJobTask: Database session is not found.")
 
-        child_uuid = kwargs["child_uuid"]
-        job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
-        if job is None:
-            raise ValueError(
-                f"ChildJobTask: ChildJob {child_uuid} does not exist on the database."
-            )
-
+        # an ensemble task runs several child jobs
+        child_uuids = kwargs.get("child_uuids") or [kwargs["child_uuid"]]
         uuid = str(uuid4())
-        job.worker_uuid = uuid  # type: ignore
+        for child_uuid in child_uuids:
+            job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
+            if job is None:
+                raise ValueError(
+                    f"ChildJobTask: ChildJob {child_uuid} does not exist on the database."
+                )
+            job.worker_uuid = uuid  # type: ignore
         session.commit()
 
-        print(f"ChildJobTask: Running task {uuid} for child job {child_uuid}.")
+        print(
+            f"ChildJobTask: Running task {uuid} for child job {', '.join(child_uuids)}."
+        )
 
         return self.apply_async(args, kwargs, task_id=uuid)
 
 
-@celery.task(bind=True, base=ChildJobTask)
-def run_job_raptgen(
-    self: ChildJobTask,
-    child_uuid: str,
-    is_resume: bool = False,
-    database_url: str = "postgresql+psycopg2://postgres:postgres@db:5432/raptgen",
-):
+def _embed_dataloader(
+    model: CNN_PHMM_VAE, dataloader: DataLoader, device: torch.device
+) -> torch.Tensor:
     """
-    Run the RaptGen model.
+    Compute the latent means of all sequences in the dataloader, in dataset order.
+    """
+    mus_list = []
+    indices_list = []
+    with torch.no_grad():
+        for batch, *_, indices in dataloader:
+            _, mus, _ = model(batch.to(device))
+            mus_list.append(mus)
+            indices_list.append(indices)
+    return _restore_order(mus_list, indices_list)
 
-    Parameters
-    ----------
-    child_uuid : str
-        child job identifier to run or resume
-    is_resume : bool
-        flag to indicate if the job is resumed
-    database_url : str
-        database URL to connect
+
+def _restore_order(values_list: list, indices_list: list) -> torch.Tensor:
     """
-    # get the database session
-    session = get_db_session(database_url).__next__()
+    Concatenate the per-batch values and sort them back into dataset order.
+    """
+    if len(values_list) == 0:
+        # an empty split has no batches. the latent space is 2-dimensional
+        return torch.empty((0, 2))
+    values = torch.cat(values_list, dim=0).cpu()
+    restored = torch.empty_like(values)
+    restored[torch.cat(indices_list)] = values
+    return restored
 
-    child_job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
-    if child_job is None:
+
+def _duplicate_weights(duplicates: pd.Series, jobtype: JobType) -> torch.Tensor:
+    """
+    Per-sequence loss weights of the unique sequences for the job type.
+
+    RaptGen weights every unique sequence equally, RaptGen-Freq by its number of
+    duplicates and RaptGen-Logfreq by 1 + log(duplicates).
+    """
+    counts = torch.tensor(duplicates.to_list(), dtype=torch.float32)
+    if jobtype == JobType.RaptGenFreq:
+        return counts
+    elif jobtype == JobType.RaptGenLogfreq:
+        return 1 + torch.log(counts)
+    return torch.ones_like(counts)
+
+
+def _is_halving_rung(epochs_finished: int, min_epochs: int, rate: int) -> bool:
+    """
+    Whether successive halving compares the child jobs after this epoch.
+
+    The rungs are at `min_epochs`, `min_epochs * rate`, `min_epochs * rate**2`, ...
+    """
+    rung = min_epochs
+    while rung < epochs_finished:
+        rung *= rate
+    return rung == epochs_finished
+
+
+def _halving_survivors(losses: Dict[str, float], rate: int) -> Set[str]:
+    """
+    Child jobs kept at a rung: the best `1 / rate` of the child jobs that
+    reached it, ranked by their minimum test loss. All of them are kept while
+    fewer than `rate` child jobs have reached the rung, since the rest of the
+    parent job may still be queued.
+    """
+    keep = len(losses) // rate
+    if keep == 0:
+        return set(losses)
+    cutoff = sorted(losses.values())[keep - 1]
+    return {uuid for uuid, loss in losses.items() if loss <= cutoff}
+
+
+def _rung_losses(session: Session, parent_uuid: str, rung: int) -> Dict[str, float]:
+    """
+    Minimum test loss up to the rung of each child job of the parent job that
+    has finished `rung` epochs.
+    """
+    rows = (
+        session.query(TrainingLosses.child_uuid, func.min(TrainingLosses.test_loss))
+        .join(ChildJob, ChildJob.uuid == TrainingLosses.child_uuid)
+        .filter(ChildJob.parent_uuid == parent_uuid, TrainingLosses.epoch < rung)
+        .group_by(TrainingLosses.child_uuid)
+        .having(func.max(TrainingLosses.epoch) == rung - 1)
+        .all()
+    )
+    return {child_uuid: loss for child_uuid, loss in rows}
+
+
+def delete_unreferenced_checkpoints(session: Session, refs: Iterable[Optional[str]]):
+    """
+    Delete the checkpoint files of `refs` that no child job refers to.
+    Identical trainings share the checkpoint files, so a replaced or deleted
+    reference may still be used by another child job.
+    """
+    unreferenced = set(refs)
+    unreferenced.discard(None)
+    for column in (ChildJob.current_checkpoint_ref, ChildJob.optimal_checkpoint_ref):
+        for (ref,) in session.query(column).filter(column.in_(list(unreferenced))):
+            unreferenced.discard(ref)
+    store = CheckpointStore()
+    for ref in unreferenced:
+        store.delete(ref)  # type: ignore
+
+
+def _reset_progress(session: Session, child_job: ChildJob):
+    """
+    Forget the finished epochs of a child job that starts over.
+    """
+    session.query(TrainingLosses).filter(
+        TrainingLosses.child_uuid == child_job.uuid
+    ).delete()
+    replaced_refs = [child_job.current_checkpoint_ref, child_job.optimal_checkpoint_ref]
+    child_job.epochs_current = 0  # type: ignore
+    child_job.minimum_NLL = float("inf")  # type: ignore
+    child_job.current_checkpoint_ref = None  # type: ignore
+    child_job.optimal_checkpoint_ref = None  # type: ignore
+    child_job.current_checkpoint = None  # type: ignore
+    child_job.optimal_checkpoint = None  # type: ignore
+    session.commit()
+    delete_unreferenced_checkpoints(session, replaced_refs)
+
+
+def load_warm_start_checkpoint(
+    session: Session, training_params: Union[RaptGenParams, RaptGenTrainingParams]
+) -> Optional[dict]:
+    """
+    Load the checkpoint a new child job is warm started from: the published
+    VAE model `warm_start_vae_uuid` or the optimal checkpoint of the child job
+    `warm_start_child_uuid`. Returns None to train from scratch.
+
+    Raises ValueError if the source does not exist, has no checkpoint, or its
+    pHMM length differs from `model_length`.
+    """
+    if training_params.warm_start_vae_uuid is not None:
+        vae = (
+            session.query(ViewerVAE)
+            .filter(ViewerVAE.uuid == training_params.warm_start_vae_uuid)
+            .first()
+        )
+        if vae is None:
+            raise ValueError(
+                f"VAE model {training_params.warm_start_vae_uuid} does not exist."
+            )
+        model_length = vae.phmm_length
+        checkpoint_binary = vae.checkpoint
+    elif training_params.warm_start_child_uuid is not None:
+        child_job = (
+            session.query(ChildJob)
+            .filter(ChildJob.uuid == training_params.warm_start_child_uuid)
+            .first()
+        )
+        source_params = (
+            session.query(RaptGenParams)
+            .filter(RaptGenParams.child_uuid == training_params.warm_start_child_uuid)
+            .first()
+        )
+        if child_job is None or source_params is None:
+            raise ValueError(
+                f"Child job {training_params.warm_start_child_uuid} does not exist."
+            )
+        model_length = source_params.model_length
+        checkpoint_binary = read_checkpoint(
+            child_job.optimal_checkpoint_ref,  # type: ignore
+            child_job.optimal_checkpoint,  # type: ignore
+        )
+    else:
+        return None
+
+    if checkpoint_binary is None:
+        raise ValueError("The warm start source has no checkpoint.")
+    if model_length != training_params.model_length:
         raise ValueError(
-            f"Child job {child_uuid} does not exist. Initialize the job first."
+            f"The pHMM length of the warm start source is {model_length}, "
+            f"not {training_params.model_length}."
         )
+    with BytesIO(checkpoint_binary) as f:  # type: ignore
+        return torch.load(f, map_location="cpu")
 
-    training_params = (
-        session.query(RaptGenParams)
-        .filter(RaptGenParams.child_uuid == child_uuid)
-        .first()
+
+def _write_embeddings(
+    session: Session,
+    child_uuid: str,
+    train_df: pd.DataFrame,
+    test_df: pd.DataFrame,
+    train_coords: torch.Tensor,
+    test_coords: torch.Tensor,
+):
+    """
+    Replace the SequenceEmbeddings rows of the child job with the given coordinates.
+    """
+    train_df = train_df.assign(
+        coord_x=train_coords[:, 0].numpy().tolist(),
+        coord_y=train_coords[:, 1].numpy().tolist(),
+    )
+    test_df = test_df.assign(
+        coord_x=test_coords[:, 0].numpy().tolist(),
+        coord_y=test_coords[:, 1].numpy().tolist(),
     )
 
-    print(f"Waiting for the semaphore for child job {child_uuid}.")
+    embeddings_df = pd.concat([train_df, test_df], ignore_index=True)
+    embeddings_df = embeddings_df.drop(columns=["encoded_id", "is_training_data"])
+    embeddings_df["child_uuid"] = child_uuid
+    embeddings_dict = embeddings_df.to_dict(orient="records")
+    session.query(SequenceEmbeddings).filter(
+        SequenceEmbeddings.child_uuid == child_uuid
+    ).delete()
+    session.commit()
+    session.bulk_insert_mappings(SequenceEmbeddings, embeddings_dict)  # type: ignore
 
-    with semaphore_dict[training_params.device]:  # type: ignore
 
-        print(f"Running RaptGen model for child job {child_uuid}.")
+def _replica_seed(seed_value: int, child_job: ChildJob) -> int:
+    """
+    Seed of the initialization and the batches of a child job. The reiterations
+    and configurations of a parent job share the seed of the training
+    parameters but not their models and batches.
+    """
+    return seed_value + child_job.id  # type: ignore
 
-        # update the status of the child job to progress
-        ChildJobTask.update_status_to_progress(session, child_uuid, self.request.id)  # type: ignore
 
+class _TrainingData:
+    """
+    Sequences of a parent job, split and batched for training.
+    Shared by all the child jobs trained together.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        child_job: ChildJob,
+        training_params: RaptGenParams,
+    ):
         # process the data from SequenceData
         sequence_records = (
             session.query(SequenceData)
@@ -252,231 +470,928 @@ def run_job_raptgen(
         sequence_records_df = sequence_records_df.sample(
             frac=1, random_state=training_params.seed_value  # type: ignore
         )
-        train_df = sequence_records_df[sequence_records_df["is_training_data"]]
-        test_df = sequence_records_df[~sequence_records_df["is_training_data"]]
+        self.train_df = sequence_records_df[sequence_records_df["is_training_data"]]
+        self.test_df = sequence_records_df[~sequence_records_df["is_training_data"]]
 
-        train_ids_ls = train_df["encoded_id"].to_list()
+        train_ids_ls = self.train_df["encoded_id"].to_list()
         train_ids = torch.tensor(
             train_ids_ls, device="cpu"
         )  # avoid deadlock on GPU by sending to CPU
-        train_dataloader = DataLoader(
-            TensorDataset(train_ids),
-            batch_size=min(len(train_df), 512),
-            shuffle=False,
+        self.train_weights = _duplicate_weights(self.train_df["duplicate"], child_job.jobtype)  # type: ignore
+        self.train_dataset = TensorDataset(
+            train_ids, self.train_weights, torch.arange(len(self.train_df))
         )
-        test_ids_ls = test_df["encoded_id"].to_list()
+        self.train_lengths: List[int] = sequence_lengths(train_ids).tolist()
+        self.train_batch_size = min(len(self.train_df), 512)
+        self.seed_value: int = training_params.seed_value  # type: ignore
+        self._replica_dataloaders: Dict[str, DataLoader] = dict()
+        # unshuffled batches of the training sequences, to embed them
+        self.train_dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=LengthBucketBatchSampler(
+                self.train_lengths, batch_size=self.train_batch_size, shuffle=False
+            ),
+        )
+        test_ids_ls = self.test_df["encoded_id"].to_list()
         test_ids = torch.tensor(
             test_ids_ls, device="cpu"
         )  # avoid deadlock on GPU by sending to CPU
-        test_dataloader = DataLoader(
-            TensorDataset(test_ids),
-            batch_size=min(len(train_df), 512),
-            shuffle=False,
+        self.test_weights = _duplicate_weights(self.test_df["duplicate"], child_job.jobtype)  # type: ignore
+        self.test_dataloader = DataLoader(
+            TensorDataset(test_ids, self.test_weights, torch.arange(len(self.test_df))),
+            batch_sampler=LengthBucketBatchSampler(
+                sequence_lengths(test_ids).tolist(),
+                batch_size=min(len(self.train_df), 512),
+                shuffle=False,
+            ),
+        )
+
+        # RaptGen averages the loss over the unique sequences as is
+        self.is_weighted: bool = child_job.jobtype != JobType.RaptGen  # type: ignore
+
+    def replica_dataloader(self, child_job: ChildJob) -> DataLoader:
+        """
+        Shuffled training batches of the child job.
+
+        The sequences of the same length are batched together, so that every
+        batch runs the pHMM dynamic programming once at its true length. Each
+        child job shuffles the sequences with its own seed, while the order of
+        the lengths of the batches follows the seed of the training parameters.
+        The child jobs trained together thus see different batches of the same
+        lengths, and their pHMM losses still run in one pass per batch.
+        """
+        if child_job.uuid not in self._replica_dataloaders:
+            self._replica_dataloaders[child_job.uuid] = DataLoader(  # type: ignore
+                self.train_dataset,
+                batch_sampler=LengthBucketBatchSampler(
+                    self.train_lengths,
+                    batch_size=self.train_batch_size,
+                    shuffle=True,
+                    generator=torch.Generator().manual_seed(
+                        _replica_seed(self.seed_value, child_job)
+                    ),
+                    order_generator=torch.Generator().manual_seed(self.seed_value),
+                ),
+            )
+        return self._replica_dataloaders[child_job.uuid]  # type: ignore
+
+
+class _Replica:
+    """
+    Model, optimizer and early stopping state of a child job being trained.
+    """
+
+    def __init__(self, child_job: ChildJob, training_params: RaptGenParams):
+        self.child_job = child_job
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(_replica_seed(training_params.seed_value, child_job))  # type: ignore
+            self.model = CNN_PHMM_VAE(
+                motif_len=training_params.model_length,  # type: ignore
+                embed_size=2,
+            )
+        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=1e-3)
+
+        # frozen layers keep the weights they are warm started with. their
+        # batch normalization statistics still follow the new dataset.
+        if training_params.frozen_encoder_layers:
+            encoder = self.model.encoder
+            for module in [encoder.embed, *encoder.resnet[: training_params.frozen_encoder_layers]]:  # type: ignore
+                module.requires_grad_(False)
+
+        self.patience: float = 0
+        self.min_loss: float = float("inf")
+        # number of finished epochs in the latest submitted checkpoint
+        self.checkpoint_epoch: int = 0
+        # checkpoints submitted to the writer but not referenced in the database yet
+        self.pending_checkpoints: dict = {"current": None, "optimal": None}
+        # every submitted checkpoint, until its file is kept or deleted. a pending
+        # checkpoint superseded before it was written is never referenced
+        self.submitted_checkpoints: List[Future] = []
+        # finished epochs of the model the intermediate embeddings were computed with
+        self.embeddings_epoch: int = 0
+
+    def state_dict(self) -> dict:
+        """
+        Model and optimizer state to checkpoint.
+        """
+        return {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+        }
+
+    def warm_start(self, checkpoint: dict, load_optimizer: bool):
+        """
+        Initialize the model, and optionally the optimizer, from a checkpoint of
+        another training.
+        """
+        self.model.load_state_dict(checkpoint["model"])
+        if load_optimizer and "optimizer" in checkpoint:
+            self.optimizer.load_state_dict(checkpoint["optimizer"])
+
+    def to(self, device: torch.device):
+        self.model.to(device)
+        self.model.train()
+
+        for state in self.optimizer.state.values():
+            for k, v in state.items():
+                if isinstance(v, torch.Tensor):
+                    state[k] = v.to(device)
+
+
+def _train_epoch(
+    replicas: List[_Replica],
+    data: _TrainingData,
+    training_params: RaptGenParams,
+    epoch: int,
+    device_t: torch.device,
+    group: Optional[DataParallelGroup] = None,
+) -> torch.Tensor:
+    """
+    Train the replicas for one epoch, each on its own batches of the same
+    lengths (`_TrainingData.replica_dataloader`).
+
+    The models and optimizers of the replicas run one after another: stacking
+    their parameters with `torch.func.vmap` was slower than this loop for the
+    CNN encoder, and the batch normalization statistics cannot be updated in
+    place under vmap. Only the pHMM losses, which dominate an epoch, run in
+    one dynamic programming pass per batch.
+
+    With a data-parallel group, the rank trains on its share of the batches
+    and the gradients and losses are reduced over the ranks.
+
+    Returns the mean training loss of each replica.
+    """
+    if epoch < training_params.beta_duration:  # type: ignore
+        beta: float = epoch / training_params.beta_duration  # type: ignore
+    else:
+        beta: float = 1
+    use_force_matching: bool = epoch < training_params.match_forcing_duration  # type: ignore
+
+    num_replicas = len(replicas)
+    train_loss = torch.zeros(num_replicas, dtype=torch.float64)
+
+    # the replicas take their i-th batches together. the batch sizes only depend
+    # on the number of sequences, so the batches of a pass have the same size
+    batches = zip(*[data.replica_dataloader(replica.child_job) for replica in replicas])
+    if group is not None:
+        batches = group.shard(batches)
+    for shard in batches:
+        for replica in replicas:
+            replica.optimizer.zero_grad()
+
+        weight_sums = torch.zeros(num_replicas, dtype=torch.float64)
+        if shard is not None:
+            replica_batches = [batch.to(device_t) for batch, _, _ in shard]
+            replica_weights = [
+                batch_weights.to(device_t) for _, batch_weights, _ in shard
+            ]
+            weight_sums = torch.tensor(
+                [batch_weights.sum().item() for batch_weights in replica_weights],
+                dtype=torch.float64,
+            )
+
+            # run the replicas one by one and their pHMM losses in one pass
+            outputs = [
+                replica.model(batch)
+                for replica, batch in zip(replicas, replica_batches)
+            ]
+
+            losses = profile_hmm_vae_loss(
+                batch_input=trim_padding(torch.cat(replica_batches)),
+                transition_probs=torch.cat([output[0][0] for output in outputs]),
+                emission_probs=torch.cat([output[0][1] for output in outputs]),
+                mus=torch.cat([output[1] for output in outputs]),
+                logvars=torch.cat([output[2] for output in outputs]),
+                beta=beta,
+                force_matching=use_force_matching,
+                match_cost=(
+                    1
+                    + training_params.match_cost  # type: ignore
+                    * (1 - epoch / training_params.match_forcing_duration)  # type: ignore
+                    if use_force_matching
+                    else 1
+                ),
+                band_width=training_params.band_width,  # type: ignore
+                weights=(torch.cat(replica_weights) if data.is_weighted else None),
+                replicas=num_replicas,
+            )
+
+            # the replicas share no parameters, so the gradient of the sum is the
+            # gradient of each replica's loss
+            if group is None:
+                losses.sum().backward()
+            else:
+                (losses * weight_sums.to(losses)).sum().backward()
+
+            train_loss += losses.detach().cpu() * weight_sums
+            # 損失関数はバッチ内で（重み付き）平均している。重みの総和をかけてバッチ毎の総損失量を計算。
+
+        if group is not None:
+            # 各ランクのバッチを合わせた（重み付き）平均の勾配にする。データ並列では replica は 1 つ。
+            group.average_gradients(
+                [replica.model for replica in replicas], weight_sums.sum().item()
+            )
+
+        for replica in replicas:
+            replica.optimizer.step()
+
+    if group is not None:
+        group.all_reduce_(train_loss)
+    train_loss /= data.train_weights.sum().item()
+    # train_loss は dataset を構成する塩基配列（各データ点）の平均損失値になる。
+
+    return train_loss
+
+
+@torch.no_grad()
+def _test_epoch(
+    models: List[CNN_PHMM_VAE],
+    data: _TrainingData,
+    training_params: RaptGenParams,
+    device_t: torch.device,
+    group: Optional[DataParallelGroup] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Evaluate the models on the test set.
+
+    With a data-parallel group, the rank evaluates its share of the batches
+    and the sums are reduced over the ranks.
+
+    Returns the total reconstruction loss, the total KL divergence and the
+    likelihood cut off by the band of each model.
+    """
+    num_replicas = len(models)
+    test_kld = torch.zeros(num_replicas, dtype=torch.float64)
+    test_ce = torch.zeros(num_replicas, dtype=torch.float64)
+    test_band_cutoff = torch.zeros(num_replicas, dtype=torch.float64)
+
+    batches = (
+        data.test_dataloader if group is None else group.shard(data.test_dataloader)
+    )
+    for shard in batches:
+        if shard is None:
+            continue
+        batch, batch_weights, _ = shard
+        batch = batch.to(device_t)
+        batch_weights = batch_weights.to(device_t)
+
+        outputs = [model(batch) for model in models]
+
+        transition_probs = torch.cat([output[0][0] for output in outputs])
+        emission_probs = torch.cat([output[0][1] for output in outputs])
+        ce, kld = profile_hmm_vae_loss(
+            batch_input=trim_padding(batch).repeat(num_replicas, 1),
+            transition_probs=transition_probs,
+            emission_probs=emission_probs,
+            mus=torch.cat([output[1] for output in outputs]),
+            logvars=torch.cat([output[2] for output in outputs]),
+            split_ce_kld=True,
+            engine="inference",
+            weights=(batch_weights.repeat(num_replicas) if data.is_weighted else None),
+            replicas=num_replicas,
         )
+        test_ce += ce.cpu() * batch_weights.sum().item()
+        test_kld += kld.cpu() * batch_weights.sum().item()
+
+        # the test loss is always evaluated on the full table.
+        # report the probability mass the training band cuts off.
+        if training_params.band_width is not None:
+            test_band_cutoff += (
+                (
+                    profile_hmm_band_cutoff(
+                        transition_probs=transition_probs,
+                        emission_probs=emission_probs,
+                        batch_input=trim_padding(batch).repeat(num_replicas, 1),
+                        band_width=training_params.band_width,  # type: ignore
+                    ).reshape(num_replicas, -1)
+                    * batch_weights
+                )
+                .sum(dim=1)
+                .cpu()
+            )
+
+    if group is not None:
+        sums = group.all_reduce_(torch.stack([test_ce, test_kld, test_band_cutoff]))
+        test_ce, test_kld, test_band_cutoff = sums.unbind()
+
+    return test_ce, test_kld, test_band_cutoff
+
+
+def _train_replicas(
+    task: ChildJobTask,
+    session: Session,
+    replicas: List[_Replica],
+    data: _TrainingData,
+    training_params: RaptGenParams,
+    device_t: torch.device,
+    start_epoch: int,
+    group: Optional[DataParallelGroup] = None,
+) -> bool:
+    """
+    Train the child jobs of the replicas from `start_epoch` until each of them
+    finishes or stops early. The replicas see the same batches; their pHMM
+    losses are computed in one dynamic programming pass per batch.
 
-        # prepare the model
-        model = CNN_PHMM_VAE(
+    With a data-parallel group, this is rank 0: it trains on its share of the
+    batches, tells the other ranks when to stop, and records the losses,
+    checkpoints and embeddings alone.
+
+    Returns False if the task is aborted, True otherwise.
+    """
+    # checkpoints are written to the checkpoint store by a background thread.
+    # the database only keeps their references, set once they are written.
+    checkpoint_writer = CheckpointWriter(CheckpointStore())
+    checkpoint_interval: int = training_params.checkpoint_interval or 1  # type: ignore
+
+    def submit_checkpoint(
+        replica: _Replica, epochs_finished: int, state: Optional[dict] = None
+    ) -> Future:
+        # `state` is the model and optimizer state of the epoch if the replica
+        # has trained further since
+        replica.checkpoint_epoch = epochs_finished
+        if state is None:
+            state = replica.state_dict()
+        future = checkpoint_writer.submit(state | {"epoch": epochs_finished})
+        replica.pending_checkpoints["current"] = future
+        replica.submitted_checkpoints.append(future)
+        return future
+
+    def update_checkpoint_refs(replica: _Replica, wait: bool):
+        replaced_refs = []
+        for kind, future in replica.pending_checkpoints.items():
+            if future is not None and (wait or future.done()):
+                replaced_refs.append(
+                    getattr(replica.child_job, f"{kind}_checkpoint_ref")
+                )
+                setattr(replica.child_job, f"{kind}_checkpoint_ref", future.result())
+                replica.pending_checkpoints[kind] = None
+        written = [
+            future for future in replica.submitted_checkpoints if wait or future.done()
+        ]
+        replica.submitted_checkpoints = [
+            future for future in replica.submitted_checkpoints if future not in written
+        ]
+        # the replaced and superseded checkpoint files are deleted once the new
+        # references are committed, unless this or another child job refers to them
+        if replaced_refs or written:
+            session.commit()
+            delete_unreferenced_checkpoints(
+                session, replaced_refs + [future.result() for future in written]
+            )
+
+    def write_embeddings(replica: _Replica, model_state: Optional[dict] = None):
+        # embed the whole dataset in evaluation mode with the model state, by
+        # default the one of the optimal checkpoint
+        if model_state is None:
+            optimal_checkpoint_binary = read_checkpoint(
+                replica.child_job.optimal_checkpoint_ref,  # type: ignore
+                replica.child_job.optimal_checkpoint,  # type: ignore
+            )
+            if optimal_checkpoint_binary is None:
+                return
+            with BytesIO(optimal_checkpoint_binary) as f:
+                model_state = torch.load(f, map_location=device_t)["model"]
+        optimal_model = CNN_PHMM_VAE(
             motif_len=training_params.model_length,  # type: ignore
             embed_size=2,
         )
-        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        optimal_model.load_state_dict(model_state)  # type: ignore
+        optimal_model.to(device_t)
+        optimal_model.eval()
+        _write_embeddings(
+            session,
+            replica.child_job.uuid,  # type: ignore
+            data.train_df,
+            data.test_df,
+            _embed_dataloader(optimal_model, data.train_dataloader, device_t),
+            _embed_dataloader(optimal_model, data.test_dataloader, device_t),
+        )
+
+    def finish(
+        replica: _Replica,
+        epochs_finished: int,
+        status: str,
+        state: Optional[dict] = None,
+    ):
+        if epochs_finished > replica.checkpoint_epoch:
+            submit_checkpoint(replica, epochs_finished, state)
+        update_checkpoint_refs(replica, wait=True)
+        write_embeddings(replica)
+        replica.child_job.status = status  # type: ignore
+        session.commit()
+
+    def record_epoch(
+        epoch: int,
+        epoch_replicas: List[_Replica],
+        train_loss: torch.Tensor,
+        test_result: tuple,
+        states: List[Optional[dict]],
+    ):
+        # record the losses of the epoch, update the checkpoints and finish the
+        # replicas that stop after it
+        test_ce, test_kld, test_band_cutoff = test_result
+        test_loss = test_kld + test_ce
+
+        if torch.isnan(test_loss).any():
+            raise ValueError("Test loss is not a number.")
+
+        # an empty test split has no batches to evaluate. the optimal checkpoint
+        # is then selected on the training loss instead
+        selection_loss = test_loss if len(data.test_df) > 0 else train_loss
+
+        for i, replica in enumerate(epoch_replicas):
+            child_job = replica.child_job
+            session.add(
+                TrainingLosses(
+                    child_uuid=child_job.uuid,
+                    epoch=epoch,
+                    test_loss=test_loss[i].item(),
+                    test_recon=test_ce[i].item(),
+                    test_kld=test_kld[i].item(),
+                    train_loss=train_loss[i].item(),
+                )
+            )
+
+            # when the lowest test loss is found, update the optimal checkpoint and embeddings
+            if selection_loss[i].item() < replica.min_loss:
+                replica.min_loss = selection_loss[i].item()
+                child_job.minimum_NLL = replica.min_loss  # type: ignore
+
+                replica.patience = 0
+
+                # refresh the embeddings shown while training with the new optimal
+                # model, at most once per checkpoint interval. the embeddings of
+                # the final optimal checkpoint are written when the replica finishes.
+                if epoch + 1 - replica.embeddings_epoch >= checkpoint_interval:
+                    write_embeddings(
+                        replica,
+                        (
+                            states[i]["model"]  # type: ignore
+                            if states[i] is not None
+                            else replica.model.state_dict()
+                        ),
+                    )
+                    replica.embeddings_epoch = epoch + 1
+
+                replica.pending_checkpoints["optimal"] = submit_checkpoint(
+                    replica, epoch + 1, states[i]
+                )
+            elif (epoch + 1) % checkpoint_interval == 0:
+                submit_checkpoint(replica, epoch + 1, states[i])
+            update_checkpoint_refs(replica, wait=False)
+
+            prefix = f"Child job {child_job.id}, " if len(replicas) > 1 else ""
+            print(
+                f"{prefix}Epoch {epoch + 1}: Train Loss {train_loss[i].item()}, Test Loss {test_loss[i].item()}"
+            )
+            if training_params.band_width is not None:
+                print(
+                    f"{prefix}Epoch {epoch + 1}: Band width {training_params.band_width} cuts off "
+                    f"{test_band_cutoff[i].item() / max(data.test_weights.sum().item(), 1):.3%} of the test likelihood on average"  # type: ignore
+                )
+
+            # update the child job entry
+            child_job.epochs_current = epoch + 1  # type: ignore
+
+        session.commit()
+
+        # early stopping
+        stopped = [
+            replica
+            for replica in epoch_replicas
+            if replica.patience >= training_params.early_stopping  # type: ignore
+        ]
+
+        # successive halving: at each rung, the child jobs ranked below the best
+        # 1 / rate of the parent job stop like early stopped ones. the child jobs
+        # of all the configurations of a sweep are ranked together, which is what
+        # prunes the configurations. the optimal checkpoint they have is kept, so
+        # publishing still picks the best child.
+        if training_params.halving_min_epochs is not None and _is_halving_rung(
+            epoch + 1,
+            training_params.halving_min_epochs,  # type: ignore
+            training_params.halving_rate or 3,  # type: ignore
+        ):
+            survivors = _halving_survivors(
+                _rung_losses(session, replicas[0].child_job.parent_uuid, epoch + 1),  # type: ignore
+                training_params.halving_rate or 3,  # type: ignore
+            )
+            for replica in epoch_replicas:
+                if replica.child_job.uuid not in survivors and replica not in stopped:
+                    prefix = (
+                        f"Child job {replica.child_job.id}, "
+                        if len(replicas) > 1
+                        else ""
+                    )
+                    print(f"{prefix}Stopped by successive halving at epoch {epoch + 1}")
+                    stopped.append(replica)
+
+        for i, replica in enumerate(epoch_replicas):
+            if replica in stopped:
+                finish(replica, epoch + 1, "success", states[i])
+                active.remove(replica)
+
+    # with pipelined validation, the test pass of an epoch runs on a snapshot of
+    # the replicas in a helper thread while the next epoch trains. its results,
+    # and the decision to stop, are applied one epoch late.
+    pipelined: bool = bool(training_params.pipelined_validation) and group is None
+    validation_executor = ThreadPoolExecutor(max_workers=1) if pipelined else None
+    pending: Optional[tuple] = None
+
+    def record_pending():
+        nonlocal pending
+        if pending is None:
+            return
+        epoch, epoch_replicas, train_loss, future, states = pending
+        pending = None
+        record_epoch(epoch, epoch_replicas, train_loss, future.result(), states)
+
+    for replica in replicas:
+        replica.checkpoint_epoch = start_epoch
+        replica.to(device_t)
+
+    active = list(replicas)
+    for epoch in range(start_epoch, training_params.epochs):  # type: ignore
+        if task.is_aborted():
+            if group is not None:
+                group.broadcast_flag(False)
+            record_pending()
+            for replica in active:
+                finish(replica, epoch, "suspend")
+            if validation_executor is not None:
+                validation_executor.shutdown()
+            checkpoint_writer.close()
+            return False
+        if group is not None:
+            group.broadcast_flag(True)
+
+        trained = list(active)
+        train_loss = _train_epoch(
+            trained, data, training_params, epoch, device_t, group
+        )
+        if torch.isnan(train_loss).any():
+            raise ValueError("Training loss is not a number.")
+
+        if validation_executor is None:
+            test_result = _test_epoch(
+                [replica.model for replica in trained],
+                data,
+                training_params,
+                device_t,
+                group,
+            )
+            record_epoch(epoch, trained, train_loss, test_result, [None] * len(trained))
+        else:
+            # the replicas stopped by the previous epoch discard this one
+            record_pending()
+            indices = [trained.index(replica) for replica in active]
+            train_loss = train_loss[indices]
+            models = [copy.deepcopy(replica.model) for replica in active]
+            states = [
+                {
+                    "model": model.state_dict(),
+                    "optimizer": copy.deepcopy(replica.optimizer.state_dict()),
+                }
+                for model, replica in zip(models, active)
+            ]
+            if len(active) > 0:
+                future = validation_executor.submit(
+                    _test_epoch, models, data, training_params, device_t
+                )
+                pending = (epoch, list(active), train_loss, future, states)
+
+        if len(active) == 0:
+            break
 
-        patience: float = 0
+    record_pending()
+    if validation_executor is not None:
+        validation_executor.shutdown()
+    if group is not None:
+        group.broadcast_flag(False)
+    for replica in active:
+        finish(replica, replica.child_job.epochs_current, "success")  # type: ignore
+    checkpoint_writer.close()
+
+    return True
+
+
+@celery.task(bind=True, base=ChildJobTask)
+def run_job_raptgen(
+    self: ChildJobTask,
+    child_uuid: str,
+    is_resume: bool = False,
+    database_url: str = "postgresql+psycopg2://postgres:postgres@db:5432/raptgen",
+):
+    """
+    Run the RaptGen model.
+
+    Parameters
+    ----------
+    child_uuid : str
+        child job identifier to run or resume
+    is_resume : bool
+        flag to indicate if the job is resumed
+    database_url : str
+        database URL to connect
+    """
+    # get the database session
+    session = get_db_session(database_url).__next__()
+
+    child_job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
+    if child_job is None:
+        raise ValueError(
+            f"Child job {child_uuid} does not exist. Initialize the job first."
+        )
+
+    training_params = (
+        session.query(RaptGenParams)
+        .filter(RaptGenParams.child_uuid == child_uuid)
+        .first()
+    )
+
+    # data-parallel training runs on CPU processes
+    num_processes: int = (
+        training_params.num_processes or 1 if training_params.device == "CPU" else 1  # type: ignore
+    )
+
+    print(f"Waiting for the semaphore for child job {child_uuid}.")
+
+    with (
+        cpu_scheduler.reserve(num_processes)
+        if num_processes > 1
+        else semaphore_dict[training_params.device]  # type: ignore
+    ) as cores:
+
+        print(f"Running RaptGen model for child job {child_uuid}.")
+
+        # update the status of the child job to progress
+        ChildJobTask.update_status_to_progress(session, child_uuid, self.request.id)  # type: ignore
+
+        data = _TrainingData(session, child_job, training_params)  # type: ignore
+        replica = _Replica(child_job, training_params)  # type: ignore
         current_epoch: int = 0
-        min_loss: float = float("inf")
 
         device_t = torch.device(training_params.device.lower())  # type: ignore
 
         # if resume_uuid is not None, load the model and optimizer states from the checkpoint
-        if is_resume:
-            current_epoch = child_job.epochs_current  # type: ignore
-            if current_epoch != 0:  # type: ignore
+        current_checkpoint = None
+        if is_resume and child_job.epochs_current != 0:
+            current_checkpoint_binary = read_checkpoint(
+                child_job.current_checkpoint_ref,  # type: ignore
+                child_job.current_checkpoint,  # type: ignore
+            )
+            if current_checkpoint_binary is None:
+                # the job stopped before its first checkpoint was written
+                print(f"Child job {child_uuid} has no checkpoint. Starting over.")
+                _reset_progress(session, child_job)
+            else:
+                with BytesIO(current_checkpoint_binary) as f:
+                    current_checkpoint = torch.load(f)
+
+        if current_checkpoint is None:
+            warm_start_checkpoint = load_warm_start_checkpoint(session, training_params)  # type: ignore
+            if warm_start_checkpoint is not None:
+                replica.warm_start(
+                    warm_start_checkpoint,
+                    bool(training_params.warm_start_optimizer),
+                )
+        else:
+            replica.model.load_state_dict(current_checkpoint["model"])
+            replica.optimizer.load_state_dict(current_checkpoint["optimizer"])
+
+            # with a checkpoint interval, the checkpoint may be older than the
+            # last finished epoch if the job stopped unexpectedly. retrain from it.
+            current_epoch = current_checkpoint.get("epoch", child_job.epochs_current)
+            child_job.epochs_current = current_epoch  # type: ignore
+            session.query(TrainingLosses).filter(
+                TrainingLosses.child_uuid == child_uuid,
+                TrainingLosses.epoch >= current_epoch,
+            ).delete()
+
+            # the optimal checkpoint is selected on the training loss when
+            # the test split is empty
+            selection_column = (
+                TrainingLosses.test_loss
+                if len(data.test_df) > 0
+                else TrainingLosses.train_loss
+            )
+            optimal_checkpoint_binary = read_checkpoint(
+                child_job.optimal_checkpoint_ref,  # type: ignore
+                child_job.optimal_checkpoint,  # type: ignore
+            )
+            optimal_epoch = None
+            if optimal_checkpoint_binary is not None:
+                with BytesIO(optimal_checkpoint_binary) as f:
+                    optimal_epoch = torch.load(f).get("epoch")
+
+            if optimal_epoch is not None and optimal_epoch > current_epoch:
+                # the optimal checkpoint was found in a rolled back epoch. the
+                # checkpoint resumed from becomes the optimal one
+                min_loss_record = (
+                    session.query(TrainingLosses)
+                    .filter(
+                        TrainingLosses.child_uuid == child_uuid,
+                        TrainingLosses.epoch == current_epoch - 1,
+                    )
+                    .first()
+                )
+                replaced_ref = child_job.optimal_checkpoint_ref
+                child_job.optimal_checkpoint_ref = child_job.current_checkpoint_ref  # type: ignore
+                child_job.optimal_checkpoint = child_job.current_checkpoint  # type: ignore
+                session.commit()
+                delete_unreferenced_checkpoints(session, [replaced_ref])  # type: ignore
+            else:
                 min_loss_record = (
                     session.query(TrainingLosses)
                     .filter(TrainingLosses.child_uuid == child_uuid)
-                    .order_by(TrainingLosses.test_loss)
+                    .order_by(selection_column)
                     .first()
                 )
-                min_loss_epoch: int = min_loss_record.epoch  # type: ignore
-                patience = current_epoch - min_loss_epoch
-                min_loss = min_loss_record.test_loss  # type: ignore
-
-                current_checkpoint_binary: bytes = child_job.current_checkpoint  # type: ignore
-                with BytesIO(current_checkpoint_binary) as f:
-                    current_checkpoint = torch.load(f)
-                    model.load_state_dict(current_checkpoint["model"])
-                    optimizer.load_state_dict(current_checkpoint["optimizer"])
+            if min_loss_record is not None:
+                replica.patience = current_epoch - min_loss_record.epoch  # type: ignore
+                replica.min_loss = getattr(min_loss_record, selection_column.key)
+            child_job.minimum_NLL = replica.min_loss  # type: ignore
 
+        if is_resume:
             child_job.duration_suspend = (  # type: ignore
                 child_job.duration_suspend
                 + int(time.time())
                 - child_job.datetime_laststop
             )
 
-        model.to(device_t)
-        model.train()
-
-        for state in optimizer.state.values():
-            for k, v in state.items():
-                if isinstance(v, torch.Tensor):
-                    state[k] = v.to(device_t)
-
         print(
             f"Training RaptGen model for task_id {self.request.id}. With abort flag {self.is_aborted()}."
         )
 
-        for epoch in range(current_epoch, training_params.epochs):  # type: ignore
-            if self.is_aborted():
-                child_job.status = "suspend"  # type: ignore
-                session.commit()
-                return False
-
-            if epoch < training_params.beta_duration:  # type: ignore
-                beta: float = epoch / training_params.beta_duration  # type: ignore
-            else:
-                beta: float = 1
-            use_force_matching: bool = epoch < training_params.match_forcing_duration  # type: ignore
-
-            train_loss: float = 0
-            test_kld: float = 0
-            test_ce: float = 0
-
-            for (batch,) in train_dataloader:
-                batch = batch.to(device_t)
-                optimizer.zero_grad()
-
-                (transition_probs, emission_probs), mus, logvars = model(batch)
-
-                loss = profile_hmm_vae_loss(
-                    batch_input=batch,
-                    transition_probs=transition_probs,
-                    emission_probs=emission_probs,
-                    mus=mus,
-                    logvars=logvars,
-                    beta=beta,
-                    force_matching=use_force_matching,
-                    match_cost=(
-                        1
-                        + training_params.match_cost  # type: ignore
-                        * (1 - epoch / training_params.match_forcing_duration)  # type: ignore
-                        if use_force_matching
-                        else 1
-                    ),
-                )
+        if num_processes == 1:
+            return _train_replicas(
+                self,
+                session,
+                [replica],
+                data,
+                training_params,  # type: ignore
+                device_t,
+                start_epoch=current_epoch,
+            )
 
-                loss.backward()
+        # the other ranks start from the state of rank 0. each spawned rank
+        # runs its threads on its own slice of the reserved cores. rank 0 runs
+        # in the thread of this task and keeps the thread count the scheduler
+        # set for the whole worker process, without being bound to its slice
+        with BytesIO() as f:
+            torch.save(replica.state_dict(), f)
+            state_binary = f.getvalue()
+        rank_cores = split_cores(cores, num_processes)
+        group = DataParallelGroup.start(
+            num_processes,
+            _data_parallel_worker,
+            args=(
+                child_uuid,
+                database_url,
+                state_binary,
+                current_epoch,
+                rank_cores,
+                cpu_scheduler.pin,
+            ),
+        )
+        try:
+            result = _train_replicas(
+                self,
+                session,
+                [replica],
+                data,
+                training_params,  # type: ignore
+                device_t,
+                start_epoch=current_epoch,
+                group=group,
+            )
+        except BaseException:
+            # the other ranks wait in a collective that never completes
+            group.close(timeout=0)
+            raise
+        group.close()
+        return result
+
+
+def _data_parallel_worker(
+    rank: int,
+    size: int,
+    port: int,
+    child_uuid: str,
+    database_url: str,
+    state_binary: bytes,
+    start_epoch: int,
+    rank_cores: List[List[int]],
+    pin: bool,
+):
+    """
+    Rank 1 or above of a data-parallel child job. Trains and evaluates its
+    share of the batches in step with rank 0 until rank 0 stops it. The
+    losses, checkpoints and status are only recorded by rank 0.
 
-                train_loss += loss.item() * int(batch.shape[0])
-                # 損失関数はバッチ内で平均している。バッチ要素数をかけてバッチ毎の総損失量を計算。
+    The process runs one thread per core of its slice `rank_cores[rank]`,
+    bound to the slice with `pin`; torch starts with a thread per core of
+    the node otherwise.
+    """
+    bind_threads(rank_cores[rank], pin)
+    group = DataParallelGroup.join(rank, size, port)
 
-                optimizer.step()
+    session = get_db_session(database_url).__next__()
+    child_job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
+    training_params = (
+        session.query(RaptGenParams)
+        .filter(RaptGenParams.child_uuid == child_uuid)
+        .first()
+    )
+    data = _TrainingData(session, child_job, training_params)  # type: ignore
+    replica = _Replica(child_job, training_params)  # type: ignore
+    session.close()
 
-            train_loss /= len(train_dataloader.dataset)  # type: ignore
-            # train_loss は dataset を構成する塩基配列（各データ点）の平均損失値になる。
+    with BytesIO(state_binary) as f:
+        state = torch.load(f)
+    replica.model.load_state_dict(state["model"])
+    replica.optimizer.load_state_dict(state["optimizer"])
+    device_t = torch.device("cpu")
+    replica.to(device_t)
 
-            if train_loss == torch.nan:
-                raise ValueError("Training loss is not a number.")
+    epoch = start_epoch
+    while group.broadcast_flag():
+        _train_epoch([replica], data, training_params, epoch, device_t, group)  # type: ignore
+        _test_epoch([replica.model], data, training_params, device_t, group)  # type: ignore
+        epoch += 1
 
-            with torch.no_grad():
-                for (batch,) in test_dataloader:
-                    batch = batch.to(device_t)
 
-                    (transition_probs, emission_probs), mus, logvars = model(batch)
-                    ce, kld = profile_hmm_vae_loss(
-                        batch_input=batch,
-                        transition_probs=transition_probs,
-                        emission_probs=emission_probs,
-                        mus=mus,
-                        logvars=logvars,
-                        split_ce_kld=True,
-                    )
-                    test_ce += ce.item() * batch.shape[0]
-                    test_kld += kld.item() * batch.shape[0]
+@celery.task(bind=True, base=ChildJobTask)
+def run_job_raptgen_ensemble(
+    self: ChildJobTask,
+    child_uuids: List[str],
+    database_url: str = "postgresql+psycopg2://postgres:postgres@db:5432/raptgen",
+):
+    """
+    Train the reiterations of a parent job together in one task.
 
-                test_loss = test_kld + test_ce
+    The child jobs share the encoded dataset, the dataloaders and one pHMM
+    dynamic programming pass per batch. Each child job keeps its own model,
+    optimizer, losses, checkpoints and early stopping, so a suspended
+    ensemble is resumed with `run_job_raptgen` for each child job.
 
-            if test_loss == torch.nan:
-                raise ValueError("Test loss is not a number.")
+    Parameters
+    ----------
+    child_uuids : List[str]
+        identifiers of the child jobs to run. They must share the parent job
+        and the training parameters
+    database_url : str
+        database URL to connect
+    """
+    # get the database session
+    session = get_db_session(database_url).__next__()
 
-            session.add(
-                TrainingLosses(
-                    child_uuid=child_uuid,
-                    epoch=epoch,
-                    test_loss=test_loss,
-                    test_recon=test_ce,
-                    test_kld=test_kld,
-                    train_loss=train_loss,
-                )
+    child_jobs = []
+    for child_uuid in child_uuids:
+        child_job = session.query(ChildJob).filter(ChildJob.uuid == child_uuid).first()
+        if child_job is None:
+            raise ValueError(
+                f"Child job {child_uuid} does not exist. Initialize the job first."
             )
+        child_jobs.append(child_job)
 
-            with BytesIO() as f:
-                torch.save(
-                    {
-                        "model": model.state_dict(),
-                        "optimizer": optimizer.state_dict(),
-                    },
-                    f,
-                )
-                f.seek(0)
-                current_checkpoint_binary = f.read()
-            child_job.current_checkpoint = current_checkpoint_binary  # type: ignore
-
-            # when the lowest test loss is found, update the optimal checkpoint and embeddings
-            if test_loss < min_loss:
-                min_loss = test_loss
-                child_job.minimum_NLL = min_loss  # type: ignore
-
-                patience = 0
-
-                train_coords_list = []
-                test_coords_list = []
-                with torch.no_grad():
-                    for (batch,) in train_dataloader:
-                        batch = batch.to(device_t)
-                        _, latent_codes, _ = model(batch)
-                        train_coords_list.append(latent_codes)
-                    for (batch,) in test_dataloader:
-                        batch = batch.to(device_t)
-                        _, latent_codes, _ = model(batch)
-                        test_coords_list.append(latent_codes)
-                    train_coords = torch.cat(train_coords_list, dim=0)
-                    test_coords = torch.cat(test_coords_list, dim=0)
-                train_df["coord_x"] = train_coords[:, 0].cpu().numpy().tolist()
-                train_df["coord_y"] = train_coords[:, 1].cpu().numpy().tolist()
-                test_df["coord_x"] = test_coords[:, 0].cpu().numpy().tolist()
-                test_df["coord_y"] = test_coords[:, 1].cpu().numpy().tolist()
-
-                embeddings_df = pd.concat([train_df, test_df], ignore_index=True)
-                embeddings_df = embeddings_df.drop(
-                    columns=["encoded_id", "is_training_data"]
-                )
-                embeddings_df["child_uuid"] = child_uuid
-                embeddings_dict = embeddings_df.to_dict(orient="records")
-                # delete(SequenceEmbeddings).where(SequenceEmbeddings.child_uuid == task_id)
-                session.query(SequenceEmbeddings).filter(
-                    SequenceEmbeddings.child_uuid == child_uuid
-                ).delete()
-                session.commit()
-                session.bulk_insert_mappings(SequenceEmbeddings, embeddings_dict)  # type: ignore
+    training_params = (
+        session.query(RaptGenParams)
+        .filter(RaptGenParams.child_uuid == child_uuids[0])
+        .first()
+    )
 
-                child_job.optimal_checkpoint = current_checkpoint_binary  # type: ignore
+    print(f"Waiting for the semaphore for child jobs {', '.join(child_uuids)}.")
 
-            print(f"Epoch {epoch + 1}: Train Loss {train_loss}, Test Loss {test_loss}")
+    with semaphore_dict[training_params.device]:  # type: ignore
 
-            # update the child job entry
-            child_job.epochs_current = epoch + 1  # type: ignore
+        print(f"Running RaptGen ensemble for child jobs {', '.join(child_uuids)}.")
 
-            session.commit()
+        # update the status of the child jobs to progress
+        for child_uuid in child_uuids:
+            ChildJobTask.update_status_to_progress(session, child_uuid, self.request.id)  # type: ignore
 
-            # early stopping
-            if patience >= training_params.early_stopping:  # type: ignore
-                break
+        data = _TrainingData(session, child_jobs[0], training_params)  # type: ignore
+        replicas = [_Replica(child_job, training_params) for child_job in child_jobs]  # type: ignore
+        device_t = torch.device(training_params.device.lower())  # type: ignore
 
-        # update the child job entry
-        child_job.status = "success"  # type: ignore
-        session.commit()
+        warm_start_checkpoint = load_warm_start_checkpoint(session, training_params)  # type: ignore
+        if warm_start_checkpoint is not None:
+            for replica in replicas:
+                replica.warm_start(
+                    warm_start_checkpoint,
+                    bool(training_params.warm_start_optimizer),
+                )
 
-    return True
+        return _train_replicas(
+            self,
+            session,
+            replicas,
+            data,
+            training_params,  # type: ignore
+            device_t,
+            start_epoch=0,
+        )
 
 
 def initialize_job_raptgen(
@@ -484,6 +1399,7 @@ def initialize_job_raptgen(
     parent_uuid: str,
     id: int,
     params: RaptGenTrainingParams,
+    jobtype: JobType = JobType.RaptGen,
 ) -> UUID:
     """
     Initialize the database entry for the RaptGen job.
@@ -498,6 +1414,9 @@ def initialize_job_raptgen(
             child job identifier
         params : RaptGenTrainingParams
             training parameters
+        jobtype : JobType
+            RaptGen, or RaptGen-Freq / RaptGen-Logfreq to weight the unique
+            sequences by their (log) number of duplicates
 
     Returns
     -------
@@ -519,7 +1438,7 @@ def initialize_job_raptgen(
             epochs_total=params.epochs,
             epochs_current=0,
             minimum_NLL=float("inf"),
-            jobtype="RaptGen",
+            jobtype=jobtype,
             is_added_viewer_dataset=False,
             current_checkpoint=None,
             optimal_checkpoint=None,
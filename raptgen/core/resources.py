@@ -0,0 +1,145 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence
+
+import torch
+
+
+def available_cores() -> List[int]:
+    """
+    Return the CPU cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: Sequence[int], num_parts: int) -> List[List[int]]:
+    """
+    Split `cores` into `num_parts` contiguous slices of nearly equal size.
+    With fewer cores than parts, the parts take the cores in turn.
+    """
+    if len(cores) < num_parts:
+        return [[cores[i % len(cores)]] for i in range(num_parts)]
+    bounds = [len(cores) * i // num_parts for i in range(num_parts + 1)]
+    return [list(cores[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+
+def bind_threads(cores: Sequence[int], pin: bool = False):
+    """
+    Run the intra-op threads of the calling process on `cores`: one thread
+    per core, and with `pin`, the calling thread bound to the cores. The
+    worker threads OpenMP creates later inherit the binding.
+
+    The number of threads is process-wide, so this is only for processes
+    running a single job, such as the spawned ranks of a data-parallel job.
+    """
+    torch.set_num_threads(len(cores))
+    if pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(threading.get_native_id(), cores)
+
+
+class CoreScheduler:
+    """
+    Admit CPU training jobs within the core budget of the node.
+
+    Each job entering the scheduler takes `threads_per_job` free cores and
+    blocks until enough cores are released by other jobs. Used as a context
+    manager in place of a semaphore:
+
+        with scheduler:
+            train()
+
+    The scheduler only accounts for the cores. Celery runs the jobs as threads
+    of one process, and both `torch.set_num_threads` and the OpenMP thread
+    pools are shared by them, so a job cannot be given its own thread count or
+    affinity without overwriting those of the others. Instead, the first job
+    sets the number of intra-op threads of the process to `threads_per_job`
+    once, the same value every job would ask for, and the admitted jobs never
+    use more threads than there are cores. The jobs are not bound to the cores
+    they take; only the processes a data-parallel job spawns for its other
+    ranks are bound to their slices with `bind_threads`.
+
+    Parameters
+    ----------
+    cores : Sequence[int], optional
+        cores to schedule the jobs on. Defaults to `available_cores()`
+    threads_per_job : int, optional
+        number of cores and threads given to each job. Defaults to half of the
+        cores, at most 4, since the models are too small to scale further
+    pin : bool
+        flag to bind the spawned processes of data-parallel jobs to their
+        cores with `os.sched_setaffinity`
+    """
+
+    def __init__(
+        self,
+        cores: Optional[Sequence[int]] = None,
+        threads_per_job: Optional[int] = None,
+        pin: bool = False,
+    ):
+        self.cores = list(cores) if cores is not None else available_cores()
+        if threads_per_job is None:
+            threads_per_job = min(4, len(self.cores) // 2)
+        self.threads_per_job = max(1, min(threads_per_job, len(self.cores)))
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+
+        self._free = list(self.cores)
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._threads_set = False
+
+    @property
+    def max_jobs(self) -> int:
+        """
+        Number of jobs that can run at the same time.
+        """
+        return len(self.cores) // self.threads_per_job
+
+    def acquire(self, num_jobs: int = 1) -> List[int]:
+        """
+        Wait for free cores and take them for the calling thread. A job made
+        of `num_jobs` processes takes the cores of that many jobs, at most
+        all of them, and gives each process its slice with `split_cores`.
+        """
+        num_cores = min(self.threads_per_job * num_jobs, len(self.cores))
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._free) >= num_cores)
+            cores = self._free[:num_cores]
+            del self._free[:num_cores]
+            if not self._threads_set:
+                torch.set_num_threads(self.threads_per_job)
+                self._threads_set = True
+
+        if not hasattr(self._local, "allocations"):
+            self._local.allocations = []
+        self._local.allocations.append(cores)
+        return cores
+
+    def release(self):
+        """
+        Give the cores last taken by the calling thread back to the scheduler.
+        """
+        cores = self._local.allocations.pop()
+        with self._condition:
+            self._free.extend(cores)
+            self._free.sort()
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, num_jobs: int) -> Iterator[List[int]]:
+        """
+        Context manager taking the cores of `num_jobs` jobs.
+        """
+        cores = self.acquire(num_jobs)
+        try:
+            yield cores
+        finally:
+            self.release()
+
+    def __enter__(self) -> List[int]:
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
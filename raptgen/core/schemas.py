@@ -1,5 +1,8 @@
-from pydantic import BaseModel, Field
-from typing import List, Union, Dict, Literal, Any
+import itertools
+import random
+
+from pydantic import BaseModel, Field, field_validator, model_validator
+from typing import List, Union, Dict, Literal, Any, Optional
 
 
 class PreprocessingParams(BaseModel):
@@ -19,6 +22,78 @@ class RaptGenTrainingParams(BaseModel):
     seed_value: int
     match_cost: int
     device: str
+    band_width: Optional[int] = Field(default=None, ge=0)
+    checkpoint_interval: Optional[int] = Field(default=None, ge=1)
+    halving_min_epochs: Optional[int] = Field(default=None, ge=1)
+    halving_rate: Optional[int] = Field(default=None, ge=2)
+    warm_start_vae_uuid: Optional[str] = None
+    warm_start_child_uuid: Optional[str] = None
+    warm_start_optimizer: Optional[bool] = None
+    frozen_encoder_layers: Optional[int] = Field(default=None, ge=0, le=6)
+    num_processes: Optional[int] = Field(default=None, ge=1)
+    pipelined_validation: Optional[bool] = None
+
+    @model_validator(mode="after")
+    def check_warm_start(self) -> "RaptGenTrainingParams":
+        if (
+            self.warm_start_vae_uuid is not None
+            and self.warm_start_child_uuid is not None
+        ):
+            raise ValueError("only one warm start source can be given")
+        return self
+
+
+# lower bounds of the swept values of the unbounded training parameters. a sweep
+# is rejected as a whole rather than queueing children that cannot be trained.
+SWEEP_MINIMUMS = {
+    "model_length": 1,
+    "epochs": 1,
+    "match_forcing_duration": 0,
+    "beta_duration": 0,
+    "early_stopping": 1,
+    "match_cost": 0,
+}
+
+
+class SweepSpace(BaseModel):
+    # values tried for each swept training parameter
+    grid: Dict[str, List[Any]] = Field(min_length=1)
+    # number of configurations drawn at random from the grid. None tries all of them
+    num_samples: Optional[int] = Field(default=None, ge=1)
+    seed: int = 0
+
+    @field_validator("grid")
+    @classmethod
+    def check_grid(cls, grid: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        for name, values in grid.items():
+            if name not in RaptGenTrainingParams.model_fields or name == "device":
+                raise ValueError(f"{name} is not a swept training parameter")
+            if len(values) == 0:
+                raise ValueError(f"no values are given for {name}")
+            if name in SWEEP_MINIMUMS and any(
+                not isinstance(value, (int, float)) or value < SWEEP_MINIMUMS[name]
+                for value in values
+            ):
+                raise ValueError(
+                    f"values of {name} must be numbers of at least {SWEEP_MINIMUMS[name]}"
+                )
+        return grid
+
+    def expand(self, params: RaptGenTrainingParams) -> List[RaptGenTrainingParams]:
+        """
+        Training parameters of each configuration: `params` with the swept
+        parameters replaced by a combination of the grid values.
+        """
+        names = list(self.grid)
+        combinations = list(itertools.product(*self.grid.values()))
+        if self.num_samples is not None and self.num_samples < len(combinations):
+            combinations = random.Random(self.seed).sample(
+                combinations, self.num_samples
+            )
+        return [
+            RaptGenTrainingParams(**(params.dict() | dict(zip(names, values))))
+            for values in combinations
+        ]
 
 
 class BaseRaptGenModel(BaseModel):
@@ -28,6 +103,11 @@ class BaseRaptGenModel(BaseModel):
     random_regions: List[str]
     duplicates: List[int]
     reiteration: int
+    # train the reiterations together in one task
+    ensemble: bool = False
+    # train every configuration of the search space on the same dataset. successive
+    # halving ranks the child jobs of all the configurations together
+    sweep: Optional[SweepSpace] = None
 
 
 class RaptGenModel(BaseRaptGenModel):
@@ -37,4 +117,4 @@ class RaptGenModel(BaseRaptGenModel):
 
 class RaptGenFreqModel(BaseRaptGenModel):
     type: Literal["RaptGen-freq", "RaptGen-logfreq"]
-    params_training: Dict[str, Any]  # allowing any key with any value
+    params_training: RaptGenTrainingParams
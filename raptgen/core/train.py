@@ -4,7 +4,16 @@
 from __future__ import annotations
 
 # from typing import Annotated
-from typing import Callable, OrderedDict, Tuple, Type
+from typing import (
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    OrderedDict,
+    Sequence,
+    Tuple,
+    Type,
+)
 import random
 import numpy as np
 import pandas as pd
@@ -12,7 +21,9 @@ import torch
 from sklearn.model_selection import train_test_split
 from torch.utils.data.dataloader import DataLoader
 from torch.utils.data.dataset import TensorDataset
+from torch.utils.data.sampler import Sampler
 from core.algorithms import VAE, profile_hmm_vae_loss
+from core.preprocessing import NucleotideID
 from tqdm.auto import tqdm
 
 # seed 値の固定は https://qiita.com/north_redwing/items/1e153139125d37829d2d を参照した。
@@ -56,6 +67,120 @@ def _seed_worker(worker_id):
     random.seed(worker_seed)
 
 
+def sequence_lengths(batch: torch.Tensor) -> torch.Tensor:
+    """ID 化された配列のバッチから，パディングを除いた各配列の長さを返す。
+
+    Parameters
+    ----------
+    batch : torch.Tensor
+        `core.preprocessing.ID_encode()` で ID 化された配列のバッチ。(`batch`, `string_length`) の 2 次元構成。
+
+    Returns
+    -------
+    lengths : torch.Tensor
+        各配列の長さ。(`batch`, ) の 1 次元構成。
+    """
+    if batch.numel() == 0:
+        # 空の分割から作ったテンソルは (0, ) の 1 次元構成になりうる
+        return torch.zeros(len(batch), dtype=torch.long, device=batch.device)
+    return (batch != NucleotideID.PAD).sum(dim=1)
+
+
+def trim_padding(batch: torch.Tensor) -> torch.Tensor:
+    """右パディングされたバッチから，全配列でパディングとなっている末尾の列を取り除く。
+    `profile_hmm_loss` の動的計画表は列数に比例して大きくなるが，パディングの列は損失値に影響しない。
+
+    Parameters
+    ----------
+    batch : torch.Tensor
+        `core.preprocessing.ID_encode()` で ID 化され，右パディングされた配列のバッチ。(`batch`, `string_length`) の 2 次元構成。
+
+    Returns
+    -------
+    trimmed_batch : torch.Tensor
+        (`batch`, バッチ内の最大配列長) の 2 次元構成。空のバッチはそのまま返す。
+    """
+    if batch.numel() == 0:
+        return batch
+    max_length = int(sequence_lengths(batch).max())
+    return batch[:, : max(max_length, 1)]
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """長さの近い配列をまとめたバッチを生成する `DataLoader` 用の batch sampler。
+    同じ長さの配列（バケット）内でシャッフルしてから長さ順に並べ，`batch_size` 以下の均等な大きさに区切り，さらにバッチの順序をシャッフルする。
+    シャッフルはイテレーションの度（すなわち epoch 毎）に行われる。
+
+    ほとんどのバッチは同じ長さの配列のみからなり，バケットの境界にあるバッチのみ隣り合う 2 つの長さを含む。
+    `trim_padding` でパディングを取り除けば `profile_hmm_loss` はバッチ内の真の配列長で動的計画法を計算できる。
+    バケット毎に区切るとバッチ数，すなわち逐次的な動的計画法の回数が増えてかえって遅くなるため，バッチ数は通常の `DataLoader` と同じに保っている。
+
+    Parameters
+    ----------
+    lengths : Sequence[int]
+        データセットの各配列の長さ。
+    batch_size : int
+        バッチの最大の大きさ。`min_batch_size` を保つために超える場合がある。
+    shuffle : bool, default = True
+        バケット内の配列およびバッチの順序をシャッフルするか。`False` のときは長さ順，データセット順に並ぶ。
+    min_batch_size : int, default = 2
+        バッチの最小の大きさ。BatchNorm は要素数 1 のバッチを学習できない。
+    generator : Optional[torch.Generator], default = None
+        シャッフルに使用する乱数生成器。
+    order_generator : Optional[torch.Generator], default = None
+        バッチの順序のシャッフルに使用する乱数生成器。`None` のときは `generator` を使用する。
+        同じ長さの配列について同じ状態の `order_generator` を持つ sampler は，`generator` が異なっても同じ長さの順にバッチを生成する。
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        min_batch_size: int = 2,
+        generator: Optional[torch.Generator] = None,
+        order_generator: Optional[torch.Generator] = None,
+    ):
+        assert batch_size >= min_batch_size >= 1
+        lengths_t = torch.as_tensor(lengths)
+        self.buckets: List[torch.Tensor] = [
+            torch.nonzero(lengths_t == length).flatten()
+            for length in torch.unique(lengths_t)
+        ]
+        self.shuffle = shuffle
+        self.generator = generator
+        self.order_generator = (
+            order_generator if order_generator is not None else generator
+        )
+        # 末尾に小さなバッチが残らないよう，均等な大きさに区切る
+        self.num_batches = max(
+            min(-(-len(lengths_t) // batch_size), len(lengths_t) // min_batch_size),
+            1,
+        )
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if len(self.buckets) == 0:
+            return
+        buckets = self.buckets
+        if self.shuffle:
+            buckets = [
+                bucket[torch.randperm(len(bucket), generator=self.generator)]
+                for bucket in buckets
+            ]
+        batches = torch.tensor_split(torch.cat(buckets), self.num_batches)
+        if self.shuffle:
+            order = torch.randperm(
+                len(batches), generator=self.order_generator
+            ).tolist()
+        else:
+            order = range(len(batches))
+        for i in order:
+            yield batches[i].tolist()
+
+    def __len__(self) -> int:
+        return self.num_batches if len(self.buckets) > 0 else 0
+
+
 def get_dataloader(
     ndarray_data: np.ndarray,  # 配列を入力させてもいいが，各配列がちゃんとパディングされて一定の配列長になっていることを保証するため np.ndarray を入力させる。
     test_size: float = 0.1,
@@ -63,6 +188,7 @@ def get_dataloader(
     train_test_shuffle: bool = True,
     use_cuda: bool = False,  # refactoring 前はデフォルトで Cuda を使用している。フールプルーフでデフォルトを CPU 側にする。
     num_workers: int = 1,
+    bucket_by_length: bool = False,
     pin_memory: bool = False,  # refactoring 前は GPU を使用する際デフォルトで True だった。確認していないが遺伝研の CPU で libgomp error 吐くならおそらくここが問題の可能性があるので今回はデフォルトで False にしている。ちなみにここを True にすると https://qiita.com/sugulu_Ogawa_ISID/items/62f5f7adee083d96a587#12-pin_memory の説明にあるとおり推論が早くなる。
     **kwargs,
 ) -> Tuple[DataLoader, DataLoader]:
@@ -87,6 +213,8 @@ def get_dataloader(
     pin_memory : bool, default = False
         `True` の場合推論時に automatic memory pinning が適用され，計算が若干高速化される。詳しくは [ここ](https://qiita.com/sugulu_Ogawa_ISID/items/62f5f7adee083d96a587#12-pin_memory) を参照。
         `use_cuda = True` で CUDA が搭載された GPU 上で推論を行うと指定した際に有効になり，そうでない場合は `DataLoader` のコンストラクタで指定される `pin_memory` は `False` となる。
+    bucket_by_length : bool, default = False
+        `True` の場合，`LengthBucketBatchSampler` を使用して同じ長さの配列毎にバッチを作る。`ndarray_data` は ID 化されている必要がある。
 
     Returns
     -------
@@ -113,8 +241,27 @@ def get_dataloader(
         kwargs["worker_init_fn"] = _seed_worker
         kwargs["generator"] = gen
 
-    train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True, **kwargs)
-    test_loader = DataLoader(test_data, batch_size=batch_size, shuffle=False, **kwargs)
+    if bucket_by_length == True:
+        train_sampler = LengthBucketBatchSampler(
+            sequence_lengths(train_data.tensors[0]).tolist(),
+            batch_size=batch_size,
+            shuffle=True,
+            generator=kwargs.get("generator"),
+        )
+        test_sampler = LengthBucketBatchSampler(
+            sequence_lengths(test_data.tensors[0]).tolist(),
+            batch_size=batch_size,
+            shuffle=False,
+        )
+        train_loader = DataLoader(train_data, batch_sampler=train_sampler, **kwargs)
+        test_loader = DataLoader(test_data, batch_sampler=test_sampler, **kwargs)
+    else:
+        train_loader = DataLoader(
+            train_data, batch_size=batch_size, shuffle=True, **kwargs
+        )
+        test_loader = DataLoader(
+            test_data, batch_size=batch_size, shuffle=False, **kwargs
+        )
 
     return train_loader, test_loader
 
@@ -209,7 +356,7 @@ def train_VAE(
                         transition_probs, emission_probs = reconst_params
                         if epoch <= force_epochs:
                             loss: torch.Tensor = loss_fn(
-                                batch_input=batch,
+                                batch_input=trim_padding(batch),
                                 transition_probs=transition_probs,
                                 emission_probs=emission_probs,
                                 mus=mus,
@@ -220,7 +367,7 @@ def train_VAE(
                             )
                         else:
                             loss: torch.Tensor = loss_fn(
-                                batch_input=batch,
+                                batch_input=trim_padding(batch),
                                 transition_probs=transition_probs,
                                 emission_probs=emission_probs,
                                 mus=mus,
@@ -253,12 +400,13 @@ def train_VAE(
                             reconst_params, mus, logvars = model(batch)
                             transition_probs, emission_probs = reconst_params
                             ce, kld = loss_fn(
-                                batch_input=batch,
+                                batch_input=trim_padding(batch),
                                 transition_probs=transition_probs,
                                 emission_probs=emission_probs,
                                 mus=mus,
                                 logvars=logvars,
                                 split_ce_kld=True,
+                                engine="inference",
                             )
                             test_ce += ce.item() * batch.shape[0]
                             test_kld += kld.item() * batch.shape[0]
@@ -1,25 +1,32 @@
-from typing import Dict, List
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Dict, List, Optional, Set, Tuple
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from fastapi.responses import Response
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import pickle
 import torch
 import numpy as np
 from uuid import uuid4
-import matplotlib.pyplot as plt
 from io import BytesIO
 import tempfile
 import subprocess
 from core.db import (
+    ViewerSequenceEmbeddings,
     ViewerVAE,
     get_db_session,
 )
 from core.algorithms import (
     CNN_PHMM_VAE,
+    LatentDecodeTiles,
     embed_sequences,
+    export_inference_model,
+    get_log_likelihood_grid,
+    get_log_likelihoods,
     get_most_probable_seq,
-    draw_logo,
+    get_viterbi_seqs,
+    render_logo,
+    sample_sequences,
 )
 
 router = APIRouter()
@@ -34,6 +41,17 @@ class CPU_Unpickler(pickle.Unpickler):
 
 
 sessions: Dict[str, CNN_PHMM_VAE] = dict()
+# VAE uuid and quantization flag of each session
+session_profiles: Dict[str, Tuple[str, bool]] = dict()
+# sessions whose exported model and decode tiles are in place
+prepared_sessions: Set[str] = set()
+# max coordinate deviation of the quantized model on a sample of the training
+# sequences, per VAE uuid. None while it is being computed
+quantization_deviations: Dict[str, Optional[float]] = dict()
+# number of training sequences the quantization deviation is measured on
+QUANTIZATION_SAMPLE_SIZE = 1000
+# precomputed decode lattice over the training embeddings, per session uuid
+decode_tiles: Dict[str, LatentDecodeTiles] = dict()
 
 
 class RequestCoordinates(BaseModel):
@@ -42,16 +60,71 @@ class RequestCoordinates(BaseModel):
     coords_y: List[float]
 
 
+class RequestDecodeCoordinates(RequestCoordinates):
+    exact: bool = False
+    level: Optional[int] = Field(default=None, ge=0)
+
+
+class RequestViterbiCoordinates(RequestCoordinates):
+    top_k: int = Field(default=1, ge=1, le=100)
+
+
+# max number of sequences sampled by one request, over all the coordinates
+MAX_SAMPLES_PER_REQUEST = 100000
+
+
+class RequestSampleCoordinates(RequestCoordinates):
+    num_samples: int = Field(default=10, ge=1, le=10000)
+    seed: Optional[int] = None
+
+
+# max number of (sequence, coordinate) pairs scored by one request
+MAX_SCORE_PAIRS = 1000000
+
+
 class RequestSequences(BaseModel):
     session_uuid: str
     sequences: List[str]
 
 
+class RequestScore(BaseModel):
+    session_uuid: str
+    sequences: List[str]
+    coords_x: List[float]
+    coords_y: List[float]
+
+
+class RequestScoreHeatmap(BaseModel):
+    session_uuid: str
+    sequences: List[str]
+    range_x: Tuple[float, float]
+    range_y: Tuple[float, float]
+    resolution: int = Field(default=50, ge=2, le=200)
+
+
 @router.get("/api/session/start")
 def start_session(
     vae_uuid: str,
+    background_tasks: BackgroundTasks,
+    quantized: bool = False,
     session: Session = Depends(get_db_session),
 ):
+    """
+    Load a published VAE model for decoding and encoding.
+
+    The session answers requests right away with the eager model, while the
+    fused TorchScript model and the decode tiles over the bounding box of the
+    training embeddings are prepared in the background. `/api/session/status`
+    reports `ready` once they are in place.
+
+    With `quantized=true`, the session then uses a dynamically int8-quantized
+    model, which is faster on CPU but slightly less accurate. The response then
+    reports `max_deviation`, the largest distance between the quantized and the
+    original embeddings of a sample of the model's own training sequences. It
+    is measured once per VAE after the first quantized session is prepared, and
+    is null until then; poll `/api/session/status` with the session uuid to
+    read it.
+    """
     # if VAE_name is empty, return an error
     vae_profile = session.query(ViewerVAE).where(ViewerVAE.uuid == vae_uuid).first()
     if vae_profile is None:
@@ -77,17 +150,134 @@ def start_session(
         model.load_state_dict(checkpoint["model"])
     model.eval()
 
-    # save model
     sessions[session_uuid] = model
+    session_profiles[session_uuid] = (vae_uuid, quantized)
+
+    # bounding box of the training embeddings
+    min_x, max_x, min_y, max_y, num_embeddings = (
+        session.query(
+            func.min(ViewerSequenceEmbeddings.coord_x),
+            func.max(ViewerSequenceEmbeddings.coord_x),
+            func.min(ViewerSequenceEmbeddings.coord_y),
+            func.max(ViewerSequenceEmbeddings.coord_y),
+            func.count(ViewerSequenceEmbeddings.id),
+        )
+        .where(ViewerSequenceEmbeddings.vae_uuid == vae_uuid)
+        .one()
+    )
+    bounds = None
+    if num_embeddings > 0:
+        margin_x = max((max_x - min_x) * 0.05, 1e-3)
+        margin_y = max((max_y - min_y) * 0.05, 1e-3)
+        bounds = (
+            (min_x - margin_x, max_x + margin_x),
+            (min_y - margin_y, max_y + margin_y),
+        )
+
+    # the training sequences to measure the quantization deviation on, spread
+    # evenly over the embeddings of the VAE
+    random_regions = None
+    if quantized and vae_uuid not in quantization_deviations and num_embeddings > 0:
+        quantization_deviations[vae_uuid] = None
+        stride = -(-num_embeddings // QUANTIZATION_SAMPLE_SIZE)
+        random_regions = [
+            random_region
+            for (random_region,) in session.query(
+                ViewerSequenceEmbeddings.random_region
+            )
+            .where(
+                ViewerSequenceEmbeddings.vae_uuid == vae_uuid,
+                ViewerSequenceEmbeddings.id % stride == 0,
+            )
+            .limit(QUANTIZATION_SAMPLE_SIZE)
+        ]
+
+    background_tasks.add_task(
+        prepare_session,
+        session_uuid,
+        vae_uuid,
+        model,
+        quantized,
+        bounds,
+        random_regions,
+    )
 
     return {
         "uuid": session_uuid,
+        "quantized": quantized,
+        "max_deviation": quantization_deviations.get(vae_uuid) if quantized else None,
     }
 
 
+def prepare_session(
+    session_uuid: str,
+    vae_uuid: str,
+    model: CNN_PHMM_VAE,
+    quantized: bool,
+    bounds: Optional[Tuple[Tuple[float, float], Tuple[float, float]]],
+    random_regions: Optional[List[str]],
+):
+    """
+    Replace the eager model of a session with the fused TorchScript model,
+    quantized if requested, and precompute the decode tiles over `bounds`.
+    Given `random_regions`, the quantization deviation is measured on them.
+    A session ended in the meantime is left ended.
+    """
+    # falls back to the eager model on failure
+    inference_model = export_inference_model(model, quantize=quantized)
+    try:
+        if session_uuid not in sessions:
+            return
+        sessions[session_uuid] = inference_model
+        if bounds is not None:
+            tiles = LatentDecodeTiles(
+                inference_model, range_x=bounds[0], range_y=bounds[1]
+            )
+            if session_uuid not in sessions:
+                return
+            decode_tiles[session_uuid] = tiles
+        prepared_sessions.add(session_uuid)
+    finally:
+        if random_regions is not None:
+            measure_quantization_deviation(
+                vae_uuid, random_regions, inference_model, model
+            )
+
+
+def measure_quantization_deviation(
+    vae_uuid: str,
+    random_regions: List[str],
+    quantized_model: CNN_PHMM_VAE,
+    model: CNN_PHMM_VAE,
+):
+    """
+    Cache the max coordinate deviation of the quantized model on at most
+    `QUANTIZATION_SAMPLE_SIZE` training sequences, drawn reproducibly.
+    """
+    if len(random_regions) > QUANTIZATION_SAMPLE_SIZE:
+        sample = np.random.default_rng(0).choice(
+            len(random_regions), QUANTIZATION_SAMPLE_SIZE, replace=False
+        )
+        random_regions = [random_regions[i] for i in sample]
+    try:
+        deviations = np.linalg.norm(
+            embed_sequences(random_regions, quantized_model)
+            - embed_sequences(random_regions, model),
+            axis=1,
+        )
+    except Exception:
+        # measure again with the next quantized session
+        quantization_deviations.pop(vae_uuid, None)
+        raise
+    quantization_deviations[vae_uuid] = float(deviations.max())
+
+
 @router.get("/api/session/end")
 def end_session(session_uuid: str):
     popped = sessions.pop(session_uuid, None)
+    session_profiles.pop(session_uuid, None)
+    prepared_sessions.discard(session_uuid)
+    decode_tiles.pop(session_uuid, None)
 
     if popped is None:
         raise HTTPException(status_code=404, detail="Item not found")
@@ -114,7 +304,49 @@ async def encode(request: RequestSequences):
 
 
 @router.post("/api/session/decode")
-async def decode(request: RequestCoordinates):
+async def decode(request: RequestDecodeCoordinates):
+    """
+    Decode the most probable sequences of the pHMMs at the given coordinates.
+
+    Coordinates inside the precomputed lattice are answered from the nearest
+    lattice point of the finest level, or of `level` if given. Set `exact` to
+    decode every coordinate directly. Until the lattice of the session is
+    ready, every coordinate is decoded directly.
+    """
+    global sessions
+    if request.session_uuid not in sessions.keys():
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    if not len(request.coords_x) > 0 or not len(request.coords_y) > 0:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    if not len(request.coords_x) == len(request.coords_y):
+        raise HTTPException(status_code=400, detail="Invalid input")
+
+    coords = np.array([request.coords_x, request.coords_y]).T
+
+    model = sessions[request.session_uuid]
+    tiles = decode_tiles.get(request.session_uuid)
+    if tiles is None:
+        seqs, _ = get_most_probable_seq(coords=list(coords), model=model)
+    else:
+        if request.level is not None and request.level >= len(tiles.resolutions):
+            raise HTTPException(status_code=400, detail="Invalid input")
+        seqs = tiles.decode(list(coords), exact=request.exact, level=request.level)
+
+    return {
+        "sequences": seqs,
+    }
+
+
+@router.post("/api/session/decode/viterbi")
+async def decode_viterbi(request: RequestViterbiCoordinates):
+    """
+    Decode the exact most probable sequences of the pHMMs at the given coordinates.
+
+    Unlike `/api/session/decode`, which follows the locally most probable
+    transition, this runs the Viterbi algorithm and returns the `top_k` most
+    probable sequences for every coordinate, in descending order of probability.
+    """
     global sessions
     if request.session_uuid not in sessions.keys():
         raise HTTPException(status_code=404, detail="Item not found")
@@ -127,18 +359,182 @@ async def decode(request: RequestCoordinates):
     coords = np.array([request.coords_x, request.coords_y]).T
 
     model = sessions[request.session_uuid]
-    seqs, _ = get_most_probable_seq(coords=list(coords), model=model)
+    seqs, log_probs = get_viterbi_seqs(
+        coords=list(coords), model=model, top_k=request.top_k
+    )
 
     return {
         "sequences": seqs,
+        "log_probs": log_probs,
+    }
+
+
+@router.post("/api/session/decode/sample")
+async def decode_sample(request: RequestSampleCoordinates):
+    """
+    Sample sequences from the pHMMs at the given coordinates.
+
+    Draws `num_samples` sequences per coordinate and returns them together with
+    the log-probability of the sampled path (states and sequence) under the pHMM.
+    At most `MAX_SAMPLES_PER_REQUEST` sequences are sampled in total.
+    """
+    global sessions
+    if request.session_uuid not in sessions.keys():
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    if not len(request.coords_x) > 0 or not len(request.coords_y) > 0:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    if not len(request.coords_x) == len(request.coords_y):
+        raise HTTPException(status_code=400, detail="Invalid input")
+
+    if len(request.coords_x) * request.num_samples > MAX_SAMPLES_PER_REQUEST:
+        raise HTTPException(
+            status_code=422,
+            detail=[
+                {
+                    "loc": ["body", "num_samples"],
+                    "msg": f"at most {MAX_SAMPLES_PER_REQUEST} sequences can be sampled in total",
+                    "type": "value_error",
+                }
+            ],
+        )
+
+    coords = np.array([request.coords_x, request.coords_y]).T
+
+    model = sessions[request.session_uuid]
+    seqs, log_probs = sample_sequences(
+        coords=list(coords),
+        model=model,
+        num_samples=request.num_samples,
+        seed=request.seed,
+    )
+
+    return {
+        "sequences": seqs,
+        "log_probs": log_probs.tolist(),
+    }
+
+
+def validate_score_request(sequences: List[str], num_coords: int):
+    """
+    Reject sequences with characters other than A, C, G, T and U, and requests
+    scoring more than `MAX_SCORE_PAIRS` pairs of a sequence and a coordinate.
+    """
+    for i, sequence in enumerate(sequences):
+        if not set(sequence) <= set("ACGTU"):
+            raise HTTPException(
+                status_code=422,
+                detail=[
+                    {
+                        "loc": ["body", "sequences", i],
+                        "msg": "sequences must consist of A, C, G, T and U",
+                        "type": "value_error",
+                    }
+                ],
+            )
+    if len(sequences) * num_coords > MAX_SCORE_PAIRS:
+        raise HTTPException(
+            status_code=422,
+            detail=[
+                {
+                    "loc": ["body", "sequences"],
+                    "msg": f"at most {MAX_SCORE_PAIRS} pairs of a sequence and a coordinate can be scored",
+                    "type": "value_error",
+                }
+            ],
+        )
+
+
+@router.post("/api/session/score")
+async def score(request: RequestScore):
+    """
+    Compute the log-likelihood of each sequence under the pHMM decoded at each coordinate.
+
+    Returns an N x M matrix, where `log_likelihoods[n][m]` is the log-likelihood
+    of `sequences[n]` under the pHMM at `(coords_x[m], coords_y[m])`. N x M is at
+    most `MAX_SCORE_PAIRS`.
+    """
+    global sessions
+    if request.session_uuid not in sessions.keys():
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    if not len(request.sequences) > 0:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    if not len(request.coords_x) > 0 or not len(request.coords_y) > 0:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    if not len(request.coords_x) == len(request.coords_y):
+        raise HTTPException(status_code=400, detail="Invalid input")
+    validate_score_request(request.sequences, len(request.coords_x))
+
+    coords = np.array([request.coords_x, request.coords_y]).T
+
+    model = sessions[request.session_uuid]
+    log_likelihoods = get_log_likelihoods(
+        sequences=request.sequences, coords=list(coords), model=model
+    )
+
+    return {
+        "log_likelihoods": log_likelihoods.tolist(),
+    }
+
+
+@router.post("/api/session/score/heatmap")
+async def score_heatmap(request: RequestScoreHeatmap):
+    """
+    Compute the log-likelihood of each sequence on a regular grid over the latent space.
+
+    `log_likelihoods[n][j][i]` is the log-likelihood of `sequences[n]` under the
+    pHMM at `(grid_x[i], grid_y[j])`, ready to be drawn as a heatmap per sequence.
+    The number of sequences times `resolution ** 2` is at most `MAX_SCORE_PAIRS`.
+    """
+    global sessions
+    if request.session_uuid not in sessions.keys():
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    if not len(request.sequences) > 0:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    validate_score_request(request.sequences, request.resolution**2)
+
+    model = sessions[request.session_uuid]
+    grid_x, grid_y, log_likelihoods = get_log_likelihood_grid(
+        sequences=request.sequences,
+        model=model,
+        range_x=request.range_x,
+        range_y=request.range_y,
+        resolution=request.resolution,
+    )
+
+    return {
+        "grid_x": grid_x.tolist(),
+        "grid_y": grid_y.tolist(),
+        "log_likelihoods": log_likelihoods.tolist(),
     }
 
 
 @router.get("/api/session/status")
-def get_session_status():
+def get_session_status(session_uuid: Optional[str] = None):
+    """
+    List the sessions. With `session_uuid`, report that session instead: its
+    VAE, whether its model is quantized, whether its exported model and decode
+    tiles are `ready`, and for a quantized model the `max_deviation` measured
+    after the session started, null until then.
+    """
     global sessions
+    if session_uuid is None:
+        return {
+            "entries": list(sessions.keys()),
+        }
+
+    if session_uuid not in sessions.keys():
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    vae_uuid, quantized = session_profiles[session_uuid]
     return {
-        "entries": list(sessions.keys()),
+        "uuid": session_uuid,
+        "vae_uuid": vae_uuid,
+        "quantized": quantized,
+        "ready": session_uuid in prepared_sessions,
+        "max_deviation": (quantization_deviations.get(vae_uuid) if quantized else None),
     }
 
 
@@ -156,14 +552,12 @@ async def get_weblogo(request: RequestCoordinates):
 
     model = sessions[request.session_uuid]
 
-    fig, ax = plt.subplots(1, 1, figsize=(10, 3), dpi=120)
-    draw_logo(
-        ax=ax,
+    image = render_logo(
         coord=np.array([request.coords_x[0], request.coords_y[0]]),
         model=model,
     )
     bytes_io = BytesIO()
-    fig.savefig(bytes_io, format="png")
+    image.save(bytes_io, format="png", compress_level=1)
     bytes_io.seek(0)
     figdata = bytes_io.read()
     return Response(
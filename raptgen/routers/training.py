@@ -7,8 +7,10 @@ import numpy as np
 import pandas as pd
 import torch
 from celery.contrib.abortable import AbortableAsyncResult
+from core.checkpoints import read_checkpoint
 from core.db import (
     ChildJob,
+    JobType,
     ParentJob,
     PreprocessingParams,
     RaptGenParams,
@@ -19,10 +21,16 @@ from core.db import (
     ViewerVAE,
     get_db_session,
 )
-from core.jobs import initialize_job_raptgen, run_job_raptgen
-from core.schemas import RaptGenFreqModel, RaptGenModel
+from core.jobs import (
+    delete_unreferenced_checkpoints,
+    initialize_job_raptgen,
+    load_warm_start_checkpoint,
+    run_job_raptgen,
+    run_job_raptgen_ensemble,
+)
+from core.schemas import RaptGenFreqModel, RaptGenModel, RaptGenTrainingParams
 from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from sqlalchemy import func
 from sqlalchemy.orm import Session
 from tasks import celery
@@ -75,7 +83,9 @@ async def get_parent_job(
         - status: The status of the parent job.
         - start: The start time of the parent job.
         - duration: The duration of the parent job.
-        - reiteration: The reiteration count of the parent job.
+        - reiteration: The reiteration count of each configuration of the parent job.
+        - sweep: The search space of the sweep, or None.
+        - num_configurations: The number of configurations of the sweep, 1 without a sweep.
         - params_training: The training parameters of the parent job.
         - params_preprocessing: The preprocessing parameters of the parent job.
         - summary: A summary of all child jobs associated with the parent job.
@@ -140,6 +150,8 @@ async def get_parent_job(
         "start": parent_job.start,
         "duration": parent_job.duration,
         "reiteration": parent_job.reiteration,
+        "sweep": parent_job.sweep,
+        "num_configurations": parent_job.num_configurations or 1,
         "params_training": params_training,
         "params_preprocessing": params_preprocessing,
         "summary": summary,
@@ -280,6 +292,97 @@ async def get_child_job(
     return response
 
 
+class RankedChildJob(BaseModel):
+    id: int
+    status: str
+    epochs_finished: Optional[int] = None
+    minimum_NLL: Optional[float] = None
+    params_training: Optional[RaptGenTrainingParams] = None
+
+
+@router.get(
+    "/api/train/jobs/ranking/{parent_uuid}", response_model=List[RankedChildJob]
+)
+async def rank_child_jobs(
+    parent_uuid: str,
+    session: Session = Depends(get_db_session),
+):
+    """
+    Rank the child jobs of a parent job by their minimum NLL, e.g. to compare
+    the configurations of a sweep.
+
+    Parameters
+    ----------
+    parent_uuid : str
+        The UUID of the parent job.
+    session : Session, optional
+        The database session, by default uses dependency injection to get the session.
+
+    Returns
+    -------
+    List[RankedChildJob]
+        The child jobs from the lowest minimum NLL. Child jobs without a finite
+        minimum NLL come last. Each item includes:
+        - id: The position of the child job on the parent job.
+        - status: The status of the child job.
+        - epochs_finished: The number of finished epochs.
+        - minimum_NLL: The minimum NLL, or None.
+        - params_training: The training parameters of the child job.
+
+    Raises
+    ------
+    HTTPException
+        If the parent job is not found in the database.
+    """
+    parent_job = session.query(ParentJob).filter(ParentJob.uuid == parent_uuid).first()
+    if parent_job is None:
+        raise HTTPException(
+            status_code=422,
+            detail=[
+                {
+                    "loc": ["path", "parent_uuid"],
+                    "msg": "Job not found",
+                    "type": "value_error",
+                }
+            ],
+        )
+
+    ranking: List[RankedChildJob] = []
+    for child_job in parent_job.child_jobs:
+        minimum_NLL: Optional[float] = child_job.minimum_NLL
+        if minimum_NLL is None or not np.isfinite(minimum_NLL):
+            minimum_NLL = None
+        params_training = (
+            session.query(RaptGenParams)
+            .filter(RaptGenParams.child_uuid == child_job.uuid)
+            .first()
+        )
+        ranking.append(
+            RankedChildJob(
+                id=child_job.id,  # type: ignore
+                status=child_job.status,  # type: ignore
+                epochs_finished=child_job.epochs_current,  # type: ignore
+                minimum_NLL=minimum_NLL,
+                params_training=(
+                    RaptGenTrainingParams.model_validate(
+                        params_training, from_attributes=True
+                    )
+                    if params_training is not None
+                    else None
+                ),
+            )
+        )
+    ranking.sort(
+        key=lambda item: (
+            item.minimum_NLL is None,
+            item.minimum_NLL or 0,
+            item.id,
+        )
+    )
+
+    return ranking
+
+
 class SearchPayload(BaseModel):
     status: Optional[List[str]] = None
     search_regex: Optional[str] = None
@@ -301,7 +404,7 @@ async def search_jobs(
         The search parameters.
         status: List of statuses to filter the jobs.
         search_regex: Regular expression to filter the jobs.
-        is_multiple: Boolean to filter reiteration > 2.
+        is_multiple: Boolean to filter parent jobs with more than one child job.
         type: List of types (RaptGen, RaptGen-freq, etc.) to filter the jobs.
     session : Session, optional
         The database session, by default uses dependency injection to get the session.
@@ -348,11 +451,15 @@ async def search_jobs(
         query = query.filter(ParentJob.type.in_(request.type))
 
     # Filter by is_multiple
+    # a sweep has `reiteration` child jobs for each of its configurations
     if request.is_multiple is not None:
+        num_child_jobs = ParentJob.reiteration * func.coalesce(
+            ParentJob.num_configurations, 1
+        )
         if request.is_multiple:
-            query = query.filter(ParentJob.reiteration > 1)
+            query = query.filter(num_child_jobs > 1)
         else:
-            query = query.filter(ParentJob.reiteration == 1)
+            query = query.filter(num_child_jobs == 1)
 
     results = query.all()
 
@@ -380,6 +487,7 @@ async def search_jobs(
                 "start": job.start,
                 "duration": job.duration,
                 "reiteration": job.reiteration,
+                "num_configurations": job.num_configurations or 1,
                 "series": series,
             }
         )
@@ -391,13 +499,57 @@ class JobSubmissionResponse(BaseModel):
     uuid: str
 
 
+# job types of the child jobs trained for each submitted model type
+MODEL_JOB_TYPES = {
+    "RaptGen": JobType.RaptGen,
+    "RaptGen-freq": JobType.RaptGenFreq,
+    "RaptGen-logfreq": JobType.RaptGenLogfreq,
+}
+
+
 @router.post("/api/train/jobs/submit", response_model=JobSubmissionResponse)
 async def run_parent_job(
     request_param: Union[RaptGenModel, RaptGenFreqModel],
     session: Session = Depends(get_db_session),  # Use dependency injection for session
 ):
     # なんでget_db_session()を使わないんだっけ？
-    if isinstance(request_param, RaptGenModel):
+    if isinstance(request_param, (RaptGenModel, RaptGenFreqModel)):
+        # the configurations of a sweep share the dataset of one parent job
+        if request_param.sweep is not None:
+            try:
+                configurations = request_param.sweep.expand(
+                    request_param.params_training
+                )
+            except ValidationError as e:
+                raise HTTPException(
+                    status_code=422,
+                    detail=[
+                        {
+                            "loc": ["body", "sweep", "grid"],
+                            "msg": "Invalid training parameters in the search space",
+                            "type": "value_error",
+                        }
+                    ],
+                ) from e
+        else:
+            configurations = [request_param.params_training]
+
+        # the warm start checkpoints must exist and fit the model
+        for params_training in configurations:
+            try:
+                load_warm_start_checkpoint(session, params_training)
+            except ValueError as e:
+                raise HTTPException(
+                    status_code=422,
+                    detail=[
+                        {
+                            "loc": ["body", "params_training"],
+                            "msg": str(e),
+                            "type": "value_error",
+                        }
+                    ],
+                ) from e
+
         parent_id = str(uuid4())
         session.add(
             ParentJob(
@@ -408,6 +560,12 @@ async def run_parent_job(
                 start=int(time.time()),
                 duration=0,
                 reiteration=request_param.reiteration,
+                sweep=(
+                    request_param.sweep.dict()
+                    if request_param.sweep is not None
+                    else None
+                ),
+                num_configurations=len(configurations),
                 worker_uuid=parent_id,
             )
         )
@@ -437,36 +595,37 @@ async def run_parent_job(
             hide_password=False
         )
 
-        uuids: List[str] = []
-        for i in range(request_param.reiteration):
-            uuid = initialize_job_raptgen(
-                session=session,
-                parent_uuid=parent_id,
-                id=i,
-                params=request_param.params_training,
-            )
-            uuids.append(str(uuid))
-
-        for uuid in uuids:
-            run_job_raptgen.delay(
-                child_uuid=uuid,
-                is_resume=False,
-                database_url=database_url,
-            )
+        # the reiterations of each configuration are numbered consecutively
+        uuids_list: List[List[str]] = []
+        for k, params_training in enumerate(configurations):
+            uuids: List[str] = []
+            for i in range(request_param.reiteration):
+                uuid = initialize_job_raptgen(
+                    session=session,
+                    parent_uuid=parent_id,
+                    id=k * request_param.reiteration + i,
+                    params=params_training,
+                    jobtype=MODEL_JOB_TYPES[request_param.type],
+                )
+                uuids.append(str(uuid))
+            uuids_list.append(uuids)
+
+        for uuids in uuids_list:
+            if request_param.ensemble and len(uuids) > 1:
+                run_job_raptgen_ensemble.delay(
+                    child_uuids=uuids,
+                    database_url=database_url,
+                )
+            else:
+                for uuid in uuids:
+                    run_job_raptgen.delay(
+                        child_uuid=uuid,
+                        is_resume=False,
+                        database_url=database_url,
+                    )
 
         return JobSubmissionResponse(uuid=parent_id)
 
-    elif isinstance(request_param, RaptGenFreqModel):
-        raise HTTPException(
-            status_code=422,
-            detail=[
-                {
-                    "loc": ["body", "type"],
-                    "msg": "RaptGenFreqModel is not supported for now",
-                    "type": "value_error",
-                }
-            ],
-        )
     else:
         raise HTTPException(
             status_code=422,
@@ -716,7 +875,11 @@ async def delete_parent_job(
         await suspend_parent_job(OperationPayload(uuid=parent_uuid), session=session)
 
     child_jobs = session.query(ChildJob).filter(ChildJob.parent_uuid == parent_uuid)
+    checkpoint_refs = set()
     for child_job in child_jobs:
+        checkpoint_refs.update(
+            [child_job.current_checkpoint_ref, child_job.optimal_checkpoint_ref]
+        )
         session.query(SequenceEmbeddings).filter(
             SequenceEmbeddings.child_uuid == child_job.uuid
         ).delete()
@@ -736,6 +899,8 @@ async def delete_parent_job(
     session.delete(parent_job)
     session.commit()
 
+    delete_unreferenced_checkpoints(session, checkpoint_refs)
+
     return None
 
 
@@ -864,7 +1029,10 @@ async def publish_job(
         match_cost=params_training.match_cost,
         phmm_length=params_training.model_length,
         # checkpoint
-        checkpoint=child_job.optimal_checkpoint,
+        checkpoint=read_checkpoint(
+            child_job.optimal_checkpoint_ref,  # type: ignore
+            child_job.optimal_checkpoint,  # type: ignore
+        ),
     )
     session.add(viewer)
 
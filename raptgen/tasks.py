@@ -1,6 +1,6 @@
 from celery import Celery, current_task, Task
 from typing import List, Dict, Any, OrderedDict, Optional
-from core.algorithms import CNN_PHMM_VAE, embed_sequences
+from core.algorithms import CNN_PHMM_VAE, embed_sequences, export_inference_model
 
 import numpy as np
 import pickle
@@ -50,7 +50,7 @@ import core.gmmjobs
 @celery.task(bind=True)
 def batch_encode(self: Task, seqs: List[str], state_dict_pkl: bytes):
     res = _validate_pHMM_model(BytesIO(state_dict_pkl))
-    model = res["data"]["model"]
+    model = export_inference_model(res["data"]["model"])
     self.update_state(
         state="PROGRESS",
         meta={
@@ -58,24 +58,23 @@ def batch_encode(self: Task, seqs: List[str], state_dict_pkl: bytes):
             "total": len(seqs),
         },
     )
-    coord_list = []
+    coords = np.empty((len(seqs), model.embed_size), dtype=np.float32)
 
     count: int = 0
-    chunk_size = len(seqs) // 100
+    chunk_size = max(len(seqs) // 100, 1)
 
     while count < len(seqs):
         chunk = seqs[count : count + chunk_size]
-        arr = embed_sequences(chunk, model)
-        coord_list = coord_list + list(arr)
+        coords[count : count + len(chunk)] = embed_sequences(chunk, model)
         self.update_state(
             state="PROGRESS",
             meta={
-                "current": count + chunk_size,
+                "current": count + len(chunk),
                 "total": len(seqs),
                 "result": np.array([[]]),
             },
         )
 
-        count = count + chunk_size
+        count = count + len(chunk)
 
-    return np.array(coord_list)
+    return coords
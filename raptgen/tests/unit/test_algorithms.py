@@ -0,0 +1,658 @@
+import numpy as np
+import pytest
+import torch
+
+from core.algorithms import (
+    CNN_PHMM_VAE,
+    LatentDecodeTiles,
+    _phmm_forward_backward,
+    _load_glyph_atlas,
+    _phmm_viterbi,
+    embed_sequences,
+    export_inference_model,
+    get_log_likelihood_grid,
+    get_log_likelihoods,
+    get_most_probable_seq,
+    get_viterbi_seqs,
+    profile_hmm_band_cutoff,
+    profile_hmm_loss,
+    profile_hmm_vae_loss,
+    render_logo,
+    sample_sequences,
+)
+from core.preprocessing import ID_encode, NucleotideID, State, Transition
+
+
+def random_phmm_params(batch_size: int, motif_len: int, seed: int = 0):
+    gen = torch.Generator().manual_seed(seed)
+    logits = torch.randn(batch_size, motif_len + 1, 7, generator=gen)
+    transition_probs = torch.cat(
+        (
+            logits[:, :, 0:3].log_softmax(dim=2),
+            logits[:, :, 3:5].log_softmax(dim=2),
+            logits[:, :, 5:7].log_softmax(dim=2),
+        ),
+        dim=2,
+    )
+    emission_probs = torch.randn(batch_size, motif_len, 4, generator=gen).log_softmax(
+        dim=2
+    )
+    return transition_probs.requires_grad_(), emission_probs.requires_grad_()
+
+
+def random_batch(lengths, max_length: int, seed: int = 0):
+    gen = torch.Generator().manual_seed(seed)
+    batch = torch.full((len(lengths), max_length), int(NucleotideID.PAD))
+    for i, length in enumerate(lengths):
+        batch[i, :length] = torch.randint(0, 4, (length,), generator=gen)
+    return batch
+
+
+def loss_and_grads(transition_probs, emission_probs, batch, **kwargs):
+    transition_probs.grad = None
+    emission_probs.grad = None
+    loss = profile_hmm_loss(
+        transition_probs=transition_probs,
+        emission_probs=emission_probs,
+        batch_input=batch,
+        **kwargs,
+    )
+    loss.sum().backward()
+    return (
+        loss.detach().reshape(-1),
+        transition_probs.grad.clone(),
+        emission_probs.grad.clone(),
+    )
+
+
+@pytest.mark.parametrize("lengths", [[10] * 6, [7, 9, 10, 8, 10, 7]])
+def test_wavefront_engine_matches_loop(lengths):
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=8)
+    batch = random_batch(lengths, max_length=10)
+
+    expected = loss_and_grads(
+        transition_probs, emission_probs, batch, engine="loop", padded=False
+    )
+    actual = loss_and_grads(
+        transition_probs, emission_probs, batch, engine="wavefront", padded=False
+    )
+
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+
+
+@pytest.mark.parametrize("engine", ["loop", "wavefront"])
+def test_padded_batch_matches_grouped(engine):
+    lengths = [7, 9, 10, 8, 10, 7]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=8)
+    batch = random_batch(lengths, max_length=12)
+
+    expected = loss_and_grads(
+        transition_probs, emission_probs, batch, engine=engine, padded=False
+    )
+    actual = loss_and_grads(
+        transition_probs, emission_probs, batch, engine=engine, padded=True
+    )
+
+    assert actual[0].shape == (len(lengths),)
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+
+
+def test_padded_batch_with_left_padding():
+    transition_probs, emission_probs = random_phmm_params(2, motif_len=6)
+    right = random_batch([6, 8], max_length=8)
+    left = right.clone()
+    left[0] = torch.cat((right[0, 6:], right[0, :6]))
+
+    expected = loss_and_grads(transition_probs, emission_probs, right)
+    actual = loss_and_grads(transition_probs, emission_probs, left)
+
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+
+
+@pytest.mark.parametrize("padded", [False, True])
+def test_forward_backward_engine_matches_loop(padded):
+    lengths = [7, 9, 10, 8, 10, 7]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=8)
+    batch = random_batch(lengths, max_length=10)
+
+    expected = loss_and_grads(
+        transition_probs, emission_probs, batch, engine="loop", padded=False
+    )
+    actual = loss_and_grads(
+        transition_probs,
+        emission_probs,
+        batch,
+        engine="forward_backward",
+        padded=padded,
+    )
+
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+
+
+def test_forward_backward_gradcheck():
+    lengths = [4, 6, 5]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=4)
+    transition_probs = transition_probs.detach().double().requires_grad_()
+    emission_probs = emission_probs.detach().double().requires_grad_()
+    seqs = random_batch(lengths, max_length=6)
+    seqs[seqs == int(NucleotideID.PAD)] = 0
+
+    assert torch.autograd.gradcheck(
+        lambda a, e_m: _phmm_forward_backward(a, e_m, seqs, torch.tensor(lengths)),
+        (transition_probs, emission_probs),
+    )
+
+
+@pytest.mark.parametrize("band_width", [0, 2, 5])
+def test_banded_engines_match_loop(band_width):
+    lengths = [9, 10, 12, 10, 11, 9]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=10)
+    batch = random_batch(lengths, max_length=12)
+
+    expected = loss_and_grads(
+        transition_probs,
+        emission_probs,
+        batch,
+        engine="loop",
+        padded=False,
+        band_width=band_width,
+    )
+    for engine in ["loop", "wavefront", "forward_backward"]:
+        actual = loss_and_grads(
+            transition_probs,
+            emission_probs,
+            batch,
+            engine=engine,
+            padded=True,
+            band_width=band_width,
+        )
+        for e, a in zip(expected, actual):
+            assert torch.allclose(e, a, atol=1e-4)
+
+
+def test_wide_band_matches_full_table():
+    lengths = [7, 9, 10, 8]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=8)
+    batch = random_batch(lengths, max_length=10)
+
+    expected = loss_and_grads(transition_probs, emission_probs, batch)
+    actual = loss_and_grads(transition_probs, emission_probs, batch, band_width=10)
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-5)
+
+    narrow = loss_and_grads(transition_probs, emission_probs, batch, band_width=1)
+    assert torch.all(narrow[0] >= expected[0] - 1e-5)
+
+
+def test_band_cutoff():
+    lengths = [7, 9, 10, 8]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=8)
+    batch = random_batch(lengths, max_length=10)
+
+    cutoffs = [
+        profile_hmm_band_cutoff(transition_probs, emission_probs, batch, band_width=w)
+        for w in [1, 3, 10]
+    ]
+    assert all(c.shape == (len(lengths),) for c in cutoffs)
+    assert torch.all(cutoffs[0] >= cutoffs[1] - 1e-6)
+    assert torch.all(cutoffs[1] >= cutoffs[2] - 1e-6)
+    assert torch.allclose(cutoffs[2], torch.zeros(len(lengths)), atol=1e-5)
+
+    with pytest.raises(ValueError):
+        profile_hmm_loss(transition_probs, emission_probs, batch, band_width=-1)
+
+
+@pytest.mark.parametrize("band_width", [None, 3])
+def test_inference_engine_matches_wavefront(band_width):
+    lengths = [9, 10, 12, 10, 11, 9]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=10)
+    batch = random_batch(lengths, max_length=12)
+
+    with torch.no_grad():
+        expected = profile_hmm_loss(
+            transition_probs, emission_probs, batch, band_width=band_width
+        )
+        actual = profile_hmm_loss(
+            transition_probs,
+            emission_probs,
+            batch,
+            engine="inference",
+            band_width=band_width,
+        )
+
+    assert actual.shape == (len(lengths),)
+    assert torch.allclose(expected, actual, atol=1e-4)
+
+
+@pytest.mark.parametrize("band_width", [None, 2])
+def test_inference_engine_matches_loop_on_long_reads(band_width):
+    # reads longer than 2 * motif_len are only reachable through the -100 cells
+    lengths = [30, 12, 25, 11]
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=5)
+    batch = random_batch(lengths, max_length=30)
+
+    with torch.no_grad():
+        expected = profile_hmm_loss(
+            transition_probs,
+            emission_probs,
+            batch,
+            engine="loop",
+            band_width=band_width,
+        )
+        actual = profile_hmm_loss(
+            transition_probs,
+            emission_probs,
+            batch,
+            engine="inference",
+            band_width=band_width,
+        )
+
+    assert torch.isfinite(actual).all()
+    assert torch.allclose(expected, actual, atol=1e-4)
+
+
+def test_inference_engine_rejects_autograd():
+    transition_probs, emission_probs = random_phmm_params(2, motif_len=4)
+    batch = random_batch([5, 5], max_length=5)
+    with pytest.raises(ValueError):
+        profile_hmm_loss(transition_probs, emission_probs, batch, engine="inference")
+
+
+def test_unknown_engine():
+    transition_probs, emission_probs = random_phmm_params(2, motif_len=4)
+    batch = random_batch([5, 5], max_length=5)
+    with pytest.raises(ValueError):
+        profile_hmm_loss(transition_probs, emission_probs, batch, engine="unknown")
+
+
+@pytest.mark.parametrize("force_matching", [False, True])
+def test_weighted_vae_loss_matches_expanded_batch(force_matching):
+    lengths = [9, 10, 12]
+    duplicates = torch.tensor([3, 1, 2])
+    transition_probs, emission_probs = random_phmm_params(len(lengths), motif_len=10)
+    batch = random_batch(lengths, max_length=12)
+    gen = torch.Generator().manual_seed(0)
+    mus = torch.randn(len(lengths), 2, generator=gen)
+    logvars = torch.randn(len(lengths), 2, generator=gen)
+
+    def vae_loss(index, **kwargs):
+        return profile_hmm_vae_loss(
+            batch_input=batch[index],
+            transition_probs=transition_probs[index],
+            emission_probs=emission_probs[index],
+            mus=mus[index],
+            logvars=logvars[index],
+            force_matching=force_matching,
+            split_ce_kld=True,
+            **kwargs,
+        )
+
+    expanded = vae_loss(torch.arange(len(lengths)).repeat_interleave(duplicates))
+    weighted = vae_loss(torch.arange(len(lengths)), weights=duplicates)
+    uniform = vae_loss(torch.arange(len(lengths)), weights=torch.ones(len(lengths)))
+    unweighted = vae_loss(torch.arange(len(lengths)))
+
+    assert torch.allclose(weighted, expanded, atol=1e-5)
+    assert torch.allclose(uniform, unweighted, atol=1e-5)
+
+
+def test_vae_loss_of_stacked_replicas():
+    lengths = [9, 10, 12]
+    weights = torch.tensor([3.0, 1.0, 2.0])
+    transition_probs, emission_probs = random_phmm_params(2 * len(lengths), 10)
+    batch = random_batch(lengths, max_length=12)
+    gen = torch.Generator().manual_seed(0)
+    mus = torch.randn(2 * len(lengths), 2, generator=gen)
+    logvars = torch.randn(2 * len(lengths), 2, generator=gen)
+
+    stacked = profile_hmm_vae_loss(
+        batch_input=batch.repeat(2, 1),
+        transition_probs=transition_probs,
+        emission_probs=emission_probs,
+        mus=mus,
+        logvars=logvars,
+        split_ce_kld=True,
+        weights=weights.repeat(2),
+        replicas=2,
+    )
+    assert stacked.shape == (2, 2)
+    for replica, index in enumerate(torch.arange(2 * len(lengths)).chunk(2)):
+        separate = profile_hmm_vae_loss(
+            batch_input=batch,
+            transition_probs=transition_probs[index],
+            emission_probs=emission_probs[index],
+            mus=mus[index],
+            logvars=logvars[index],
+            split_ce_kld=True,
+            weights=weights,
+        )
+        assert torch.allclose(stacked[:, replica], separate, atol=1e-5)
+
+
+def test_most_probable_seq_batch_matches_single():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=12, embed_size=2)
+    model.eval()
+    coords = list(np.random.RandomState(0).randn(50, 2) * 3)
+
+    seqs, states = get_most_probable_seq(coords, model)
+
+    assert len(seqs) == len(states) == len(coords)
+    for coord, seq, path in zip(coords, seqs, states):
+        single_seqs, single_states = get_most_probable_seq([coord], model)
+        assert single_seqs == [seq]
+        assert single_states == [path]
+
+        # every state except the start and the end emits exactly one character
+        assert path[0] == (0, State.M)
+        assert path[-1][0] == 13
+        assert len(seq) == len(path) - 2
+        for char, (_, state) in zip(seq, path[1:-1]):
+            if state == State.M:
+                assert char in "ATGC"
+            else:
+                assert char == {State.I: "N", State.D: "_"}[state]
+
+
+def enumerate_phmm_paths(a, e_m, max_inserts):
+    """Enumerate every (path, sequence) pair with at most `max_inserts` consecutive inserts."""
+    motif_len = e_m.shape[0]
+    log_quarter = np.log(1 / 4)
+    to_m = {State.M: Transition.M2M, State.I: Transition.I2M, State.D: Transition.D2M}
+    to_d = {State.M: Transition.M2D, State.D: Transition.D2D}
+    results = []
+
+    def walk(k, state, score, seq):
+        for run in range(max_inserts + 1 if state == State.M else 1):
+            last, s, q = state, score, seq
+            for i in range(run):
+                s += a[k, Transition.M2I if i == 0 else Transition.I2I] + log_quarter
+                last, q = State.I, q + "N"
+            if k == motif_len:
+                results.append((s + a[k, to_m[last]], q))
+                continue
+            for c in range(4):
+                walk(k + 1, State.M, s + a[k, to_m[last]] + e_m[k, c], q + "ATGC"[c])
+            if last in to_d:
+                walk(k + 1, State.D, s + a[k, to_d[last]], q + "_")
+
+    walk(0, State.M, 0.0, "")
+    return sorted(results, key=lambda x: -x[0])
+
+
+def test_viterbi_matches_enumeration():
+    top_k = 6
+    transition_probs, emission_probs = random_phmm_params(3, motif_len=2, seed=1)
+    transition_probs = transition_probs.detach()
+    emission_probs = emission_probs.detach()
+
+    seqs, log_probs = _phmm_viterbi(transition_probs, emission_probs, top_k=top_k)
+
+    for i in range(3):
+        expected = enumerate_phmm_paths(
+            transition_probs[i].double().numpy(),
+            emission_probs[i].double().numpy(),
+            max_inserts=top_k + 1,
+        )[:top_k]
+        assert seqs[i] == [seq for _, seq in expected]
+        assert np.allclose(log_probs[i], [score for score, _ in expected], atol=1e-4)
+
+
+def test_viterbi_not_worse_than_greedy():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=12, embed_size=2)
+    model.eval()
+    coords = list(np.random.RandomState(0).randn(20, 2) * 3)
+
+    greedy_seqs, _ = get_most_probable_seq(coords, model)
+    seqs, log_probs = get_viterbi_seqs(coords, model, top_k=3)
+
+    with torch.no_grad():
+        transition_probs, emission_probs = model.decoder(torch.Tensor(np.array(coords)))
+    for i, greedy in enumerate(greedy_seqs):
+        assert len(seqs[i]) == 3 and len(set(seqs[i])) == 3
+        assert log_probs[i] == sorted(log_probs[i], reverse=True)
+        score = _score_path(transition_probs[i], emission_probs[i], greedy)
+        assert log_probs[i][0] >= score - 1e-4
+
+
+def _score_path(a, e_m, seq):
+    """Log-probability of the (path, sequence) pair written as in get_most_probable_seq."""
+    score, k, state = 0.0, 0, State.M
+    trans = {
+        (State.M, State.M): Transition.M2M,
+        (State.M, State.I): Transition.M2I,
+        (State.M, State.D): Transition.M2D,
+        (State.I, State.M): Transition.I2M,
+        (State.I, State.I): Transition.I2I,
+        (State.D, State.M): Transition.D2M,
+        (State.D, State.D): Transition.D2D,
+    }
+    for char in seq:
+        nxt = {"N": State.I, "_": State.D}.get(char, State.M)
+        score += float(a[k, trans[(state, nxt)]])
+        if nxt != State.I:
+            k += 1
+        if nxt == State.M:
+            score += float(e_m[k - 1, "ATGC".index(char)])
+        elif nxt == State.I:
+            score += np.log(1 / 4)
+        state = nxt
+    return score + float(a[k, trans[(state, State.M)]])
+
+
+def test_embed_sequences_restores_input_order():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2)
+    rng = np.random.RandomState(0)
+    sequences = [
+        "".join(rng.choice(list("AUGC"), rng.randint(8, 12))) for _ in range(30)
+    ]
+
+    coords = embed_sequences(sequences, model, max_batch_size=4)
+
+    assert coords.shape == (len(sequences), 2)
+    assert coords.dtype == np.float32
+    for sequence, coord in zip(sequences, coords):
+        assert np.allclose(embed_sequences([sequence], model)[0], coord, atol=1e-5)
+    assert embed_sequences([], model).shape == (0, 2)
+
+
+def test_render_logo_uses_cached_glyphs():
+    from matplotlib import font_manager
+
+    font_file = font_manager.findfont("DejaVu Sans")
+    assert _load_glyph_atlas(font_file, "AUGC") is _load_glyph_atlas(font_file, "AUGC")
+
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=12, embed_size=2).eval()
+    for calc_h_em in [True, False]:
+        image = render_logo(
+            np.array([0.5, -0.5]),
+            model,
+            calc_h_em=calc_h_em,
+            font_file=font_file,
+            size=(600, 180),
+        )
+        assert image.mode == "RGB"
+        assert image.size == (600, 180)
+        # some pixels are painted with the nucleotide colours
+        assert len(image.getcolors(maxcolors=600 * 180)) > 2
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 4, 1024])
+def test_log_likelihoods_match_profile_hmm_loss(max_batch_size):
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    rng = np.random.default_rng(0)
+    sequences = [
+        "".join(rng.choice(list("AUGC"), length)) for length in [9, 6, 8, 9, 7]
+    ]
+    coords = list(rng.normal(size=(3, 2)).astype(np.float32))
+
+    log_likelihoods = get_log_likelihoods(
+        sequences, coords, model, max_batch_size=max_batch_size
+    )
+    assert log_likelihoods.shape == (5, 3)
+
+    with torch.no_grad():
+        transition_probs, emission_probs = model.decoder(torch.tensor(np.array(coords)))
+        for n, seq in enumerate(sequences):
+            batch = torch.tensor([ID_encode(seq)] * len(coords))
+            expected = -profile_hmm_loss(transition_probs, emission_probs, batch)
+            np.testing.assert_allclose(log_likelihoods[n], expected, atol=1e-4)
+
+    grid_x, grid_y, grid = get_log_likelihood_grid(
+        sequences, model, (-1, 1), (0, 2), resolution=4
+    )
+    assert grid.shape == (5, 4, 4)
+    np.testing.assert_allclose(
+        grid[:, 2, 1],
+        get_log_likelihoods(sequences, [np.array([grid_x[1], grid_y[2]])], model)[:, 0],
+    )
+
+
+def test_sample_sequences():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=6, embed_size=2).eval()
+    coords = list(np.random.default_rng(0).normal(size=(3, 2)).astype(np.float32))
+
+    seqs, log_probs = sample_sequences(coords, model, num_samples=200, seed=0)
+    assert len(seqs) == 3 and all(len(samples) == 200 for samples in seqs)
+    assert log_probs.shape == (3, 200)
+    assert all(set(seq) <= set("ATGC") for samples in seqs for seq in samples)
+
+    same_seqs, same_log_probs = sample_sequences(coords, model, num_samples=200, seed=0)
+    assert seqs == same_seqs
+    np.testing.assert_array_equal(log_probs, same_log_probs)
+
+    # a single path is never more probable than the sequence itself or the Viterbi path
+    _, viterbi_log_probs = get_viterbi_seqs(coords, model)
+    log_likelihoods = get_log_likelihoods(
+        [seq for samples in seqs for seq in samples], coords, model
+    )
+    for n in range(len(coords)):
+        assert np.all(log_probs[n] <= viterbi_log_probs[n][0] + 1e-4)
+        sample_log_likelihoods = log_likelihoods[n * 200 : (n + 1) * 200, n]
+        assert np.all(log_probs[n] <= sample_log_likelihoods + 1e-4)
+
+    # batches that straddle the coordinates keep each sample on its own pHMM
+    seqs, log_probs = sample_sequences(
+        coords, model, num_samples=5, seed=0, max_batch_size=7
+    )
+    assert [len(samples) for samples in seqs] == [5, 5, 5]
+    log_likelihoods = get_log_likelihoods(
+        [seq for samples in seqs for seq in samples], coords, model
+    )
+    for n in range(len(coords)):
+        assert np.all(log_probs[n] <= log_likelihoods[n * 5 : (n + 1) * 5, n] + 1e-4)
+
+
+def test_exported_model_matches_eager():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2)
+    # update the BatchNorm running statistics so that fusing them is not trivial
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randint(0, 4, (16, 12)))
+    model.eval()
+    exported = export_inference_model(model)
+    assert isinstance(exported.encoder, torch.jit.ScriptModule)
+    assert isinstance(exported.decoder, torch.jit.ScriptModule)
+
+    rng = np.random.default_rng(0)
+    sequences = [
+        "".join(rng.choice(list("AUGC"), length)) for length in [12, 9, 12, 15, 1]
+    ]
+    np.testing.assert_allclose(
+        embed_sequences(sequences, exported),
+        embed_sequences(sequences, model),
+        atol=1e-5,
+    )
+
+    coords = torch.tensor(rng.normal(size=(4, 2)), dtype=torch.float32)
+    with torch.no_grad():
+        for exported_probs, eager_probs in zip(
+            exported.decoder(coords), model.decoder(coords)
+        ):
+            torch.testing.assert_close(exported_probs, eager_probs)
+
+
+def test_quantized_model_is_close_to_eager():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    quantized = export_inference_model(model, quantize=True)
+    assert isinstance(quantized.encoder, torch.jit.ScriptModule)
+
+    rng = np.random.default_rng(0)
+    sequences = ["".join(rng.choice(list("AUGC"), 12)) for _ in range(50)]
+    eager_coords = embed_sequences(sequences, model)
+    quantized_coords = embed_sequences(sequences, quantized)
+    assert not np.array_equal(quantized_coords, eager_coords)
+    np.testing.assert_allclose(quantized_coords, eager_coords, atol=5e-2)
+
+    coords = torch.tensor(eager_coords)
+    with torch.no_grad():
+        for quantized_probs, eager_probs in zip(
+            quantized.decoder(coords), model.decoder(coords)
+        ):
+            torch.testing.assert_close(
+                quantized_probs.exp(), eager_probs.exp(), atol=5e-2, rtol=0
+            )
+
+
+def test_latent_decode_tiles():
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=6, embed_size=2).eval()
+    tiles = LatentDecodeTiles(
+        model, (-2, 2), (-1, 3), base_resolution=5, num_levels=2, tile_size=4
+    )
+
+    # lattice points are answered exactly, including the narrower border tiles
+    rng = np.random.default_rng(0)
+    for level, resolution in enumerate(tiles.resolutions):
+        lattice_x = np.linspace(-2, 2, resolution)
+        lattice_y = np.linspace(-1, 3, resolution)
+        coords = [
+            np.array([lattice_x[i], lattice_y[j]])
+            for i, j in rng.integers(0, resolution, (20, 2))
+        ] + [np.array([2, 3])]
+        sequences, transition_probs, emission_probs, inside = tiles.lookup(
+            coords, level=level
+        )
+        assert inside.all()
+        assert sequences == get_most_probable_seq(coords, model)[0]
+        with torch.no_grad():
+            expected = model.decoder(
+                torch.tensor(np.array(coords), dtype=torch.float32)
+            )
+        np.testing.assert_allclose(transition_probs, expected[0], atol=1e-5)
+        np.testing.assert_allclose(emission_probs, expected[1], atol=1e-5)
+
+    # off-lattice points snap to the nearest lattice point of the finest level
+    lattice_x = np.linspace(-2, 2, tiles.resolutions[-1])
+    lattice_y = np.linspace(-1, 3, tiles.resolutions[-1])
+    coords = [np.array([0.05, 1.05]), np.array([-1.9, 2.6])]
+    snapped = [
+        np.array(
+            [
+                lattice_x[np.abs(lattice_x - x).argmin()],
+                lattice_y[np.abs(lattice_y - y).argmin()],
+            ]
+        )
+        for x, y in coords
+    ]
+    _, transition_probs, _, _ = tiles.lookup(coords)
+    with torch.no_grad():
+        expected = model.decoder(torch.tensor(np.array(snapped), dtype=torch.float32))
+    np.testing.assert_allclose(transition_probs, expected[0], atol=1e-5)
+
+    # points outside the lattice and exact requests are decoded directly
+    coords = [np.array([0.05, 1.05]), np.array([5.0, 0.0])]
+    assert tiles.decode(coords)[1] == get_most_probable_seq(coords[1:], model)[0][0]
+    assert tiles.decode(coords, exact=True) == get_most_probable_seq(coords, model)[0]
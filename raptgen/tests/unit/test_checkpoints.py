@@ -0,0 +1,46 @@
+import os
+
+import pytest
+import torch
+
+from core.checkpoints import CheckpointStore, CheckpointWriter, read_checkpoint
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_checkpoint_store_round_trip(tmp_path, compress):
+    """Test that stored checkpoints are read back and deduplicated."""
+    store = CheckpointStore(root=str(tmp_path), compress=compress)
+    checkpoint = {"model": {"weight": torch.arange(6.0).reshape(2, 3)}, "epoch": 3}
+
+    ref = store.save(checkpoint)
+    assert ref.endswith(".gz") == compress
+    assert store.save(checkpoint) == ref
+    assert len(os.listdir(tmp_path / ref[:2])) == 1
+
+    loaded = store.load(ref)
+    assert loaded["epoch"] == 3
+    assert torch.equal(loaded["model"]["weight"], checkpoint["model"]["weight"])
+
+    store.delete(ref)
+    store.delete(ref)
+    with pytest.raises(FileNotFoundError):
+        store.get(ref)
+    with pytest.raises(ValueError):
+        store.get("../" + ref)
+
+
+def test_checkpoint_writer_snapshots_tensors(tmp_path):
+    """Test that the writer stores the state at submission, not at write time."""
+    store = CheckpointStore(root=str(tmp_path))
+    writer = CheckpointWriter(store)
+    weight = torch.zeros(4)
+
+    future = writer.submit({"weight": weight})
+    weight += 1
+    writer.close()
+
+    assert torch.equal(store.load(future.result())["weight"], torch.zeros(4))
+    assert read_checkpoint(future.result(), b"legacy", store=store) == store.get(
+        future.result()
+    )
+    assert read_checkpoint(None, b"legacy", store=store) == b"legacy"
@@ -6,6 +6,7 @@ import os
 
 # internal package
 from core.preprocessing import one_hot_encode, ID_encode
+from core.train import LengthBucketBatchSampler, sequence_lengths, trim_padding
 
 
 def test_one_hot_index():
@@ -118,3 +119,80 @@ def test_one_hot_encode():
         ),
         expected_output,
     )
+
+
+def test_length_bucket_batch_sampler():
+    """Test that LengthBucketBatchSampler batches sequences of close lengths."""
+    lengths = [5] * 7 + [6] * 4 + [7] * 1 + [8] * 3
+    sampler = LengthBucketBatchSampler(
+        lengths, batch_size=4, generator=torch.Generator().manual_seed(0)
+    )
+    assert len(sampler) == 4
+
+    epochs = [list(sampler) for _ in range(2)]
+    for batches in epochs:
+        assert len(batches) == len(sampler)
+        assert sorted(sum(batches, [])) == list(range(len(lengths)))
+        assert all(3 <= len(batch) <= 4 for batch in batches)
+        # batches are cut from the sequences sorted by length
+        spans = sorted(
+            (min(lengths[i] for i in b), max(lengths[i] for i in b)) for b in batches
+        )
+        assert all(
+            high <= next_low for (_, high), (next_low, _) in zip(spans, spans[1:])
+        )
+    # reshuffled every epoch
+    assert epochs[0] != epochs[1]
+
+    sampler = LengthBucketBatchSampler(lengths, batch_size=4, shuffle=False)
+    assert list(sampler)[:2] == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    # a single batch is kept when splitting would leave a batch of one
+    assert list(LengthBucketBatchSampler([5, 6, 7], batch_size=2, shuffle=False)) == [
+        [0, 1, 2]
+    ]
+
+
+def test_trim_padding():
+    """Test that trim_padding removes the columns padded in every sequence."""
+    batch = torch.tensor(
+        [
+            ID_encode("ATGC", right_padding=3),
+            ID_encode("ATG", right_padding=4),
+        ]
+    )
+    assert sequence_lengths(batch).tolist() == [4, 3]
+    assert torch.equal(trim_padding(batch), batch[:, :4])
+
+
+def test_empty_batch():
+    """Test that an empty batch or split is handled instead of raising."""
+    for batch in [torch.tensor([]), torch.empty((0, 7), dtype=torch.long)]:
+        assert sequence_lengths(batch).tolist() == []
+        assert trim_padding(batch) is batch
+
+    sampler = LengthBucketBatchSampler(
+        sequence_lengths(torch.tensor([])).tolist(), batch_size=2
+    )
+    assert len(sampler) == 0
+    assert list(sampler) == []
+
+
+def test_length_bucket_batch_sampler_order_generator():
+    """Test that samplers sharing the order generator batch the same lengths."""
+    lengths = [5] * 7 + [6] * 4 + [7] * 1 + [8] * 3
+    samplers = [
+        LengthBucketBatchSampler(
+            lengths,
+            batch_size=4,
+            generator=torch.Generator().manual_seed(seed),
+            order_generator=torch.Generator().manual_seed(0),
+        )
+        for seed in [1, 2]
+    ]
+    for _ in range(2):
+        first, second = [list(sampler) for sampler in samplers]
+        assert first != second
+        assert [sorted(lengths[i] for i in batch) for batch in first] == [
+            sorted(lengths[i] for i in batch) for batch in second
+        ]
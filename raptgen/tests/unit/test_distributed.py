@@ -0,0 +1,66 @@
+import threading
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from core.distributed import DataParallelGroup
+
+
+def run_ranks(size, target):
+    """Run `target(group)` for every rank in threads and return the results."""
+    store = dist.TCPStore("127.0.0.1", 0, size, is_master=True, wait_for_workers=False)
+    results = [None] * size
+
+    def run(rank):
+        group = (
+            DataParallelGroup(0, size, store, timedelta(seconds=30))
+            if rank == 0
+            else DataParallelGroup.join(rank, size, store.port, timedelta(seconds=30))
+        )
+        results[rank] = target(group)
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    return results
+
+
+def test_data_parallel_group_shards_batches():
+    """Test that every rank takes the same number of steps over disjoint batches."""
+    results = run_ranks(3, lambda group: list(group.shard(range(7))))
+    assert results == [[0, 3, 6], [1, 4, None], [2, 5, None]]
+
+    results = run_ranks(
+        2, lambda group: (group.broadcast_flag(group.rank == 0), group.rank)
+    )
+    assert results == [(True, 0), (True, 1)]
+
+
+def test_data_parallel_group_averages_gradients():
+    """Test that the gradients are averaged with the batch weights of the ranks."""
+    inputs = [torch.tensor([[1.0, 2.0]]), torch.tensor([[3.0, -1.0], [0.5, 0.5]])]
+    weights = [1.0, 3.0]
+
+    def target(group):
+        torch.manual_seed(0)
+        model = nn.Linear(2, 1)
+        loss = model(inputs[group.rank]).sum() / len(inputs[group.rank])
+        (loss * weights[group.rank]).backward()
+        group.average_gradients([model], weights[group.rank])
+        return model.weight.grad
+
+    results = run_ranks(2, target)
+
+    torch.manual_seed(0)
+    model = nn.Linear(2, 1)
+    loss = sum(
+        model(x).sum() / len(x) * weight for x, weight in zip(inputs, weights)
+    ) / sum(weights)
+    loss.backward()
+
+    for grad in results:
+        assert torch.allclose(grad, model.weight.grad)
@@ -9,7 +9,15 @@ import pandas as pd
 import os
 import numpy as np
 
-from core.jobs import run_job_raptgen, ChildJobTask, initialize_job_raptgen
+from core.jobs import (
+    run_job_raptgen,
+    run_job_raptgen_ensemble,
+    ChildJobTask,
+    initialize_job_raptgen,
+    load_warm_start_checkpoint,
+    _halving_survivors,
+    _is_halving_rung,
+)
 from core.db import (
     BaseSchema,
     ParentJob,
@@ -17,9 +25,12 @@ from core.db import (
     SequenceData,
     PreprocessingParams,
     RaptGenParams,
+    SequenceEmbeddings,
+    TrainingLosses,
 )
 from core.schemas import RaptGenTrainingParams
 from tasks import celery
+from core import checkpoints
 
 
 raptgen_parent_params = {
@@ -150,6 +161,12 @@ def celery_config():
     }
 
 
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    # keep the checkpoints written by the jobs out of the working copy
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+
+
 @pytest.fixture
 def db_session(postgresql):
     connection = f"postgresql+psycopg2://{postgresql.info.user}:@{postgresql.info.host}:{postgresql.info.port}/{postgresql.info.dbname}"
@@ -237,6 +254,226 @@ def test_job_raptgen_valid_train(db_session, celery_worker):
     status = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first().status
     assert status == "success"
 
+    # the embeddings of the optimal checkpoint are written once for every sequence
+    num_sequences = (
+        db_session.query(SequenceData)
+        .filter(SequenceData.parent_uuid == "8aab26d7-7657-47fa-b624-ed752864ae76")
+        .count()
+    )
+    embeddings = (
+        db_session.query(SequenceEmbeddings)
+        .filter(SequenceEmbeddings.child_uuid == uuid)
+        .all()
+    )
+    assert len(embeddings) == num_sequences
+    assert all(embedding.coord_x is not None for embedding in embeddings)
+
+
+def test_job_raptgen_ensemble_train(db_session, celery_worker):
+    url = db_session.get_bind().url.render_as_string(hide_password=False)
+
+    params = RaptGenTrainingParams(
+        model_length=10,
+        epochs=2,
+        match_forcing_duration=1,
+        beta_duration=1,
+        early_stopping=1,
+        seed_value=1,
+        match_cost=4,
+        device="CPU",
+    )
+
+    uuids = [
+        str(
+            initialize_job_raptgen(
+                id=i,
+                parent_uuid="8aab26d7-7657-47fa-b624-ed752864ae76",
+                params=params,
+                session=db_session,
+            )
+        )
+        for i in range(3)
+    ]
+
+    asyncres: AbortableAsyncResult = run_job_raptgen_ensemble.delay(
+        child_uuids=uuids,
+        database_url=url,
+    )
+    asyncres.wait()
+    db_session.commit()
+
+    # every child job of the ensemble is trained and recorded separately
+    for uuid in uuids:
+        child_job = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first()
+        assert child_job.status == "success"
+        assert child_job.worker_uuid == asyncres.id
+        assert child_job.optimal_checkpoint_ref is not None
+        num_losses = (
+            db_session.query(TrainingLosses)
+            .filter(TrainingLosses.child_uuid == uuid)
+            .count()
+        )
+        assert num_losses == child_job.epochs_current
+        assert (
+            db_session.query(SequenceEmbeddings)
+            .filter(SequenceEmbeddings.child_uuid == uuid)
+            .count()
+            > 0
+        )
+
+
+def test_job_raptgen_pipelined_validation(db_session, celery_worker):
+    url = db_session.get_bind().url.render_as_string(hide_password=False)
+
+    params = RaptGenTrainingParams(
+        **raptgen_training_params | {"epochs": 3, "pipelined_validation": True}
+    )
+    uuid = str(
+        initialize_job_raptgen(
+            id=0,
+            parent_uuid="8aab26d7-7657-47fa-b624-ed752864ae76",
+            params=params,
+            session=db_session,
+        )
+    )
+    run_job_raptgen.delay(child_uuid=uuid, database_url=url).wait()
+    db_session.commit()
+
+    # every epoch is validated and recorded, the last one after training ends
+    child_job = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first()
+    assert child_job.status == "success"
+    assert child_job.epochs_current == 3
+    losses = (
+        db_session.query(TrainingLosses)
+        .filter(TrainingLosses.child_uuid == uuid)
+        .order_by(TrainingLosses.epoch)
+        .all()
+    )
+    assert [loss.epoch for loss in losses] == [0, 1, 2]
+    assert child_job.minimum_NLL == min(loss.test_loss for loss in losses)
+    assert child_job.optimal_checkpoint_ref is not None
+
+
+def test_job_raptgen_checkpoint_files(db_session, celery_worker, tmp_path):
+    url = db_session.get_bind().url.render_as_string(hide_password=False)
+
+    params = RaptGenTrainingParams(
+        **raptgen_training_params | {"epochs": 4, "early_stopping": 10}
+    )
+    uuid = str(
+        initialize_job_raptgen(
+            id=0,
+            parent_uuid="8aab26d7-7657-47fa-b624-ed752864ae76",
+            params=params,
+            session=db_session,
+        )
+    )
+
+    # a job resumed before its first checkpoint was written starts over
+    child_job = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first()
+    child_job.epochs_current = 2
+    child_job.status = "suspend"
+    child_job.datetime_laststop = 0
+    db_session.commit()
+
+    run_job_raptgen.delay(child_uuid=uuid, database_url=url, is_resume=True).wait()
+    db_session.commit()
+
+    child_job = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first()
+    assert child_job.status == "success"
+    assert child_job.epochs_current == 4
+    assert (
+        db_session.query(TrainingLosses)
+        .filter(TrainingLosses.child_uuid == uuid)
+        .count()
+        == 4
+    )
+
+    # the replaced checkpoint files are deleted
+    files = [
+        name
+        for _, _, names in os.walk(tmp_path / "checkpoints")
+        for name in names
+        if not name.endswith(".tmp")
+    ]
+    assert sorted(files) == sorted(
+        {child_job.current_checkpoint_ref, child_job.optimal_checkpoint_ref}
+    )
+
+
+def test_job_raptgen_warm_start(db_session, celery_worker):
+    url = db_session.get_bind().url.render_as_string(hide_password=False)
+
+    params = RaptGenTrainingParams(**raptgen_training_params)
+    source_uuid = str(
+        initialize_job_raptgen(
+            id=0,
+            parent_uuid="8aab26d7-7657-47fa-b624-ed752864ae76",
+            params=params,
+            session=db_session,
+        )
+    )
+    run_job_raptgen.delay(child_uuid=source_uuid, database_url=url).wait()
+    db_session.commit()
+
+    # the pHMM length of the source must match
+    with pytest.raises(ValueError):
+        load_warm_start_checkpoint(
+            db_session,
+            RaptGenTrainingParams(
+                **raptgen_training_params
+                | {"model_length": 5, "warm_start_child_uuid": source_uuid}
+            ),
+        )
+
+    params = RaptGenTrainingParams(
+        **raptgen_training_params
+        | {
+            "epochs": 1,
+            "warm_start_child_uuid": source_uuid,
+            "warm_start_optimizer": True,
+            "frozen_encoder_layers": 6,
+        }
+    )
+    uuid = str(
+        initialize_job_raptgen(
+            id=1,
+            parent_uuid="8aab26d7-7657-47fa-b624-ed752864ae76",
+            params=params,
+            session=db_session,
+        )
+    )
+    run_job_raptgen.delay(child_uuid=uuid, database_url=url).wait()
+    db_session.commit()
+
+    # the frozen encoder keeps the weights of the source
+    source = load_warm_start_checkpoint(db_session, params)["model"]
+    child_job = db_session.query(ChildJob).filter(ChildJob.uuid == uuid).first()
+    assert child_job.status == "success"
+    checkpoint = load_warm_start_checkpoint(
+        db_session,
+        RaptGenTrainingParams(
+            **raptgen_training_params | {"warm_start_child_uuid": uuid}
+        ),
+    )["model"]
+    for name, weight in source.items():
+        # batch normalization statistics still follow the new dataset
+        if name.startswith("encoder.") and not name.endswith(
+            ("running_mean", "running_var", "num_batches_tracked")
+        ):
+            assert np.array_equal(weight.numpy(), checkpoint[name].numpy())
+
+
+def test_successive_halving_rungs():
+    """Test the rungs and the child jobs kept at a rung."""
+    rungs = [epoch for epoch in range(1, 50) if _is_halving_rung(epoch, 4, 3)]
+    assert rungs == [4, 12, 36]
+
+    losses = {"a": 3.0, "b": 1.0, "c": 2.0, "d": 5.0, "e": 4.0, "f": 2.0}
+    assert _halving_survivors(losses, 3) == {"b", "c", "f"}
+    assert _halving_survivors(losses, 2) == {"b", "c", "f"}
+    assert _halving_survivors({"a": 3.0, "b": 1.0}, 3) == {"a", "b"}
+
 
 def test_job_raptgen_invalid_train(db_session, celery_worker, eager_mode):
     url = db_session.get_bind().url.render_as_string(hide_password=False)
@@ -0,0 +1,95 @@
+import os
+import threading
+
+import torch
+
+from core.resources import CoreScheduler, bind_threads, split_cores
+
+
+def test_core_scheduler_admits_jobs_within_budget():
+    """Test that jobs get disjoint cores and wait while the cores are taken."""
+    scheduler = CoreScheduler(cores=[0, 1, 2, 3, 4], threads_per_job=2)
+    assert scheduler.max_jobs == 2
+
+    with scheduler as first:
+        assert torch.get_num_threads() == 2
+        with scheduler as second:
+            assert len(first) == len(second) == 2
+            assert set(first).isdisjoint(second)
+
+            admitted = threading.Event()
+
+            def job():
+                with scheduler:
+                    admitted.set()
+
+            thread = threading.Thread(target=job)
+            thread.start()
+            assert not admitted.wait(timeout=0.2)
+
+        assert admitted.wait(timeout=5)
+        thread.join()
+
+    assert scheduler._free == [0, 1, 2, 3, 4]
+
+
+def test_core_scheduler_default_budget():
+    """Test the default number of threads per job."""
+    assert CoreScheduler(cores=[0]).threads_per_job == 1
+    assert CoreScheduler(cores=list(range(6))).threads_per_job == 3
+    assert CoreScheduler(cores=list(range(32))).threads_per_job == 4
+
+
+def test_split_cores_among_processes():
+    """Test that each process of a job gets its own slice of the cores."""
+    assert split_cores([0, 1, 2, 3], 2) == [[0, 1], [2, 3]]
+    assert split_cores([0, 1, 2, 3, 4], 3) == [[0], [1, 2], [3, 4]]
+    assert split_cores([0, 1], 3) == [[0], [1], [0]]
+
+    num_threads = torch.get_num_threads()
+    try:
+        bind_threads([2, 3, 4])
+        assert torch.get_num_threads() == 3
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def test_core_scheduler_concurrent_jobs_keep_their_budget():
+    """Test that concurrent jobs do not overwrite each other's threads or affinity."""
+    scheduler = CoreScheduler(cores=[0, 1, 2, 3], threads_per_job=2, pin=True)
+    num_threads = torch.get_num_threads()
+    both_admitted = threading.Barrier(2)
+    results = {}
+
+    def job(name):
+        affinity = (
+            os.sched_getaffinity(threading.get_native_id())
+            if hasattr(os, "sched_getaffinity")
+            else None
+        )
+        with scheduler as cores:
+            both_admitted.wait(timeout=5)
+            threads = torch.get_num_threads()
+            both_admitted.wait(timeout=5)
+            results[name] = (
+                cores,
+                threads,
+                torch.get_num_threads(),
+                affinity is None
+                or os.sched_getaffinity(threading.get_native_id()) == affinity,
+            )
+
+    try:
+        threads = [threading.Thread(target=job, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        torch.set_num_threads(num_threads)
+
+    (first, *first_budget), (second, *second_budget) = results.values()
+    assert set(first).isdisjoint(second)
+    assert len(first) == len(second) == 2
+    assert first_budget == second_budget == [2, 2, True]
+    assert scheduler._free == [0, 1, 2, 3]
@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core.algorithms import CNN_PHMM_VAE, export_inference_model
+from routers import session
+
+test_app = FastAPI()
+test_app.include_router(session.router)
+
+client = TestClient(test_app)
+
+
+def test_measure_quantization_deviation(monkeypatch):
+    """Test that the deviation is measured on a bounded sample and cached."""
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    quantized = export_inference_model(model, quantize=True)
+
+    rng = np.random.default_rng(0)
+    sequences = ["".join(rng.choice(list("AUGC"), 12)) for _ in range(20)]
+
+    embedded = []
+    embed_sequences_ = session.embed_sequences
+
+    def embed_sequences(sequences, model):
+        embedded.append(len(sequences))
+        return embed_sequences_(sequences, model)
+
+    monkeypatch.setattr(session, "QUANTIZATION_SAMPLE_SIZE", 8)
+    monkeypatch.setattr(session, "quantization_deviations", {"vae": None})
+    with monkeypatch.context() as m:
+        m.setattr(session, "embed_sequences", embed_sequences)
+        session.measure_quantization_deviation("vae", sequences, quantized, model)
+
+    assert embedded == [8, 8]
+    assert 0 < session.quantization_deviations["vae"] < 5e-2
+
+
+def test_session_status_reports_deviation(monkeypatch):
+    """Test that the deviation measured after the session started is reported."""
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    monkeypatch.setattr(session, "sessions", {"s": model})
+    monkeypatch.setattr(session, "session_profiles", {"s": ("vae", True)})
+    monkeypatch.setattr(session, "prepared_sessions", {"s"})
+    monkeypatch.setattr(session, "quantization_deviations", {"vae": None})
+
+    response = client.get("/api/session/status", params={"session_uuid": "s"})
+    assert response.status_code == 200
+    assert response.json()["max_deviation"] is None
+
+    session.quantization_deviations["vae"] = 0.01
+    response = client.get("/api/session/status", params={"session_uuid": "s"})
+    assert response.json() == {
+        "uuid": "s",
+        "vae_uuid": "vae",
+        "quantized": True,
+        "ready": True,
+        "max_deviation": 0.01,
+    }
+
+    assert client.get("/api/session/status").json() == {"entries": ["s"]}
+    response = client.get("/api/session/status", params={"session_uuid": "t"})
+    assert response.status_code == 404
+
+
+def test_prepare_session(monkeypatch):
+    """Test that the exported model and the decode tiles replace the eager model."""
+    torch.manual_seed(0)
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    monkeypatch.setattr(session, "sessions", {"s": model})
+    monkeypatch.setattr(session, "prepared_sessions", set())
+    monkeypatch.setattr(session, "decode_tiles", {})
+    monkeypatch.setattr(session, "quantization_deviations", {"vae": None})
+
+    session.prepare_session("s", "vae", model, True, ((-1, 1), (-1, 1)), ["AUGCAUGC"])
+    assert session.sessions["s"] is not model
+    assert session.decode_tiles["s"].range_x == (-1, 1)
+    assert session.prepared_sessions == {"s"}
+    assert session.quantization_deviations["vae"] is not None
+
+    # a session ended before it was prepared stays ended
+    session.sessions.clear()
+    session.prepare_session("t", "vae", model, False, ((-1, 1), (-1, 1)), None)
+    assert "t" not in session.sessions and "t" not in session.decode_tiles
+
+
+def test_decode_sample_bounds_total_samples(monkeypatch):
+    """Test that the number of sequences sampled over all coordinates is bounded."""
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    monkeypatch.setattr(session, "sessions", {"s": model})
+    monkeypatch.setattr(session, "MAX_SAMPLES_PER_REQUEST", 20)
+
+    request = {"session_uuid": "s", "coords_x": [0.0, 1.0], "coords_y": [0.0, 1.0]}
+    response = client.post(
+        "/api/session/decode/sample", json=request | {"num_samples": 10}
+    )
+    assert response.status_code == 200
+    assert [len(samples) for samples in response.json()["sequences"]] == [10, 10]
+
+    response = client.post(
+        "/api/session/decode/sample", json=request | {"num_samples": 11}
+    )
+    assert response.status_code == 422
+
+
+def test_score_validates_sequences(monkeypatch):
+    """Test that invalid sequences and oversized requests are rejected with 422."""
+    model = CNN_PHMM_VAE(motif_len=8, embed_size=2).eval()
+    monkeypatch.setattr(session, "sessions", {"s": model})
+    monkeypatch.setattr(session, "MAX_SCORE_PAIRS", 8)
+
+    request = {"session_uuid": "s", "coords_x": [0.0, 1.0], "coords_y": [0.0, 1.0]}
+    response = client.post(
+        "/api/session/score", json=request | {"sequences": ["ACGU", "ACGT"]}
+    )
+    assert response.status_code == 200
+    assert len(response.json()["log_likelihoods"]) == 2
+
+    response = client.post(
+        "/api/session/score", json=request | {"sequences": ["ACGU", "ACGN"]}
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "sequences", 1]
+    response = client.post(
+        "/api/session/score", json=request | {"sequences": ["A"] * 5}
+    )
+    assert response.status_code == 422
+
+    request = {"session_uuid": "s", "range_x": [0, 1], "range_y": [0, 1]}
+    response = client.post(
+        "/api/session/score/heatmap",
+        json=request | {"sequences": ["acgu"], "resolution": 2},
+    )
+    assert response.status_code == 422
+    response = client.post(
+        "/api/session/score/heatmap",
+        json=request | {"sequences": ["ACGU"] * 3, "resolution": 2},
+    )
+    assert response.status_code == 422
+    response = client.post(
+        "/api/session/score/heatmap",
+        json=request | {"sequences": ["ACGU"] * 2, "resolution": 2},
+    )
+    assert response.status_code == 200
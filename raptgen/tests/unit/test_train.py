@@ -17,6 +17,7 @@ from mocks import (
     mock_params_raptgen,
 )
 from tasks import celery
+from core import checkpoints
 
 from core.db import (
     BaseSchema,
@@ -115,6 +116,12 @@ def eager_mode():
     )
 
 
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    # keep the checkpoints written by the jobs out of the working copy
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+
+
 @pytest.fixture
 def db_session(postgresql):
     connection = f"postgresql+psycopg2://{postgresql.info.user}:@{postgresql.info.host}:{postgresql.info.port}/{postgresql.info.dbname}"
@@ -422,6 +429,96 @@ def test_enqueue_job(db_session, celery_worker):
     return parent_uuid
 
 
+def test_enqueue_sweep_job(db_session, celery_worker):
+    request = {
+        "type": "RaptGen",
+        "name": "test_sweep",
+        "params_preprocessing": {
+            "forward": "A",
+            "reverse": "T",
+            "random_region_length": 5,
+            "tolerance": 0,
+            "minimum_count": 1,
+        },
+        "random_regions": ["ATGAG", "ATGCG", "ATGGG", "ATGTG"] * 25,
+        "duplicates": [1] * 100,
+        "reiteration": 2,
+        "params_training": {
+            "model_length": 5,
+            "epochs": 1,
+            "match_forcing_duration": 1,
+            "beta_duration": 1,
+            "early_stopping": 1,
+            "seed_value": 10,
+            "match_cost": 10,
+            "device": "CPU",
+        },
+        "sweep": {"grid": {"model_length": [4, 5, 6]}},
+    }
+    response = client.post("/api/train/jobs/submit", json=request)
+    assert response.status_code == 200
+
+    # the dataset is stored once for all the configurations
+    parent_uuid = response.json()["uuid"]
+    db_session.commit()
+    assert (
+        db_session.query(SequenceData)
+        .filter(SequenceData.parent_uuid == parent_uuid)
+        .count()
+        == 100
+    )
+    model_lengths = [
+        params.model_length
+        for params in db_session.query(RaptGenParams)
+        .join(ChildJob, ChildJob.uuid == RaptGenParams.child_uuid)
+        .filter(ChildJob.parent_uuid == parent_uuid)
+        .order_by(ChildJob.id)
+        .all()
+    ]
+    assert model_lengths == [4, 4, 5, 5, 6, 6]
+
+    # the reiteration count and the sweep are stored apart
+    parent_job = (
+        db_session.query(ParentJob).filter(ParentJob.uuid == parent_uuid).first()
+    )
+    assert parent_job.reiteration == 2
+    assert parent_job.num_configurations == 3
+    assert parent_job.sweep["grid"] == {"model_length": [4, 5, 6]}
+
+    # swept values must be valid training parameters
+    request["sweep"] = {"grid": {"model_length": [-1]}}
+    response = client.post("/api/train/jobs/submit", json=request)
+    assert response.status_code == 422
+    request["sweep"] = {"grid": {"unknown": [1]}}
+    response = client.post("/api/train/jobs/submit", json=request)
+    assert response.status_code == 422
+
+
+def test_rank_child_jobs(db_session):
+    parent_uuid = "465e884b-7657-47fa-b624-ed752864ae7b"
+    response = client.get(f"/api/train/jobs/ranking/{parent_uuid}")
+    assert response.status_code == 200
+    assert [item["id"] for item in response.json()] == [0, 1]
+    assert response.json()[0]["minimum_NLL"] == pytest.approx(0.02)
+    assert set(response.json()[0]) == {
+        "id",
+        "status",
+        "epochs_finished",
+        "minimum_NLL",
+        "params_training",
+    }
+
+    # child jobs without a minimum NLL come last
+    parent_uuid = "465e884b-7657-47fa-b624-ed752864ae7d"
+    response = client.get(f"/api/train/jobs/ranking/{parent_uuid}")
+    assert [item["minimum_NLL"] for item in response.json()][-1] is None
+
+    response = client.get(
+        "/api/train/jobs/ranking/465e884b-7657-47fa-b624-1234567890ab"
+    )
+    assert response.status_code == 422
+
+
 def test_suspend_job(db_session, celery_worker):
     response = client.post(
         "/api/train/jobs/submit",